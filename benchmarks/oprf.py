@@ -0,0 +1,55 @@
+import argparse
+import random
+import time
+
+from fastecdsa.point import Point
+
+from moya.overlap.oprf import OPRF
+from moya.overlap.parameters import Parameters
+
+
+def generic_multiply(items: list[int], point: Point) -> list[tuple[int, int]]:
+    "the scalar multiplications as they were done before the fixed-base tables"
+    products = [item * point for item in items]
+    return [(Q.x, Q.y) for Q in products]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare generic scalar multiplication against the fixed-base tables for the OPRF")
+    parser.add_argument("--server-items", type=int, default=2**20, help="Size of the server set to preprocess")
+    parser.add_argument("--sample", type=int, default=2**13, help="Items to time the generic multiplication on, it is extrapolated from there")
+    parser.add_argument("--processes", type=int, default=None, help="OPRF worker processes, defaults to the number of CPUs")
+    args = parser.parse_args()
+
+    parameters = Parameters()
+    # Phone numbers in international format are around 40 bits
+    server_set = [random.randrange(10**10, 10**12) for _ in range(args.server_items)]
+    client_set = server_set[: parameters.max_client_size]
+
+    with OPRF(parameters, processes=args.processes) as oprf:
+        point = random.randrange(oprf.order_of_generator) * oprf.G
+        sample = server_set[: args.sample]
+
+        start = time.perf_counter()
+        expected = generic_multiply(sample, point)
+        generic = (time.perf_counter() - start) / len(sample)
+        assert oprf.client_offline_batch(sample, point) == expected
+        assert oprf.server_offline(sample, point) == [oprf.truncate(x) for x, _ in expected]
+
+        start = time.perf_counter()
+        oprf.server_offline(server_set, point)
+        fixed_base = time.perf_counter() - start
+        print(f"server preprocessing of {len(server_set)} items on {oprf.number_of_processes} processes")
+        print(f"  generic:    {generic * len(server_set) / oprf.number_of_processes:.1f}s (extrapolated from {len(sample)} items)")
+        print(f"  fixed-base: {fixed_base:.1f}s")
+
+        start = time.perf_counter()
+        oprf.client_offline_batch(client_set, point)
+        fixed_base = time.perf_counter() - start
+        print(f"client preprocessing of {len(client_set)} items")
+        print(f"  generic:    {generic * len(client_set):.2f}s")
+        print(f"  fixed-base: {fixed_base:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import argparse
+import time
+
+import numpy as np
+
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import coeffs_from_roots, coeffs_from_roots_batched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare building the minibin polynomials one by one against the batched engine")
+    parser.add_argument("--bin-capacity", type=int, default=Parameters().bin_capacity)
+    parser.add_argument("--workers", type=int, default=None, help="Threads for the batched engine, defaults to the number of CPUs")
+    args = parser.parse_args()
+
+    parameters = Parameters(bin_capacity=args.bin_capacity)
+    rng = np.random.default_rng()
+    minibins = rng.integers(0, parameters.plain_modulus, size=(2**parameters.output_bits * parameters.alpha, parameters.minibin_capacity))
+
+    start = time.perf_counter()
+    expected = [coeffs_from_roots(roots, parameters.plain_modulus) for roots in minibins.tolist()]
+    per_minibin = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = coeffs_from_roots_batched(minibins, parameters.plain_modulus, args.workers)
+    batched_time = time.perf_counter() - start
+
+    assert batched.tolist() == expected
+    print(f"{len(minibins)} minibins of {parameters.minibin_capacity} roots")
+    print(f"  per minibin: {per_minibin:.2f}s")
+    print(f"  batched:     {batched_time:.2f}s ({per_minibin / batched_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
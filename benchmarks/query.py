@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tenseal as ts
+
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.types import BFVVector, CoeffMatrix, OPRFPoints, VectorMatrix
+
+
+class LocalHelper(ClientHelperBase):
+    def __init__(self, server: Server, database: CoeffMatrix) -> None:
+        self.server = server
+        self.database = database
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(encoded_client_set)
+
+    async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        return self.server.run_overlap_query(self.database, enc_query)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure how server query latency scales with the number of query threads")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Thread counts to try")
+    parser.add_argument("--repeat", type=int, default=3, help="Queries to run for each thread count")
+    args = parser.parse_args()
+
+    parameters = Parameters()
+    server = Server(parameters, random.randrange(2**128))
+    database = server.preprocess_array([random.randrange(10**12) for _ in range(1000)]).T
+
+    client = Client(parameters, LocalHelper(server, database))
+    enc_query = asyncio.run(client.prepare_query(client.preprocess_oprf([random.randrange(10**12) for _ in range(1000)]))).enc_query
+
+    start = time.perf_counter()
+    server.run_overlap_query(database, enc_query)
+    print(f"serial, encoding the database rows: {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    start = time.perf_counter()
+    cache = server.cache_plaintexts(database)
+    print(f"encoding the database rows once: {(time.perf_counter() - start) * 1000:.0f}ms, {cache.nbytes / 2**20:.0f}MiB")
+
+    start = time.perf_counter()
+    expected = [r.serialize() for r in server.run_overlap_query(database, enc_query)]
+    print(f"serial, cached rows: {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    for workers in args.workers:
+        with ThreadPoolExecutor(workers) as executor:
+            server.query_executor = executor
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = server.run_overlap_query(database, enc_query)
+                timings.append(time.perf_counter() - start)
+            assert [r.serialize() for r in result] == expected, "Results differ from the serial run"
+        print(f"{workers} threads: {min(timings) * 1000:.0f}ms")
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
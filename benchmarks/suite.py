@@ -0,0 +1,243 @@
+"""
+Time each stage of the protocol separately, over a range of server and client set sizes.
+
+Every stage records its wall and CPU time, the peak growth of the resident memory of this process while it ran, and
+the size of what it would send over the wire. Results are written as JSON, and two results files can be compared:
+
+    python benchmarks/suite.py --server-log-sizes 16 18 20 --output new.json
+    python benchmarks/suite.py --compare old.json new.json
+
+The number sets are random, with a known overlap so that the results can be checked.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import typing as t
+from importlib import metadata
+
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.points import compress_points
+from moya.overlap.server import Server
+from moya.overlap.session import context_id
+from moya.overlap.types import BFVVector, OPRFPoints, VectorMatrix
+from moya.overlap.wire import encode_answer, encode_compressed_points, encode_points, encode_query
+
+R = t.TypeVar("R")
+
+# Bin capacity for each log2 of the server set size, with the default 2 ** 13 bins and 3 hashes
+BIN_CAPACITY = {16: 68, 18: 176, 20: 536, 22: 1832, 24: 6727}
+
+
+class ReplayHelper(ClientHelperBase):
+    "Client helper which returns answers computed beforehand, so that client stages are timed on their own"
+
+    def __init__(self) -> None:
+        self.oprf_answer: OPRFPoints = []
+        self.query_answer: list[BFVVector] = []
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return self.oprf_answer
+
+    async def run_query(self, public_context: t.Any, enc_query: VectorMatrix) -> list[BFVVector]:
+        return self.query_answer
+
+
+class PeakMemory:
+    """
+    Track the peak resident memory of this process above where it started, by sampling it on a thread. Unlike
+    tracemalloc this sees the memory allocated by TenSEAL, and barely slows down the code being measured.
+    """
+
+    interval = 0.005
+
+    def __init__(self) -> None:
+        self.start = self.peak = self.rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def rss() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # Not Linux, only the high-water mark of the whole process is available
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _sample(self) -> None:
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self) -> "PeakMemory":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+    @property
+    def growth(self) -> int:
+        return self.peak - self.start
+
+
+class Recorder:
+    def __init__(self, profile_dir: str | None) -> None:
+        self.profile_dir = profile_dir
+        self.results: list[dict[str, t.Any]] = []
+
+    def stage(self, name: str, fn: t.Callable[[], R], sizes: dict[str, int], payload: t.Callable[[R], dict[str, int]] | None = None) -> R:
+        """
+        Run and record a stage, returning its result
+
+        :param payload: function giving the number of bytes sent over the wire from the result of the stage
+        """
+        profile = cProfile.Profile() if self.profile_dir else None
+        with PeakMemory() as memory:
+            wall, cpu = time.perf_counter(), time.process_time()
+            result = profile.runcall(fn) if profile else fn()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        if profile and self.profile_dir:
+            profile.dump_stats(os.path.join(self.profile_dir, f"{name}-{sizes['server_log_size']}-{sizes.get('client_size', 0)}.prof"))
+
+        payload_bytes = payload(result) if payload else {}
+        self.results.append({"stage": name, **sizes, "seconds": wall, "cpu_seconds": cpu, "peak_memory_bytes": memory.growth, **payload_bytes})
+        sent = f"  {payload_bytes['payload_bytes'] / 2**20:8.2f}MiB sent" if payload_bytes else ""
+        print(f"  {name:<28} {wall:8.2f}s  {memory.growth / 2**20:8.1f}MiB{sent}")
+        return result
+
+
+def version() -> str | None:
+    try:
+        return metadata.version("moya-pythonlib-overlap")
+    except metadata.PackageNotFoundError:
+        pass
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> dict[str, t.Any]:
+    recorder = Recorder(args.profile)
+    rng = random.Random(args.seed)
+
+    for server_log_size in args.server_log_sizes:
+        parameters = Parameters(bin_capacity=BIN_CAPACITY[server_log_size])
+        # Phone numbers in international format are around 40 bits
+        server_set = list({rng.randrange(10**10, 10**12) for _ in range(2**server_log_size)})
+        server = Server(parameters, rng.randrange(2**128))
+        sizes = {"server_log_size": server_log_size}
+        print(f"server set of 2^{server_log_size}, bin capacity {parameters.bin_capacity}")
+
+        PRFed_server_set = recorder.stage("server.oprf_offline", lambda: server.oprf_offline(server_set), sizes)
+        database = recorder.stage("server.build_database", lambda: server.database_from_oprf(PRFed_server_set).T, sizes)
+        recorder.stage("server.cache_plaintexts", lambda: server.cache_plaintexts(database), sizes)
+
+        for client_size in args.client_sizes:
+            sizes = {"server_log_size": server_log_size, "client_size": client_size}
+            overlap = client_size // 2
+            client_set = rng.sample(server_set, overlap) + [rng.randrange(10**12, 10**13) for _ in range(client_size - overlap)]
+            helper = ReplayHelper()
+            client = recorder.stage("client.keygen", lambda: Client(parameters, helper), sizes)
+            print(f" client set of {client_size}")
+
+            def points_payload(points: OPRFPoints) -> dict[str, int]:
+                return {"payload_bytes": len(encode_points(points)), "compressed_payload_bytes": len(encode_compressed_points(compress_points(points)))}
+
+            encoded = recorder.stage("client.preprocess_oprf", lambda: client.preprocess_oprf(client_set), sizes, points_payload)
+            helper.oprf_answer = recorder.stage("server.oprf", lambda: server.oprf(encoded), sizes, points_payload)
+            prepared = recorder.stage(
+                "client.prepare_query",
+                lambda: asyncio.run(client.prepare_query(encoded)),
+                sizes,
+                lambda prepared: {
+                    "payload_bytes": len(encode_query(client.public_context, prepared.enc_query)),
+                    "session_payload_bytes": len(encode_query(context_id(client.public_context.serialize()), prepared.enc_query)),
+                },
+            )
+            helper.query_answer = recorder.stage(
+                "server.query",
+                lambda: server.run_overlap_query(database, prepared.enc_query),
+                sizes,
+                lambda answer: {"payload_bytes": len(encode_answer(answer))},
+            )
+            matches = recorder.stage("client.decrypt", lambda: asyncio.run(client.run_prepared_query(prepared)), sizes)
+            found = sorted(client_set[i] for i in matches)
+            if found != sorted(client_set[:overlap]):
+                print(f"  found {len(found)} of the {overlap} overlapping numbers")
+            recorder.results[-1]["correct"] = found == sorted(client_set[:overlap])
+            client.close()
+        server.close()
+
+    return {
+        "version": version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "arguments": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": recorder.results,
+    }
+
+
+def compare(old_path: str, new_path: str) -> None:
+    "print the change in time and memory of each stage between two results files"
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def key(result: dict[str, t.Any]) -> tuple[t.Any, ...]:
+        return result["stage"], result["server_log_size"], result.get("client_size")
+
+    baseline = {key(result): result for result in old["results"]}
+    print(f"{old['version']} -> {new['version']}")
+    for result in new["results"]:
+        before = baseline.get(key(result))
+        if before is None:
+            continue
+        stage, server_log_size, client_size = key(result)
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        label = f"{stage} 2^{server_log_size}" + (f" x {client_size}" if client_size else "")
+        print(f"  {label:<44} {before['seconds']:8.2f}s -> {result['seconds']:8.2f}s ({ratio:5.2f}x)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time each stage of the protocol over a range of set sizes")
+    parser.add_argument("--server-log-sizes", type=int, nargs="+", default=[16, 18], choices=sorted(BIN_CAPACITY), help="log2 of the server set sizes")
+    parser.add_argument("--client-sizes", type=int, nargs="+", default=[1000, Parameters().max_client_size])
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random number sets")
+    parser.add_argument("--output", help="File to write the results to as JSON")
+    parser.add_argument("--profile", metavar="DIRECTORY", help="Also write a cProfile file for each stage to this directory")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,9 @@ async def main() -> None:
         # A new private key is automatically generated each time this is used
         c = await client_helper.get_client()
 
-        overlapped_numbers = await c.get_intersection(client_set)
+        overlapped_numbers = []
+        async for batch in c.get_intersection_batched(client_set):
+            overlapped_numbers += batch
         print(f"Found {len(overlapped_numbers)} overlapped numbers:")
         for number in overlapped_numbers:
             print(f"    {number}")
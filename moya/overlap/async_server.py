@@ -0,0 +1,171 @@
+import asyncio
+import typing as t
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+
+from tenseal import BFVVector
+
+from .server import Server
+from .types import CoeffMatrix, CompressedPoints, OPRFPoints, VectorMatrix
+
+R = t.TypeVar("R")
+
+
+class ServerBusy(Exception):
+    "The request queue of an AsyncServer is full"
+
+
+class AsyncServerStats(t.NamedTuple):
+    # Requests waiting for a slot, and requests being worked on
+    queued: int
+    running: int
+
+    # Requests that finished, that raised an error, that were turned away because the queue was full, that ran past
+    # their deadline and that were cancelled by the caller
+    completed: int
+    failed: int
+    rejected: int
+    timed_out: int
+    cancelled: int
+
+    # Average time completed requests spent waiting for a slot and being worked on, and the longest total, in seconds
+    mean_queue_time: float
+    mean_run_time: float
+    max_latency: float
+
+
+class AsyncServer:
+    """
+    Asyncio front end of a Server, for embedding in an async web app. The blocking OPRF and query calls are run on an
+    executor so that they do not stall the event loop.
+
+    At most max_concurrency requests are worked on at a time, and at most max_queue more wait for a slot. Requests
+    beyond that raise ServerBusy straight away, so that a client can back off or go to another server rather than
+    queue up behind work that will take longer than it is willing to wait.
+
+    A request which runs past its deadline or is cancelled returns straight away, but its slot is only freed once the
+    executor has finished the work it started, as that cannot be interrupted.
+    """
+
+    def __init__(
+        self,
+        server: Server,
+        executor: Executor | None = None,
+        max_concurrency: int = 1,
+        max_queue: int = 16,
+        timeout: float | None = None,
+    ):
+        """
+        :param executor: where to run the work, by default a thread pool with max_concurrency threads. The OPRF itself
+            is spread over the process pool of the server.
+        :param timeout: default deadline of each request in seconds, including the time spent queued
+        """
+        self.server = server
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._executor = executor or ThreadPoolExecutor(max_concurrency, thread_name_prefix="overlap")
+        self._owns_executor = executor is None
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._cancelled = 0
+        self._queue_time = 0.0
+        self._run_time = 0.0
+        self._max_latency = 0.0
+
+    async def __aenter__(self) -> "AsyncServer":
+        return self
+
+    async def __aexit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        "Shut down the executor if it is owned by this object"
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def stats(self) -> AsyncServerStats:
+        return AsyncServerStats(
+            queued=self._queued,
+            running=self._running,
+            completed=self._completed,
+            failed=self._failed,
+            rejected=self._rejected,
+            timed_out=self._timed_out,
+            cancelled=self._cancelled,
+            mean_queue_time=self._queue_time / self._completed if self._completed else 0.0,
+            mean_run_time=self._run_time / self._completed if self._completed else 0.0,
+            max_latency=self._max_latency,
+        )
+
+    async def oprf(self, points: OPRFPoints, timeout: float | None = None) -> OPRFPoints:
+        return await self._submit(partial(self.server.oprf, points), timeout)
+
+    async def oprf_compressed(self, points: CompressedPoints, timeout: float | None = None) -> CompressedPoints:
+        return await self._submit(partial(self.server.oprf_compressed, points), timeout)
+
+    async def run_overlap_query(self, transposed_poly_coeffs: CoeffMatrix, received_enc_query: VectorMatrix, timeout: float | None = None) -> list[BFVVector]:
+        return await self._submit(partial(self.server.run_overlap_query, transposed_poly_coeffs, received_enc_query), timeout)
+
+    def _finished(self, future: "asyncio.Future[t.Any]") -> None:
+        "free the slot of a request once the executor is done with it, whether or not anyone is still waiting for it"
+        self._running -= 1
+        self._slots.release()
+        if not future.cancelled():
+            # Mark the error as retrieved, the caller may have given up on the request already
+            future.exception()
+
+    async def _submit(self, fn: t.Callable[[], R], timeout: float | None) -> R:
+        """
+        Wait for a slot and run fn on the executor, within the deadline
+        """
+        if self._queued >= self.max_queue and self._slots.locked():
+            self._rejected += 1
+            raise ServerBusy(f"{self._queued} requests already queued")
+
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        start = loop.time()
+
+        try:
+            self._queued += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+            finally:
+                self._queued -= 1
+            queued = loop.time()
+
+            try:
+                future = loop.run_in_executor(self._executor, fn)
+            except BaseException:
+                self._slots.release()
+                raise
+            self._running += 1
+            future.add_done_callback(self._finished)
+
+            # The work carries on if the caller stops waiting, _finished() frees the slot at the end
+            result = await asyncio.wait_for(asyncio.shield(future), None if deadline is None else max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self._timed_out += 1
+            raise
+        except asyncio.CancelledError:
+            self._cancelled += 1
+            raise
+        except Exception:
+            self._failed += 1
+            raise
+
+        self._completed += 1
+        self._queue_time += queued - start
+        self._run_time += loop.time() - queued
+        self._max_latency = max(self._max_latency, loop.time() - start)
+        return result
@@ -1,12 +1,25 @@
+import asyncio
+import contextlib
+import contextvars
 import random
+import typing as t
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from functools import partial
+from multiprocessing.pool import Pool
 
+import numpy as np
 import tenseal as ts
 
+from .contexts import ContextPool, generate_contexts
 from .cuckoo_hash import Cuckoo
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
 from .oprf import OPRF
 from .parameters import Parameters
-from .types import BFVVector, OPRFPoints, RawNumbers, VectorMatrix
+from .points import POINT_BYTES, compress_points, decompress_points
+from .types import BFVVector, CompressedPoints, OPRFPoints, RawNumbers, VectorMatrix
+
+R = t.TypeVar("R")
 
 
 class ClientHelperBase(ABC):
@@ -21,6 +34,23 @@ class ClientHelperBase(ABC):
         """
         pass
 
+    async def oprf_compressed(self, encoded_client_set: CompressedPoints) -> CompressedPoints:
+        """
+        Run OPRF against the server with SEC1 compressed points. Helpers for servers which only take full points can
+        rely on this default, which goes through oprf().
+        """
+        return compress_points(await self.oprf(decompress_points(encoded_client_set)))
+
+    async def oprf_chunks(self, encoded_client_set: OPRFPoints | CompressedPoints) -> t.AsyncIterator[tuple[int, OPRFPoints | CompressedPoints]]:
+        """
+        Run OPRF against the server, yielding the processed points in chunks as they come back, each along with the
+        index of its first point. Chunks may come back in any order. By default the whole set is a single chunk.
+        """
+        if isinstance(encoded_client_set, bytes):
+            yield 0, await self.oprf_compressed(encoded_client_set)
+        else:
+            yield 0, await self.oprf(encoded_client_set)
+
     @abstractmethod
     async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
         """
@@ -29,93 +59,236 @@ class ClientHelperBase(ABC):
         pass
 
 
+class PreparedQuery(t.NamedTuple):
+    """
+    State of a query which has been through the OPRF and encrypted, and is ready to be sent to the server
+    """
+
+    # Which client item is in each bin
+    cuckoo: Cuckoo
+    enc_query: VectorMatrix
+
+
 class Client:
-    def __init__(self, parameters: Parameters, helper: ClientHelperBase, oprf_client_key: int | None = None):
+    def __init__(
+        self,
+        parameters: Parameters,
+        helper: ClientHelperBase,
+        oprf_client_key: int | None = None,
+        pool: Pool | None = None,
+        compressed_points: bool = False,
+        instrumentation: Instrumentation | None = None,
+        contexts: ContextPool | None = None,
+        executor: Executor | None = None,
+        concurrency: asyncio.Semaphore | None = None,
+    ):
         """
         Generate a new client with the given parameters and helper.
 
         Optionally, a client OPRF key can be provided, otherwise a random one will be generated which is likely what is
         wanted.
+
+        Optionally, a process pool can be provided for the OPRF work, otherwise one is started on first use and kept
+        until close() is called.
+
+        If compressed_points is set, get_intersection() and friends send SEC1 compressed points for the OPRF, which
+        takes around half the traffic.
+
+        Optionally, an Instrumentation can be provided to time each stage of the queries, which otherwise costs nothing.
+
+        Optionally, a ContextPool can be provided to take a key pair generated ahead of time from, rather than generate
+        one here.
+
+        Optionally, an executor can be provided to run the CPU-bound stages of the queries on (the OPRF preprocessing,
+        hashing, windowing, encryption and decryption), so that they do not hold up the event loop. Otherwise they run on
+        the event loop. A semaphore shared between clients can also be provided to limit how many queries are prepared
+        or run at once, the others waiting their turn rather than slowing every query down.
         """
         self.parameters = parameters
         self.helper = helper
-        self._oprf = OPRF(self.parameters)
+        self.compressed_points = compressed_points
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.executor = executor
+        self.concurrency = concurrency
+        self._oprf = OPRF(self.parameters, pool=pool)
 
         # Generate a random key if none is provided. Not cryptographically secure, but good enough for our use-case
         # especially if it's continuously regenerated.
         self.key = oprf_client_key if oprf_client_key is not None else random.randrange(self._oprf.order_of_generator)  # nosec
 
         # Setting the public and private contexts for the BFV Homorphic Encryption scheme
-        self.private_context = ts.context(
-            ts.SCHEME_TYPE.BFV, poly_modulus_degree=self.parameters.poly_modulus_degree, plain_modulus=self.parameters.plain_modulus
-        )
-        self.public_context = ts.context_from(self.private_context.serialize())
-        self.public_context.make_context_public()
+        if contexts is not None:
+            if not contexts.matches(parameters):
+                raise ValueError("the ContextPool was created for different encryption parameters")
+            self.private_context, self.public_context = contexts.get()
+        else:
+            with self.instrumentation.stage("client.keygen", background=False):
+                self.private_context, self.public_context = generate_contexts(parameters)
+
+    def close(self) -> None:
+        "Release the OPRF worker pool"
+        self._oprf.close()
 
     def preprocess_oprf(self, client_set: RawNumbers) -> OPRFPoints:
         """
         Given a secret key and list of numbers, return preprocessed PRF which can be saved if called multiple times and
         should be sent to the oprf() function on the server.
         """
-        client_point_precomputed = (self.key % self._oprf.order_of_generator) * self._oprf.G
-        return [self._oprf.client_offline(item, client_point_precomputed) for item in client_set]
+        with self.instrumentation.stage("client.preprocess_oprf", items=len(client_set)):
+            client_point_precomputed = (self.key % self._oprf.order_of_generator) * self._oprf.G
+            return self._oprf.client_offline_batch(client_set, client_point_precomputed)
+
+    def preprocess_oprf_compressed(self, client_set: RawNumbers) -> CompressedPoints:
+        """
+        Same as preprocess_oprf(), with the points SEC1 compressed
+        """
+        return compress_points(self.preprocess_oprf(client_set))
+
+    async def _preprocess(self, client_set: RawNumbers) -> OPRFPoints | CompressedPoints:
+        preprocess = self.preprocess_oprf_compressed if self.compressed_points else self.preprocess_oprf
+        async with self._slot():
+            return await self._offload(partial(preprocess, client_set))
+
+    def _in_executor(self, fn: t.Callable[[], R]) -> t.Awaitable[R]:
+        "run fn on the executor, or on the default executor of the event loop if there is none"
+        if self.executor is None:
+            return asyncio.to_thread(fn)
+        # Copy the context variables as asyncio.to_thread() does, they hold the current stage of the instrumentation
+        return asyncio.get_running_loop().run_in_executor(self.executor, contextvars.copy_context().run, fn)
+
+    async def _offload(self, fn: t.Callable[[], R]) -> R:
+        "run a CPU-bound stage on the executor, or inline if there is none"
+        if self.executor is None:
+            return fn()
+        return await self._in_executor(fn)
+
+    def _slot(self) -> t.AsyncContextManager[t.Any]:
+        "a slot of the concurrency limit"
+        return self.concurrency if self.concurrency is not None else contextlib.nullcontext()
 
     async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
         return await self.helper.oprf(encoded_client_set)
 
-    async def run(self, encoded_client_set: OPRFPoints) -> RawNumbers:
-        PRFed_encoded_client_set = await self.oprf(encoded_client_set)
+    async def prepare_query(self, encoded_client_set: OPRFPoints | CompressedPoints) -> PreparedQuery:
+        """
+        Run the OPRF against the server for the given preprocessed set, then hash, window and encrypt it ready to be
+        queried.
+        """
+        async with self._slot():
+            with self.instrumentation.stage("client.prepare_query"):
+                return await self._prepare_query(encoded_client_set)
 
-        # We finalize the OPRF processing by applying the inverse of the secret key, oprf_client_key
+    async def _prepare_query(self, encoded_client_set: OPRFPoints | CompressedPoints) -> PreparedQuery:
+        # We finalize the OPRF processing by applying the inverse of the secret key, oprf_client_key. Each chunk is
+        # finalized on a thread as soon as it comes back from the server, while the other chunks are still in flight.
         key_inverse = pow(self.key, -1, self._oprf.order_of_generator)
-        PRFed_client_set = self._oprf.client_online(key_inverse, PRFed_encoded_client_set)
+        compressed = isinstance(encoded_client_set, bytes)
+        size = len(encoded_client_set) // POINT_BYTES if compressed else len(encoded_client_set)
+        PRFed_client_set = [0] * size
+        # Index of the first point and number of points of each chunk, which between them have to cover the request
+        covered: list[tuple[int, int]] = []
+
+        def finalize(start: int, chunk: OPRFPoints | CompressedPoints) -> None:
+            if isinstance(chunk, bytes):
+                if len(chunk) % POINT_BYTES:
+                    raise ValueError("OPRF response does not hold a whole number of compressed points")
+                points = len(chunk) // POINT_BYTES
+                PRFed = self._oprf.client_online_compressed(key_inverse, chunk)
+            else:
+                points = len(chunk)
+                PRFed = self._oprf.client_online(key_inverse, chunk)
+            if len(PRFed) != points or start + len(PRFed) > size:
+                raise ValueError("OPRF response does not match the request")
+            PRFed_client_set[start : start + len(PRFed)] = PRFed
+            covered.append((start, len(PRFed)))
+
+        finalizing = []
+        with self.instrumentation.stage("client.oprf", items=size, compressed=compressed) as stage:
+            try:
+                async for start, chunk in self.helper.oprf_chunks(encoded_client_set):
+                    finalizing.append(asyncio.ensure_future(self._in_executor(partial(finalize, start, chunk))))
+                await asyncio.gather(*finalizing)
+            finally:
+                for future in finalizing:
+                    future.cancel()
+            stage.record(chunks=len(finalizing))
 
+        # The chunks follow on from each other, with no point missing or answered twice
+        end = 0
+        for start, length in sorted(covered):
+            if start != end:
+                raise ValueError("OPRF response does not match the request")
+            end += length
+        if end != size:
+            raise ValueError("OPRF response does not match the request")
+
+        return await self._offload(partial(self._encrypt_query, PRFed_client_set))
+
+    def _encrypt_query(self, PRFed_client_set: list[int]) -> PreparedQuery:
+        "hash, window and encrypt the client set once it has been through the OPRF"
+        size = len(PRFed_client_set)
         # Each PRFed item from the client set is mapped to a Cuckoo hash table
-        CH = Cuckoo(self.parameters)
-        for item in PRFed_client_set:
-            CH.insert(item)
+        with self.instrumentation.stage("client.cuckoo", items=size, bins=2**self.parameters.output_bits):
+            CH = Cuckoo(self.parameters)
+            CH.insert_all(PRFed_client_set)
 
-        windowed_items = CH.process_window_items()
+        with self.instrumentation.stage("client.window"):
+            windowed_items = CH.window_array()
 
-        plain_query: list[int | None] = [None for k in range(len(windowed_items))]
         enc_query: VectorMatrix = [[None for j in range(self.parameters.logB_ell)] for i in range(1, self.parameters.base)]
 
         # We create the <<batched>> query to be sent to the server
         # By our choice of parameters, number of bins = poly modulus degree (m/N =1), so we get (base - 1) * logB_ell ciphertexts
-        for j in range(self.parameters.logB_ell):
-            for i in range(self.parameters.base - 1):
-                if (i + 1) * self.parameters.base**j - 1 < self.parameters.minibin_capacity:
-                    for k in range(len(windowed_items)):
-                        plain_query[k] = windowed_items[k][i][j]
-                    enc_query[i][j] = ts.bfv_vector(self.public_context, plain_query)
-
-        result = await self.helper.run_query(self.public_context, enc_query)
-        secret_key = self.private_context.secret_key()
-        decryptions = [r.decrypt(secret_key) for r in result]
-
-        recover_CH_structure = [m[0][0] for m in windowed_items]
-
-        matches: RawNumbers = []
-        for j in range(self.parameters.alpha):
-            for i in range(self.parameters.poly_modulus_degree):
-                # If there is an index of this vector where he gets 0, then the (Cuckoo hashing) item corresponding to
-                # this index belongs to a minibin of the corresponding server's bin.
-                if decryptions[j][i] == 0:
-                    # The index i is the location of the element in the intersection
-                    # Here we recover this element from the Cuckoo hash structure
-                    PRFed_common_element = CH.reconstruct_item(
-                        recover_CH_structure[i], i, self.parameters.hash_seeds[recover_CH_structure[i] % (2**self.parameters.log_no_hashes)]
-                    )
-                    index = PRFed_client_set.index(PRFed_common_element)
-                    matches.append(index)
-
-        return matches
+        # windowed_items[i][j] holds the (i, j) window entry of every bin
+        with self.instrumentation.stage("client.encrypt") as stage:
+            for j in range(self.parameters.logB_ell):
+                for i in range(self.parameters.base - 1):
+                    if (i + 1) * self.parameters.base**j - 1 < self.parameters.minibin_capacity:
+                        enc_query[i][j] = ts.bfv_vector(self.public_context, windowed_items[i, j].tolist())
+            if stage.enabled:
+                ciphertexts = [v for row in enc_query for v in row if v is not None]
+                stage.record(ciphertexts=len(ciphertexts), bytes=sum(len(v.serialize()) for v in ciphertexts))
+
+        return PreparedQuery(CH, enc_query)
+
+    async def run_prepared_query(self, prepared: PreparedQuery) -> RawNumbers:
+        """
+        Send a prepared query to the server and decrypt the response, returning the indexes of the matching items
+        """
+        async with self._slot():
+            with self.instrumentation.stage("client.query") as stage:
+                result = await self.helper.run_query(self.public_context, prepared.enc_query)
+                if stage.enabled:
+                    stage.record(ciphertexts=len(result), bytes=sum(len(r.serialize()) for r in result))
+
+            return await self._offload(partial(self._decrypt, prepared, result))
+
+    def _decrypt(self, prepared: PreparedQuery, result: list[BFVVector]) -> RawNumbers:
+        "decrypt the answer of the server, returning the indexes of the matching items"
+        with self.instrumentation.stage("client.decrypt", ciphertexts=len(result)) as stage:
+            secret_key = self.private_context.secret_key()
+            decryptions = np.array([r.decrypt(secret_key) for r in result], dtype=np.int64)
+
+            # If there is an index of any of the vectors where we get 0, then the (Cuckoo hashing) item corresponding to
+            # this index belongs to a minibin of the corresponding server's bin. An item found in several of the vectors is
+            # only reported once.
+            matching_bins = np.flatnonzero((decryptions[:, : prepared.cuckoo.number_of_bins] == 0).any(axis=0))
+
+            # The Cuckoo table knows which input item is in each bin. Bins without an item only held a dummy message.
+            matches = prepared.cuckoo.item_index[matching_bins]
+            matches = matches[matches >= 0]
+            stage.record(matches=len(matches))
+            return t.cast(RawNumbers, matches.tolist())
+
+    async def run(self, encoded_client_set: OPRFPoints | CompressedPoints) -> RawNumbers:
+        with self.instrumentation.stage("client.run"):
+            return await self.run_prepared_query(await self.prepare_query(encoded_client_set))
 
     async def get_intersection(self, client_set: RawNumbers) -> RawNumbers:
         """
         Given a list of numbers, return those existing on the server also
         """
-        matches = await self.run(self.preprocess_oprf(client_set))
+        matches = await self.run(await self._preprocess(client_set))
 
         return [client_set[i] for i in matches]
 
@@ -123,4 +296,32 @@ class Client:
         """
         Given a list of numbers, return the number of them existing on the server also
         """
-        return len(await self.run(self.preprocess_oprf(client_set)))
+        return len(await self.run(await self._preprocess(client_set)))
+
+    async def get_intersection_batched(self, client_set: RawNumbers, batch_size: int | None = None) -> t.AsyncIterator[RawNumbers]:
+        """
+        Given a list of numbers of any size, split it into batches which each fit in a single query and yield, batch by
+        batch, those existing on the server also.
+
+        The batches are pipelined: while one batch is being evaluated by the server and decrypted, the OPRF round-trip
+        and encryption of the next one is already running. All batches share this client's BFV context.
+        """
+        if batch_size is None:
+            batch_size = self.parameters.max_client_size
+        batches = [client_set[i : i + batch_size] for i in range(0, len(client_set), batch_size)]
+        if not batches:
+            return
+
+        async def prepare(batch: RawNumbers) -> PreparedQuery:
+            return await self.prepare_query(await self._preprocess(batch))
+
+        next_query = asyncio.ensure_future(prepare(batches[0]))
+        try:
+            for i, batch in enumerate(batches):
+                prepared = await next_query
+                if i + 1 < len(batches):
+                    next_query = asyncio.ensure_future(prepare(batches[i + 1]))
+                matches = await self.run_prepared_query(prepared)
+                yield [batch[j] for j in matches]
+        finally:
+            next_query.cancel()
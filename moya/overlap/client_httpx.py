@@ -1,12 +1,32 @@
+import asyncio
+import json
 import typing as t
-from base64 import b64decode, b64encode
+import weakref
+from concurrent.futures import Executor
+from multiprocessing.pool import Pool
 
 import httpx
 import tenseal as ts
 
 from .client import Client, ClientHelperBase
+from .contexts import ContextPool
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
 from .parameters import Parameters
-from .types import BFVVector, OPRFPoints, VectorMatrix
+from .points import POINT_BYTES, compress_points, decompress_points
+from .types import BFVVector, CompressedPoints, OPRFPoints, VectorMatrix
+from .wire import (
+    ACCEPT,
+    BINARY,
+    JSON,
+    content_type_of,
+    decode_answer,
+    decode_oprf,
+    decode_points,
+    encode_compressed_points,
+    encode_context,
+    encode_points,
+    encode_query,
+)
 
 
 class HTTPClientHelper(ClientHelperBase):
@@ -14,8 +34,67 @@ class HTTPClientHelper(ClientHelperBase):
     Helper class for the client that uses HTTP to communicate with a remote server
     """
 
-    def __init__(self, http_client: httpx.AsyncClient) -> None:
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        pool: Pool | None = None,
+        binary: bool = True,
+        compress: bool = False,
+        oprf_chunk_size: int | None = 4096,
+        oprf_concurrency: int = 4,
+        retries: int = 2,
+        retry_delay: float = 0.5,
+        sessions: bool = True,
+        instrumentation: Instrumentation | None = None,
+        contexts: ContextPool | None = None,
+        executor: Executor | None = None,
+        max_concurrency: int | None = None,
+        compressed_points: bool = False,
+    ) -> None:
+        """
+        Optionally, a process pool can be given which will be shared by the OPRF processing of all the clients created
+        through get_client()
+
+        :param binary: send requests in the binary wire format, falling back to JSON if the server rejects the first
+            binary request as a client error, as servers which only take JSON do
+        :param compress: compress binary requests with zstd, if the zstandard package is installed
+        :param oprf_chunk_size: number of points to send in each OPRF request, or None to send them all in one
+        :param oprf_concurrency: how many OPRF requests to have in flight at once. They share the connection pool of
+            http_client, so its limits should allow for this many connections.
+        :param retries: how many times to retry an OPRF request which fails with a transport or server error, waiting
+            retry_delay seconds before the first retry and twice as long before each further one
+        :param sessions: upload the public context of each client once and refer to it by ID in its queries, rather
+            than send it with every query. Servers which do not support this get the context with every query.
+        :param instrumentation: given to the clients created through get_client(), and which also times each request
+            along with the bytes sent and received
+        :param contexts: key pairs generated ahead of time for the clients created through get_client(), which is only
+            used if it was created for the encryption parameters of the server
+        :param executor: given to the clients created through get_client(), to run the CPU-bound stages of their
+            queries off the event loop
+        :param max_concurrency: how many queries of the clients created through get_client() to prepare or run at
+            once, the others wait their turn
+        :param compressed_points: make the clients created through get_client() send SEC1 compressed points for the
+            OPRF, which are decompressed again for servers that only take JSON
+        """
         self.http_client = http_client
+        self.pool = pool
+        self.binary = binary
+        # Set once the server has accepted a binary request, after which client errors are not taken as a lack of support
+        self._binary_accepted = False
+        self.compress = compress
+        self.oprf_chunk_size = oprf_chunk_size
+        self.oprf_concurrency = oprf_concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.sessions = sessions
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.contexts = contexts
+        self.executor = executor
+        self.concurrency = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+        self.compressed_points = compressed_points
+
+        # ID of the uploaded public context of each client
+        self._context_ids: weakref.WeakKeyDictionary[ts.Context, str] = weakref.WeakKeyDictionary()
 
     async def get_client(self, oprf_client_key: int | None = None) -> Client:
         """
@@ -23,23 +102,130 @@ class HTTPClientHelper(ClientHelperBase):
         """
         response = await self.http_client.get("parameters")
         parameters = Parameters.model_validate(response.json())
-        return Client(parameters, self, oprf_client_key)
+        contexts = self.contexts if self.contexts is not None and self.contexts.matches(parameters) else None
+        return Client(
+            parameters,
+            self,
+            oprf_client_key,
+            pool=self.pool,
+            instrumentation=self.instrumentation,
+            contexts=contexts,
+            executor=self.executor,
+            concurrency=self.concurrency,
+            compressed_points=self.compressed_points,
+        )
 
-    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
-        response = await self.http_client.post("oprf", json={"points": encoded_client_set})
+    async def _post(self, url: str, encode: t.Callable[[str], bytes]) -> tuple[bytes, str]:
+        """
+        :param encode: function returning the body of the request in the given content type
+        :return: the body and content type of the response
+        """
+        if self.binary:
+            response = await self._send(url, encode(BINARY), {"Content-Type": BINARY, "Accept": ACCEPT})
+            # Servers which only take JSON answer a binary body with 415, or fail to validate it with 400 or 422
+            unsupported = response.status_code == httpx.codes.UNSUPPORTED_MEDIA_TYPE or (
+                not self._binary_accepted and response.status_code in (httpx.codes.BAD_REQUEST, httpx.codes.UNPROCESSABLE_ENTITY)
+            )
+            if not unsupported:
+                response.raise_for_status()
+                self._binary_accepted = True
+                return response.content, content_type_of(response.headers.get("Content-Type"))
+            # Older server, stick to JSON from now on
+            self.binary = False
+
+        response = await self._send(url, encode(JSON), {"Content-Type": JSON})
         response.raise_for_status()
+        return response.content, content_type_of(response.headers.get("Content-Type"))
+
+    async def _send(self, url: str, body: bytes, headers: dict[str, str]) -> httpx.Response:
+        with self.instrumentation.stage("client.http", url=url, content_type=headers["Content-Type"], request_bytes=len(body)) as stage:
+            response = await self.http_client.post(url, content=body, headers=headers)
+            stage.record(status=response.status_code, response_bytes=len(response.content))
+            return response
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return decode_points(*await self._post("oprf", lambda content_type: encode_points(encoded_client_set, content_type, self.compress)))
+
+    async def oprf_compressed(self, encoded_client_set: CompressedPoints) -> CompressedPoints:
+        def encode(content_type: str) -> bytes:
+            if content_type == BINARY:
+                return encode_compressed_points(encoded_client_set, self.compress)
+            # JSON only has room for full points
+            return encode_points(decompress_points(encoded_client_set), content_type)
 
-        return t.cast(OPRFPoints, [tuple(p) for p in response.json()["points"]])
+        points = decode_oprf(*await self._post("oprf", encode))
+        return points if isinstance(points, bytes) else compress_points(points)
+
+    async def _oprf_chunk(self, start: int, chunk: OPRFPoints | CompressedPoints) -> tuple[int, OPRFPoints | CompressedPoints]:
+        "run OPRF for one chunk, retrying transport and server errors"
+        attempt = 0
+        while True:
+            try:
+                if isinstance(chunk, bytes):
+                    return start, await self.oprf_compressed(chunk)
+                return start, await self.oprf(chunk)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt == self.retries or (isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500):
+                    raise
+            await asyncio.sleep(self.retry_delay * 2**attempt)
+            attempt += 1
+
+    async def oprf_chunks(self, encoded_client_set: OPRFPoints | CompressedPoints) -> t.AsyncIterator[tuple[int, OPRFPoints | CompressedPoints]]:
+        """
+        Split the OPRF into requests of oprf_chunk_size points, up to oprf_concurrency of them in flight at once, and
+        yield each chunk as soon as it comes back
+        """
+        width = POINT_BYTES if isinstance(encoded_client_set, bytes) else 1
+        size = len(encoded_client_set) // width
+        chunk_size = self.oprf_chunk_size or max(size, 1)
+        slots = asyncio.Semaphore(self.oprf_concurrency)
+
+        async def run(start: int) -> tuple[int, OPRFPoints | CompressedPoints]:
+            async with slots:
+                return await self._oprf_chunk(start, encoded_client_set[start * width : (start + chunk_size) * width])
+
+        tasks = [asyncio.ensure_future(run(start)) for start in range(0, size, chunk_size)]
+        try:
+            for next_chunk in asyncio.as_completed(tasks):
+                yield await next_chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def upload_context(self, public_context: ts.Context) -> str | None:
+        """
+        Upload a public context for later queries to refer to, unless it already was
+
+        :return: the ID of the context, or None if the server does not support uploading contexts
+        """
+        cid = self._context_ids.get(public_context)
+        if cid is None and self.sessions:
+            try:
+                data, _ = await self._post("context", lambda content_type: encode_context(public_context, content_type, self.compress))
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in (httpx.codes.NOT_FOUND, httpx.codes.METHOD_NOT_ALLOWED):
+                    raise
+                # Older server, send the context with every query from now on
+                self.sessions = False
+                return None
+            cid = self._context_ids[public_context] = json.loads(data)["context_id"]
+        return cid
 
     async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
-        response = await self.http_client.post(
-            "query",
-            json={
-                "public_context": b64encode(public_context.serialize()).decode(),
-                "enc_query": [[None if v is None else b64encode(v.serialize()).decode() for v in c] for c in enc_query],
-            },
-        )
-        response.raise_for_status()
+        context: ts.Context | str = public_context
+        cid = await self.upload_context(public_context)
+        if cid is not None:
+            try:
+                data, content_type = await self._post("query", lambda content_type: encode_query(cid, enc_query, content_type, self.compress))
+                return decode_answer(public_context, data, content_type)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != httpx.codes.NOT_FOUND:
+                    raise
+            # The server dropped the context, upload it again
+            del self._context_ids[public_context]
+            context = await self.upload_context(public_context) or public_context
+
+        data, content_type = await self._post("query", lambda content_type: encode_query(context, enc_query, content_type, self.compress))
 
         # Here is the vector of decryptions of the answer
-        return [ts.bfv_vector_from(public_context, b64decode(ct)) for ct in response.json()]
+        return decode_answer(public_context, data, content_type)
@@ -0,0 +1,162 @@
+"""
+BFV contexts of the clients, generated ahead of time.
+
+Every Client generates a new BFV key pair, which takes longer than anything else in creating it. A ContextPool
+generates key pairs on background threads and keeps up to a set number of them ready, so that a client can take one
+without waiting. Every key pair is only handed out once, so each client still has keys of its own. When the pool is
+empty, the key pair is generated on the spot as it would be without the pool.
+"""
+
+import collections
+import threading
+import time
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tenseal as ts
+
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from .parameters import Parameters
+
+
+class ClientContexts(t.NamedTuple):
+    """
+    Key pair of a client
+    """
+
+    # Holds the secret key, never leaves the client
+    private_context: ts.Context
+    # Sent to the server with the queries
+    public_context: ts.Context
+
+
+def generate_contexts(parameters: Parameters) -> ClientContexts:
+    "generate a new key pair for the encryption parameters"
+    private_context = ts.context(ts.SCHEME_TYPE.BFV, poly_modulus_degree=parameters.poly_modulus_degree, plain_modulus=parameters.plain_modulus)
+    # Copying the keys is quicker than going through serialize() and context_from()
+    public_context = private_context.copy()
+    public_context.make_context_public()
+    return ClientContexts(private_context, public_context)
+
+
+class ContextPoolStats(t.NamedTuple):
+    """
+    Counts of a ContextPool since it was created
+    """
+
+    # Key pairs taken from the pool, and those which had to be generated on the spot because it was empty
+    hits: int
+    misses: int
+    # Key pairs generated, in the background or on the spot, and the time taken by all of them
+    generated: int
+    generation_seconds: float
+    # Key pairs ready to be taken
+    ready: int
+
+    @property
+    def hit_rate(self) -> float:
+        "share of the key pairs taken from the pool"
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    @property
+    def mean_generation_seconds(self) -> float:
+        "time taken to generate a key pair"
+        return self.generation_seconds / self.generated if self.generated else 0.0
+
+
+class ContextPool:
+    """
+    Key pairs for the given Parameters, generated on background threads ahead of being needed. Pass it to Client or
+    HTTPClientHelper, which take a key pair from it for every client.
+
+    TenSEAL holds the GIL while it generates the keys, and again while it copies them for the public context, so the
+    background threads hold up the event loop, and any other Python thread, for each of those steps in turn. With the
+    default parameters that is a few tens of milliseconds at a time, which the event loop gets to run in between. Doing
+    the work in another process would not avoid this, as deserializing the contexts holds the GIL for about as long.
+    """
+
+    def __init__(self, parameters: Parameters, size: int = 4, workers: int = 1, instrumentation: Instrumentation | None = None):
+        """
+        :param size: number of key pairs to keep ready, each takes a few MB
+        :param workers: number of threads generating key pairs
+        :param instrumentation: times the generation of every key pair, as client.keygen
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.parameters = parameters
+        self.size = size
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+
+        self._ready: collections.deque[ClientContexts] = collections.deque()
+        self._pending = 0
+        self._hits = self._misses = self._generated = 0
+        self._generation_seconds = 0.0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="contexts")
+        self._refill()
+
+    def __enter__(self) -> "ContextPool":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        "Stop generating key pairs and drop those which are ready"
+        with self._lock:
+            self._closed = True
+            self._ready.clear()
+        self._executor.shutdown(cancel_futures=True)
+
+    def matches(self, parameters: Parameters) -> bool:
+        "whether the key pairs of the pool suit clients with the given parameters"
+        return (parameters.poly_modulus_degree, parameters.plain_modulus) == (self.parameters.poly_modulus_degree, self.parameters.plain_modulus)
+
+    @property
+    def stats(self) -> ContextPoolStats:
+        with self._lock:
+            return ContextPoolStats(self._hits, self._misses, self._generated, self._generation_seconds, len(self._ready))
+
+    def _generate(self, background: bool) -> ClientContexts:
+        with self.instrumentation.stage("client.keygen", background=background):
+            start = time.perf_counter()
+            contexts = generate_contexts(self.parameters)
+            seconds = time.perf_counter() - start
+        with self._lock:
+            self._generated += 1
+            self._generation_seconds += seconds
+        return contexts
+
+    def _refill(self) -> None:
+        "start generating key pairs until the ready and pending ones make up the size of the pool"
+        with self._lock:
+            if self._closed:
+                return
+            futures = [self._executor.submit(self._generate, True) for _ in range(self.size - len(self._ready) - self._pending)]
+            self._pending += len(futures)
+        # Outside the lock, as the callback runs straight away for a future which is already done
+        for future in futures:
+            future.add_done_callback(self._add)
+
+    def _add(self, future: "Future[ClientContexts]") -> None:
+        with self._lock:
+            self._pending -= 1
+            if not future.cancelled() and future.exception() is None and not self._closed:
+                self._ready.append(future.result())
+
+    def get(self) -> ClientContexts:
+        """
+        :return: a key pair which has not been handed out before, generated on the spot if none are ready
+        """
+        with self._lock:
+            contexts = self._ready.popleft() if self._ready else None
+            if contexts is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+        if contexts is None:
+            contexts = self._generate(False)
+        self._refill()
+        return contexts
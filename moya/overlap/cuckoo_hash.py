@@ -1,8 +1,12 @@
 import math
+import typing as t
 from random import randint
 
 import mmh3
+import numpy as np
+import numpy.typing as npt
 
+from .hashing import locations
 from .parameters import Parameters
 from .types import IntMatrix
 
@@ -20,10 +24,16 @@ def rand_point(bound: int, i: int) -> int:
 
 
 class Cuckoo:
+    """
+    Cuckoo hash table with one item per bin. For each bin, item_index holds the index of the item in it (in the order
+    that items were inserted), or -1 if it is empty, and hash_index which of the hashes put it there.
+    """
+
     def __init__(self, parameters: Parameters) -> None:
         self.number_of_bins = 2**parameters.output_bits
         self.recursion_depth = int(8 * math.log(self.number_of_bins) / math.log(2))
-        self.data_structure: list[int | None] = [None for j in range(self.number_of_bins)]
+        self.item_index = np.full(self.number_of_bins, -1, dtype=np.int64)
+        self.hash_index = np.zeros(self.number_of_bins, dtype=np.int64)
         self.insert_index = randint(0, parameters.number_of_hashes - 1)  # nosec
         self.depth = 0
 
@@ -31,6 +41,10 @@ class Cuckoo:
         self.hash_seed = parameters.hash_seeds
         self.mask_of_power_of_2 = 2**parameters.output_bits - 1
 
+        # The inserted items, and the location of each of them for each hash
+        self.items = np.zeros(0, dtype=np.uint64)
+        self.item_locations = np.zeros((0, parameters.number_of_hashes), dtype=np.int64)
+
     def location(self, seed: int, item: int) -> int:
         """
         :param seed: a seed of a Murmur hash function
@@ -70,22 +84,55 @@ class Cuckoo:
         return int((item_left << self.parameters.output_bits) + item_right)
 
     def insert(self, item: int) -> None:
-        current_location = self.location(self.hash_seed[self.insert_index], item)
-        current_item = self.data_structure[current_location]
-        self.data_structure[current_location] = self.left_and_index(item, self.insert_index)
-
-        if current_item is None:
-            self.insert_index = randint(0, self.parameters.number_of_hashes - 1)  # nosec
-            self.depth = 0
-        else:
-            unwanted_index = self.extract_index(current_item)
-            self.insert_index = rand_point(self.parameters.number_of_hashes, unwanted_index)
-            if self.depth < self.recursion_depth:
-                self.depth += 1
-                jumping_item = self.reconstruct_item(current_item, current_location, self.hash_seed[unwanted_index])
-                self.insert(jumping_item)
-            else:
-                raise Exception("Cuckoo hashing aborted")
+        self.insert_all(np.array([item], dtype=np.uint64))
+
+    def insert_all(self, items: npt.NDArray[np.uint64] | list[int]) -> None:
+        """
+        Insert each of the items in turn. The locations of every item for every hash are computed up front, so that
+        moving items around only needs lookups.
+        """
+        items = np.asarray(items, dtype=np.uint64)
+        start = len(self.items)
+        self.items = np.concatenate([self.items, items])
+        self.item_locations = np.concatenate(
+            [self.item_locations, np.stack([locations(items, seed, self.parameters.output_bits) for seed in self.hash_seed], axis=1)]
+        )
+        item_locations = self.item_locations.tolist()
+
+        for index in range(start, len(self.items)):
+            while True:
+                current_location = item_locations[index][self.insert_index]
+                current_index = int(self.item_index[current_location])
+                unwanted_index = int(self.hash_index[current_location])
+                self.item_index[current_location] = index
+                self.hash_index[current_location] = self.insert_index
+
+                if current_index < 0:
+                    self.insert_index = randint(0, self.parameters.number_of_hashes - 1)  # nosec
+                    self.depth = 0
+                    break
+
+                self.insert_index = rand_point(self.parameters.number_of_hashes, unwanted_index)
+                if self.depth < self.recursion_depth:
+                    self.depth += 1
+                    # The item which was kicked out now jumps to another location
+                    index = current_index
+                else:
+                    raise Exception("Cuckoo hashing aborted")
+
+    @property
+    def occupied(self) -> npt.NDArray[np.bool_]:
+        "whether each bin holds an item"
+        return self.item_index >= 0
+
+    @property
+    def data_structure(self) -> npt.NDArray[np.uint64]:
+        "item_left || index of the item in each bin, or 0 for empty bins"
+        if not len(self.items):
+            return np.zeros(self.number_of_bins, dtype=np.uint64)
+        items = self.items[np.maximum(self.item_index, 0)]
+        values = ((items >> np.uint64(self.parameters.output_bits)) << np.uint64(self.parameters.log_no_hashes)) + self.hash_index.astype(np.uint64)
+        return np.where(self.occupied, values, np.uint64(0))
 
     def windowing(self, y: int, bound: int, modulus: int) -> IntMatrix:
         """
@@ -102,12 +149,36 @@ class Cuckoo:
                     windowed_y[i][j] = pow(y, (i + 1) * self.parameters.base**j, modulus)
         return windowed_y
 
-    def process_window_items(self) -> list[IntMatrix]:
-        # We pad the Cuckoo vector with dummy messages
+    def padded_items(self) -> npt.NDArray[np.uint64]:
+        "data_structure, with the empty bins padded with a dummy message"
         dummy_msg_client = 2 ** (self.parameters.sigma_max - self.parameters.output_bits + self.parameters.log_no_hashes)
+        return np.where(self.occupied, self.data_structure, np.uint64(dummy_msg_client))
 
-        # We apply the windowing procedure for each item from the Cuckoo structure
-        return [
-            self.windowing(dummy_msg_client if ch is None else ch, self.parameters.minibin_capacity, self.parameters.plain_modulus)
-            for ch in self.data_structure
-        ]
+    def window_array(self) -> npt.NDArray[np.int64]:
+        """
+        Vectorized windowing() of every bin at once
+
+        :return: a (base - 1, logB_ell, number_of_bins) array where entry (i, j, k) is y ** (i+1)*base ** j mod
+            plain_modulus for the item y in bin k, as long as the exponent of y is smaller than minibin_capacity
+        """
+        modulus = self.parameters.plain_modulus
+        assert modulus < 2**31, "products of two reduced values must fit in an int64"
+        windowed = np.zeros((self.parameters.base - 1, self.parameters.logB_ell, self.number_of_bins), dtype=np.int64)
+
+        # y ** base ** j, by squaring ell times for each j
+        y_base_j = (self.padded_items() % np.uint64(modulus)).astype(np.int64)
+        for j in range(self.parameters.logB_ell):
+            if j:
+                for _ in range(self.parameters.ell):
+                    y_base_j = y_base_j * y_base_j % modulus
+            power = y_base_j
+            for i in range(self.parameters.base - 1):
+                if (i + 1) * self.parameters.base**j - 1 < self.parameters.minibin_capacity:
+                    windowed[i, j] = power
+                power = power * y_base_j % modulus
+        return windowed
+
+    def process_window_items(self) -> list[IntMatrix]:
+        # We pad the Cuckoo vector with dummy messages and apply the windowing procedure for each item from the Cuckoo
+        # structure
+        return t.cast(list[IntMatrix], self.window_array().transpose(2, 0, 1).tolist())
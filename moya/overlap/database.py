@@ -0,0 +1,201 @@
+"""
+On-disk format for the preprocessed server database.
+
+The file is laid out as:
+
+    magic (8 bytes) | version (uint32) | header length (uint32) | JSON header | padding | coefficient matrix
+
+The JSON header holds the Parameters the database was generated with, the shape of the transposed coefficient matrix
+and a CRC32 checksum of it. The matrix itself is stored as little-endian uint32 (plain_modulus is below 2 ** 32),
+aligned so that it can be memory-mapped directly. Processes mapping the same file share its pages.
+"""
+
+import json
+import os
+import struct
+import typing as t
+import zlib
+
+import numpy as np
+import numpy.typing as npt
+
+from .parameters import Parameters
+from .types import CoeffMatrix
+
+MAGIC = b"MOYAPSI\0"
+FORMAT_VERSION = 1
+DTYPE = np.dtype("<u4")
+
+# Alignment of the start of the coefficient matrix in the file
+ALIGNMENT = 4096
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+class DatabaseFormatError(ValueError):
+    "The file is not a valid database, or was written by an unsupported version"
+
+
+class DatabaseUpdate(t.NamedTuple):
+    """
+    New coefficients for the minibins changed by Server.add() or Server.remove(). In the transposed coefficient matrix,
+    minibin j of bin b is the range of rows j * (minibin_capacity + 1) to (j + 1) * (minibin_capacity + 1) of column b.
+    """
+
+    # Bin and minibin index of each changed minibin
+    bins: npt.NDArray[np.int64]
+    minibins: npt.NDArray[np.int64]
+
+    # (len(bins), minibin_capacity + 1) array with the new coefficients of each changed minibin
+    coefficients: npt.NDArray[np.uint32]
+
+    @property
+    def row_ranges(self) -> list[tuple[int, slice]]:
+        "column and range of rows of the transposed coefficient matrix which changed, for each changed minibin"
+        width = self.coefficients.shape[1]
+        return [(int(b), slice(int(j) * width, (int(j) + 1) * width)) for b, j in zip(self.bins, self.minibins)]
+
+    def apply(self, transposed_poly_coeffs: npt.NDArray[np.uint32]) -> None:
+        "patch a transposed coefficient matrix (for example one mapped with mode='r+') in place"
+        width = self.coefficients.shape[1]
+        rows = self.minibins[:, np.newaxis] * width + np.arange(width)
+        transposed_poly_coeffs[rows, self.bins[:, np.newaxis]] = self.coefficients
+
+
+def checksum(matrix: npt.NDArray[np.uint32]) -> int:
+    "CRC32 of the coefficient matrix, computed in chunks so that memory-mapped files do not need to be read in one go"
+    crc = 0
+    for row in range(0, matrix.shape[0], 64):
+        crc = zlib.crc32(np.ascontiguousarray(matrix[row : row + 64]).data, crc)
+    return crc
+
+
+def _header(parameters: Parameters, matrix: npt.NDArray[np.uint32]) -> bytes:
+    return json.dumps(
+        {
+            "parameters": parameters.model_dump(),
+            "shape": list(matrix.shape),
+            "checksum": checksum(matrix),
+        }
+    ).encode()
+
+
+def _data_offset(header_length: int) -> int:
+    return -(-(_PREAMBLE.size + header_length) // ALIGNMENT) * ALIGNMENT
+
+
+def save_database(path: str | os.PathLike[str], parameters: Parameters, transposed_poly_coeffs: CoeffMatrix) -> None:
+    """
+    Write the transposed coefficient matrix and the parameters it was generated with to path. The file is written
+    under a temporary name and then moved into place so that readers never see a partial file.
+    """
+    matrix = np.asarray(transposed_poly_coeffs, dtype=DTYPE)
+    if matrix.ndim != 2:
+        raise ValueError("Coefficient matrix must be 2-dimensional")
+
+    header = _header(parameters, matrix)
+    data_offset = _data_offset(len(header))
+
+    tmp_path = f"{os.fspath(path)}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * (data_offset - _PREAMBLE.size - len(header)))
+        f.write(np.ascontiguousarray(matrix).data)
+    os.replace(tmp_path, path)
+
+
+class DatabaseWriter:
+    """
+    Database file written a part at a time through a memory-mapped matrix, for databases too large to build in memory.
+    The file is written under a temporary name, and commit() checksums it and moves it into place. A writer created
+    again for the same path and shape carries on with the temporary file left by an earlier one, so that writing can
+    resume after a crash.
+    """
+
+    def __init__(self, path: str | os.PathLike[str], parameters: Parameters, shape: tuple[int, int]):
+        self.path = path
+        self.tmp_path = f"{os.fspath(path)}.tmp"
+        self.parameters = parameters
+
+        # The header is written with the longest checksum, and padded to the same length once the real one is known
+        header = json.dumps({"parameters": parameters.model_dump(), "shape": list(shape), "checksum": 2**32 - 1}).encode()
+        try:
+            existing, _ = read_header(self.tmp_path)
+            resume = existing["parameters"] == parameters.model_dump() and existing["shape"] == list(shape)
+        except (OSError, ValueError):
+            resume = False
+        # Whether the contents of an earlier temporary file were kept, otherwise the matrix starts out as zeros
+        self.resumed = resume
+        if not resume:
+            with open(self.tmp_path, "wb") as f:
+                f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+                f.write(header)
+                f.truncate(_data_offset(len(header)) + shape[0] * shape[1] * DTYPE.itemsize)
+        self.header_length = len(header)
+        self.matrix: npt.NDArray[np.uint32] = np.memmap(self.tmp_path, dtype=DTYPE, mode="r+", offset=_data_offset(len(header)), shape=shape)
+
+    def flush(self) -> None:
+        "write what has been set in the matrix so far to disk"
+        t.cast(np.memmap[t.Any, t.Any], self.matrix).flush()
+
+    def commit(self) -> None:
+        "finish the file and move it into place"
+        self.flush()
+        header = _header(self.parameters, self.matrix)
+        with open(self.tmp_path, "r+b") as f:
+            f.seek(_PREAMBLE.size)
+            f.write(header.ljust(self.header_length))
+        del self.matrix
+        os.replace(self.tmp_path, self.path)
+
+
+def read_header(path: str | os.PathLike[str]) -> tuple[dict[str, t.Any], int]:
+    """
+    :return: the JSON header of the database file and the offset of the coefficient matrix in it
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) != _PREAMBLE.size:
+            raise DatabaseFormatError("File too short")
+        magic, version, header_length = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise DatabaseFormatError("Not a database file")
+        if version != FORMAT_VERSION:
+            raise DatabaseFormatError(f"Unsupported database version {version}")
+        header = t.cast(dict[str, t.Any], json.loads(f.read(header_length)))
+    return header, _data_offset(header_length)
+
+
+def load_database(path: str | os.PathLike[str], verify: bool = True, mode: t.Literal["r", "r+"] = "r") -> tuple[Parameters, npt.NDArray[np.uint32]]:
+    """
+    Memory-map a database file written by save_database().
+
+    :param verify: check the coefficient matrix against the stored checksum. This reads the whole file.
+    :param mode: "r" to map read-only, "r+" to allow patching the file in place
+    :return: the parameters the database was generated with, and the transposed coefficient matrix
+    """
+    header, data_offset = read_header(path)
+    rows, cols = header["shape"]
+    matrix: npt.NDArray[np.uint32] = np.memmap(path, dtype=DTYPE, mode=mode, offset=data_offset, shape=(rows, cols))
+    if verify and checksum(matrix) != header["checksum"]:
+        raise DatabaseFormatError("Database checksum mismatch")
+    return Parameters.model_validate(header["parameters"]), matrix
+
+
+def patch_database(path: str | os.PathLike[str], update: DatabaseUpdate) -> None:
+    """
+    Apply an update to a database file in place and refresh its checksum. Processes which have the file mapped see the
+    new coefficients straight away.
+    """
+    parameters, matrix = load_database(path, verify=False, mode="r+")
+    update.apply(matrix)
+    t.cast(np.memmap[t.Any, t.Any], matrix).flush()
+
+    _, data_offset = read_header(path)
+    header = _header(parameters, matrix)
+    if _data_offset(len(header)) != data_offset:
+        raise DatabaseFormatError("Updated header does not fit in the file")
+    with open(path, "r+b") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
@@ -0,0 +1,86 @@
+import typing as t
+
+import numpy as np
+import numpy.typing as npt
+
+_POWERS_OF_10 = [10**i for i in range(20)]
+
+# _ASCII[t][n] is the t digit zero-padded decimal string of n, as a little-endian 32-bit integer
+_ASCII = [np.array([int.from_bytes(f"{n:0{t}d}".encode(), "little") if t else 0 for n in range(10**t)], dtype=np.uint32) for t in range(5)]
+
+
+def _rotl32(x: npt.NDArray[np.uint32], r: int) -> npt.NDArray[np.uint32]:
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def _scramble(k1: npt.NDArray[np.uint32]) -> npt.NDArray[np.uint32]:
+    return _rotl32(k1 * np.uint32(0xCC9E2D51), 15) * np.uint32(0x1B873593)
+
+
+def _murmur3_32_of_decimal_fixed_length(values: npt.NDArray[np.uint64], length: int, seed: int) -> npt.NDArray[np.uint32]:
+    """
+    :param values: an array of integers which all have length decimal digits
+    :return: MurmurHash3_x86_32 of the decimal representation of each value
+    """
+    # Small enough values can use the much quicker 32-bit division
+    v: npt.NDArray[np.unsignedinteger[t.Any]] = values.astype(np.uint32 if length < 10 else np.uint64)
+
+    def block(start: int) -> npt.NDArray[np.uint32]:
+        "the (up to) 4 characters from start, read as a little-endian 32-bit integer"
+        chars = min(4, length - start)
+        digits = (v // _POWERS_OF_10[length - start - chars]) % _POWERS_OF_10[chars]
+        return t.cast(npt.NDArray[np.uint32], _ASCII[chars][digits])
+
+    # Integer overflow wraps around, which is what the hash wants
+    with np.errstate(over="ignore"):
+        h = np.full(len(v), seed, dtype=np.uint32)
+        for start in range(0, length - 3, 4):
+            h = _rotl32(h ^ _scramble(block(start)), 13) * np.uint32(5) + np.uint32(0xE6546B64)
+        if length % 4:
+            h ^= _scramble(block(length - length % 4))
+
+        h ^= np.uint32(length)
+        h ^= h >> np.uint32(16)
+        h *= np.uint32(0x85EBCA6B)
+        h ^= h >> np.uint32(13)
+        h *= np.uint32(0xC2B2AE35)
+        h ^= h >> np.uint32(16)
+    return h
+
+
+def murmur3_32_of_decimal(values: npt.NDArray[np.uint64], seed: int) -> npt.NDArray[np.uint32]:
+    """
+    Vectorized mmh3.hash(str(value), seed, signed=False) for an array of non-negative integers
+
+    :param values: an array of integers
+    :param seed: a seed of a Murmur hash function
+    :return: an array with the unsigned 32-bit hash of the decimal representation of each value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    max_length = len(str(int(values.max()))) if len(values) else 1
+    lengths = np.ones(values.shape, dtype=np.int8)
+    for power in _POWERS_OF_10[1:max_length]:
+        lengths += values >= np.uint64(power)
+
+    # Strings of each length are hashed together
+    hashes = np.empty(values.shape, dtype=np.uint32)
+    for length in np.unique(lengths).tolist():
+        selected = lengths == length
+        hashes[selected] = _murmur3_32_of_decimal_fixed_length(values[selected], length, seed)
+    return hashes
+
+
+def locations(items: npt.NDArray[np.uint64], seed: int, output_bits: int) -> npt.NDArray[np.int64]:
+    """
+    Vectorized location() of the simple and Cuckoo hash tables
+
+    :param items: an array of integers
+    :param seed: a seed of a Murmur hash function
+    :param output_bits: number of bits of output of the hash functions
+    :return: Murmur_hash(item_left) xor item_right for each item, where item = item_left || item_right
+    """
+    items = np.asarray(items, dtype=np.uint64)
+    item_left = items >> np.uint64(output_bits)
+    item_right = (items & np.uint64(2**output_bits - 1)).astype(np.int64)
+    hash_item_left = (murmur3_32_of_decimal(item_left, seed) >> np.uint32(32 - output_bits)).astype(np.int64)
+    return hash_item_left ^ item_right
@@ -0,0 +1,135 @@
+"""
+Instrumentation of the stages of the protocol.
+
+Client and Server run each stage of the protocol, such as the OPRF, Cuckoo hashing, encryption or the evaluation of a
+query, inside Instrumentation.stage(). Stages report counts such as the number of items or ciphertexts and, where data
+is serialized anyway, its size in bytes. Stages run inside each other, for example client.encrypt runs inside
+client.prepare_query.
+
+The default instrumentation does nothing, and stages only do work for their attributes when Stage.enabled is set. To
+see where the time goes, pass either a CallbackInstrumentation, which calls a function with a StageRecord at the end of
+every stage, or an OpenTelemetryInstrumentation, which turns every stage into a span.
+"""
+
+import time
+import typing as t
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+AttributeValue = int | float | str | bool
+
+
+class Stage:
+    """
+    A running stage, to which attributes can be added as they become known
+    """
+
+    # Whether the attributes are kept, attributes which take work to compute are only worth it if so
+    enabled = False
+
+    def record(self, **attributes: AttributeValue) -> None:
+        "add attributes to the stage, such as item counts"
+
+
+class Instrumentation:
+    """
+    Base class for instrumentation, which also serves as the default that does nothing
+    """
+
+    def stage(self, name: str, **attributes: AttributeValue) -> t.ContextManager[Stage]:
+        """
+        :param name: name of the stage, prefixed by client. or server.
+        :param attributes: attributes known at the start of the stage
+        :return: a context manager to run the stage in
+        """
+        return _NULL_STAGE
+
+
+_NULL_STAGE = nullcontext(Stage())
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class StageRecord(t.NamedTuple):
+    """
+    A finished stage, as given to the callback of CallbackInstrumentation
+    """
+
+    name: str
+    # Name of the stage this one ran inside of, if any
+    parent: str | None
+    seconds: float
+    attributes: dict[str, AttributeValue]
+    # Set if the stage raised an exception
+    error: BaseException | None
+
+
+class _RecordingStage(Stage):
+    enabled = True
+
+    def __init__(self, attributes: dict[str, AttributeValue]):
+        self.attributes = attributes
+
+    def record(self, **attributes: AttributeValue) -> None:
+        self.attributes.update(attributes)
+
+
+class CallbackInstrumentation(Instrumentation):
+    """
+    Call a function with a StageRecord at the end of every stage, for example to log slow stages or feed metrics. The
+    function is called on whichever thread ran the stage, so it needs to be thread-safe.
+    """
+
+    def __init__(self, callback: t.Callable[[StageRecord], None]):
+        self.callback = callback
+        self._current: ContextVar[str | None] = ContextVar("current_stage", default=None)
+
+    @contextmanager
+    def stage(self, name: str, **attributes: AttributeValue) -> t.Iterator[Stage]:
+        stage = _RecordingStage(dict(attributes))
+        parent = self._current.get()
+        token = self._current.set(name)
+        error: BaseException | None = None
+        start = time.perf_counter()
+        try:
+            yield stage
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._current.reset(token)
+            self.callback(StageRecord(name, parent, seconds, stage.attributes, error))
+
+
+class _SpanStage(Stage):
+    enabled = True
+
+    def __init__(self, span: t.Any):
+        self.span = span
+
+    def record(self, **attributes: AttributeValue) -> None:
+        self.span.set_attributes(attributes)
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    """
+    Run every stage in an OpenTelemetry span, which records exceptions raised by the stage. This needs the
+    opentelemetry-api package.
+    """
+
+    def __init__(self, tracer: t.Any = None):
+        """
+        :param tracer: the tracer to start the spans with, by default the one named moya.overlap from the global tracer
+            provider
+        """
+        if tracer is None:
+            from opentelemetry import trace
+
+            tracer = trace.get_tracer("moya.overlap")
+        self.tracer = tracer
+
+    @contextmanager
+    def stage(self, name: str, **attributes: AttributeValue) -> t.Iterator[Stage]:
+        with self.tracer.start_as_current_span(name, attributes=attributes) as span:
+            yield _SpanStage(span)
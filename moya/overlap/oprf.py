@@ -1,11 +1,56 @@
+import multiprocessing
+import os
+import threading
+import typing as t
 from math import log2
-from multiprocessing import Pool
+from multiprocessing.pool import Pool
 
 from fastecdsa.curve import P192
 from fastecdsa.point import Point
 
+from .fixed_base import fixed_base_multiply
 from .parameters import Parameters
-from .types import OPRFPoint, OPRFPoints
+from .points import POINT_BYTES, compress_points, compressed_x, decompress_points
+from .types import CompressedPoints, OPRFPoint, OPRFPoints
+
+T = t.TypeVar("T")
+R = t.TypeVar("R")
+
+# The pool is started lazily, when TenSEAL and the thread pools of the caller may already be running threads. Forking
+# a process with threads can leave the child stuck on a lock one of them held, so the workers are started from a clean
+# server process where the platform allows it.
+POOL_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Workers for the process pool. These live at module level and only exchange plain integers so that neither the OPRF
+# object nor fastecdsa Points have to be pickled to the worker processes.
+
+
+def items_times_point_worker(job: tuple[list[int], int, int]) -> list[int]:
+    """
+    :param job: a vector of integers and the coordinates of a point P on the curve
+    :return: the first coordinate of item * P for each item
+    """
+    vector_of_items, x, y = job
+    return [Q[0] for Q in fixed_base_multiply(vector_of_items, x, y)]
+
+
+def key_times_points_worker(job: tuple[int, list[int], list[int]]) -> tuple[list[int], list[int]]:
+    """
+    :param job: an integer key and the coordinates of a vector of points P on the curve
+    :return: the coordinates of key * P for each point
+    """
+    key, xs, ys = job
+    vector_of_multiples = [key * Point(x, y, curve=P192) for x, y in zip(xs, ys)]
+    return [Q.x for Q in vector_of_multiples], [Q.y for Q in vector_of_multiples]
+
+
+def key_times_compressed_points_worker(job: tuple[int, CompressedPoints]) -> CompressedPoints:
+    """
+    :param job: an integer key and a vector of compressed points P on the curve
+    :return: the compressed points key * P for each point
+    """
+    key, data = job
+    return compress_points([(Q.x, Q.y) for Q in (key * Point(x, y, curve=P192) for x, y in decompress_points(data))])
 
 
 class OPRF:
@@ -17,12 +62,21 @@ class OPRF:
     generated from a secret key and input. PRF generates outputs that are computationally indistinguishable from random values
     to any party who does not possess the secret key regardless of knowing the functions inputs.
 
+    The elliptic curve work is spread over a pool of worker processes. The pool is either passed in, or started the first
+    time it is needed and kept until close() is called, so that it can be reused between calls.
     """
 
-    def __init__(self, parameters: Parameters):
-        self.mask = 2**parameters.sigma_max - 1
+    # Smallest amount of items to send to a worker process in one go. Each scalar multiplication takes around half a
+    # millisecond so below this the IPC overhead starts to be noticeable.
+    min_chunk_size = 64
 
-        self.number_of_processes = 4
+    def __init__(self, parameters: Parameters, processes: int | None = None, pool: Pool | None = None):
+        self.mask: int = 2**parameters.sigma_max - 1
+
+        self.number_of_processes = processes if processes is not None else (os.cpu_count() or 1)
+        self._pool = pool
+        self._owns_pool = pool is None
+        self._pool_lock = threading.Lock()
 
         # Curve parameters
         self.curve_used = P192
@@ -32,10 +86,48 @@ class OPRF:
         self.G = Point(self.curve_used.gx, self.curve_used.gy, curve=self.curve_used)  # generator of the curve_used
         self.parameters = parameters
 
-    def server_offline_worker(self, vector_of_items_and_point: tuple[list[int], Point]) -> list[int]:
-        vector_of_items, point = vector_of_items_and_point
-        vector_of_multiples = [item * point for item in vector_of_items]
-        return [(Q.x >> self.log_p - self.parameters.sigma_max - 10) & self.mask for Q in vector_of_multiples]
+    def __enter__(self) -> "OPRF":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    @property
+    def pool(self) -> Pool:
+        "The worker pool, started on first use"
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = POOL_CONTEXT.Pool(self.number_of_processes)
+            return self._pool
+
+    def close(self) -> None:
+        """
+        Shut down the worker pool if it is owned by this object. It will be restarted if the OPRF is used again.
+        """
+        if self._pool is not None and self._owns_pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def chunks(self, length: int) -> list[slice]:
+        """
+        :param length: the number of items to process
+        :return: slices splitting the items into a few chunks per worker process, to balance the load between them
+        """
+        chunk_size = max(self.min_chunk_size, -(-length // (4 * self.number_of_processes)))
+        return [slice(i, i + chunk_size) for i in range(0, length, chunk_size)]
+
+    def map(self, worker: t.Callable[[T], R], jobs: list[T]) -> list[R]:
+        """
+        Run the jobs on the worker pool, or inline if there is not enough work to be worth sending to other processes
+        """
+        if len(jobs) <= 1 or self.number_of_processes <= 1:
+            return [worker(job) for job in jobs]
+        return self.pool.map(worker, jobs, chunksize=1)
+
+    def truncate(self, x: int) -> int:
+        "a sigma_max bits integer from the first coordinate of a point"
+        return (x >> self.log_p - self.parameters.sigma_max - 10) & self.mask
 
     def server_offline(self, vector_of_items: list[int], point: Point) -> list[int]:
         """
@@ -43,21 +135,9 @@ class OPRF:
         :param point: a point on elliptic curve (it will be key * G)
         :return: a sigma_max bits integer from the first coordinate of item * point (this will be the same as item * key * G)
         """
-        division = int(len(vector_of_items) / self.number_of_processes)
-        inputs = [vector_of_items[i * division : (i + 1) * division] for i in range(self.number_of_processes)]
-        if len(vector_of_items) % self.number_of_processes != 0:
-            inputs.append(
-                vector_of_items[self.number_of_processes * division : self.number_of_processes * division + (len(vector_of_items) % self.number_of_processes)]
-            )
-        inputs_and_point = [(input_vec, point) for input_vec in inputs]
-        with Pool(self.number_of_processes) as p:
-            outputs = p.map(self.server_offline_worker, inputs_and_point)
-        return [f for p in outputs for f in p]
-
-    def server_online_worker(self, keyed_vector_of_points: tuple[int, list[Point]]) -> OPRFPoints:
-        key, vector_of_points = keyed_vector_of_points
-        vector_of_multiples = [key * PP for PP in vector_of_points]
-        return [(Q.x, Q.y) for Q in vector_of_multiples]
+        jobs = [(vector_of_items[chunk], point.x, point.y) for chunk in self.chunks(len(vector_of_items))]
+        outputs = self.map(items_times_point_worker, jobs)
+        return [self.truncate(x) for xs in outputs for x in xs]
 
     def server_online(self, key: int, vector_of_pairs: OPRFPoints) -> OPRFPoints:
         """
@@ -65,18 +145,9 @@ class OPRF:
         :param vector_of_pairs: vector of coordinates of some points P on the elliptic curve
         :return: vector of coordinates of points key * P on the elliptic curve
         """
-        vector_of_points = [Point(P[0], P[1], curve=self.curve_used) for P in vector_of_pairs]
-        division = int(len(vector_of_points) / self.number_of_processes)
-        inputs = [vector_of_points[i * division : (i + 1) * division] for i in range(self.number_of_processes)]
-        if len(vector_of_points) % self.number_of_processes != 0:
-            inputs.append(
-                vector_of_points[self.number_of_processes * division : self.number_of_processes * division + (len(vector_of_points) % self.number_of_processes)]
-            )
-        keyed_inputs = [(key, _) for _ in inputs]
-        with Pool(self.number_of_processes) as p:
-            outputs = p.map(self.server_online_worker, keyed_inputs)
-
-        return [f for p in outputs for f in p]
+        jobs = [(key, [P[0] for P in vector_of_pairs[chunk]], [P[1] for P in vector_of_pairs[chunk]]) for chunk in self.chunks(len(vector_of_pairs))]
+        outputs = self.map(key_times_points_worker, jobs)
+        return [Q for xs, ys in outputs for Q in zip(xs, ys)]
 
     def client_offline(self, item: int, point: Point) -> OPRFPoint:
         """
@@ -87,20 +158,35 @@ class OPRF:
         P = item * point
         return (P.x, P.y)
 
-    def client_online_worker(self, keyed_vector_of_pairs: tuple[int, OPRFPoints]) -> list[int]:
-        key_inverse, vector_of_pairs = keyed_vector_of_pairs
-        vector_of_points = [Point(pair[0], pair[1], curve=self.curve_used) for pair in vector_of_pairs]
-        vector_key_inverse_points = [key_inverse * PP for PP in vector_of_points]
-        return [(Q.x >> self.log_p - self.parameters.sigma_max - 10) & self.mask for Q in vector_key_inverse_points]
+    def client_offline_batch(self, vector_of_items: list[int], point: Point) -> OPRFPoints:
+        """
+        Same as client_offline() for each item, sharing a table of multiples of the point between them
+        """
+        return fixed_base_multiply(vector_of_items, point.x, point.y)
 
     def client_online(self, key_inverse: int, vector_of_pairs: OPRFPoints) -> list[int]:
-        division = int(len(vector_of_pairs) / self.number_of_processes)
-        inputs = [vector_of_pairs[i * division : (i + 1) * division] for i in range(self.number_of_processes)]
-        if len(vector_of_pairs) % self.number_of_processes != 0:
-            inputs.append(
-                vector_of_pairs[self.number_of_processes * division : self.number_of_processes * division + (len(vector_of_pairs) % self.number_of_processes)]
-            )
-        keyed_inputs = [(key_inverse, _) for _ in inputs]
-        with Pool(self.number_of_processes) as p:
-            outputs = p.map(self.client_online_worker, keyed_inputs)
-        return [f for p in outputs for f in p]
+        """
+        :param key_inverse: the inverse of the client key
+        :param vector_of_pairs: vector of coordinates of points returned by the server
+        :return: a sigma_max bits integer from the first coordinate of key_inverse * P for each point
+        """
+        jobs = [(key_inverse, [P[0] for P in vector_of_pairs[chunk]], [P[1] for P in vector_of_pairs[chunk]]) for chunk in self.chunks(len(vector_of_pairs))]
+        outputs = self.map(key_times_points_worker, jobs)
+        return [self.truncate(x) for xs, _ in outputs for x in xs]
+
+    def compressed_jobs(self, key: int, data: CompressedPoints) -> list[tuple[int, CompressedPoints]]:
+        "split compressed points into chunks, which are decompressed by the worker processes"
+        return [(key, data[chunk.start * POINT_BYTES : chunk.stop * POINT_BYTES]) for chunk in self.chunks(len(data) // POINT_BYTES)]
+
+    def server_online_compressed(self, key: int, data: CompressedPoints) -> CompressedPoints:
+        """
+        Same as server_online(), with the points in and out compressed
+        """
+        return b"".join(self.map(key_times_compressed_points_worker, self.compressed_jobs(key, data)))
+
+    def client_online_compressed(self, key_inverse: int, data: CompressedPoints) -> list[int]:
+        """
+        Same as client_online(), for compressed points returned by the server
+        """
+        outputs = self.map(key_times_compressed_points_worker, self.compressed_jobs(key_inverse, data))
+        return [self.truncate(x) for output in outputs for x in compressed_x(output)]
@@ -4,6 +4,9 @@ from math import log2
 
 from pydantic import BaseModel
 
+if t.TYPE_CHECKING:
+    from .planner import QueryCosts
+
 
 class Parameters(BaseModel):
     """
@@ -23,7 +26,7 @@ class Parameters(BaseModel):
     plain_modulus: int = 536903681
     poly_modulus_degree: int = 2**13
 
-    # TODO: server_size (ie number of items in server) needs to be known beforehand...?
+    # Depends on the server size, for_sizes() works it out
     # B = [68, 176, 536, 1832, 6727] for log(server_size) = [16, 18, 20, 22, 24]
     bin_capacity: int = 536
 
@@ -33,6 +36,29 @@ class Parameters(BaseModel):
     # windowing parameter
     ell: int = 2
 
+    @classmethod
+    def for_sizes(cls, server_size: int, client_size: int, **kwargs: t.Any) -> "Parameters":
+        """
+        Pick the parameters with the lowest predicted query latency for the given set sizes, keeping the chance of
+        the simple hashing of the server set aborting below a target. See planner.plan() for the options, and
+        predicted_costs() for what to expect of the result.
+
+        :param server_size: number of items in the server set
+        :param client_size: number of items the clients are expected to query at once
+        """
+        from .planner import plan
+
+        return plan(server_size, client_size, **kwargs)[0]
+
+    def predicted_costs(self, server_size: int, client_size: int, **kwargs: t.Any) -> "QueryCosts":
+        """
+        Predict the latency, traffic and chance of failure of running a client set against a server set with these
+        parameters. See planner.query_costs() for the options.
+        """
+        from .planner import query_costs
+
+        return query_costs(self, server_size, client_size, **kwargs)
+
     @cached_property
     def number_of_hashes(self) -> int:
         "the number of hashes we use for simple/Cuckoo hashing"
@@ -58,3 +84,9 @@ class Parameters(BaseModel):
     @cached_property
     def logB_ell(self) -> int:
         return int(log2(self.minibin_capacity) / self.ell) + 1  # <= 2 ** HE.depth
+
+    @cached_property
+    def max_client_size(self) -> int:
+        "largest number of client items to put in a single query, keeping the Cuckoo table load low enough to not abort"
+        # The reference implementation uses 5535 client items for 2 ** 13 bins
+        return int(2**self.output_bits / 1.48)
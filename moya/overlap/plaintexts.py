@@ -0,0 +1,183 @@
+"""
+Pre-encoded coefficient rows of the server database.
+
+Multiplying a BFVVector by a list makes TenSEAL batch-encode the list and transform it (and the ciphertext) into NTT
+form, for every row of every query, even though the rows of the database never change. PlaintextCache encodes each
+row once, in NTT form, so that a query only has to transform each encrypted power once and then multiply-accumulate.
+
+TenSEAL does not expose a plaintext type which can be combined with a BFVVector, so this works on the underlying SEAL
+objects through tenseal.sealapi. The plaintexts are bound to the encryption parameters derived from Parameters, which
+every client context created with the same Parameters shares, rather than to any one client context.
+"""
+
+import os
+import tempfile
+import threading
+import typing as t
+
+import numpy as np
+import tenseal.sealapi as sealapi
+from tenseal import BFVVector, bfv_vector_from
+
+from .database import DatabaseUpdate
+from .parameters import Parameters
+from .types import CoeffMatrix
+
+# Default bound on the memory taken by the encoded rows. A row of the default parameters takes 256KiB in NTT form.
+DEFAULT_MAX_BYTES = 2**28
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _serialize_ciphertext(ciphertext: t.Any) -> bytes:
+    """
+    SEAL objects can only be serialized to a path through the Python bindings. Where the platform has memfd_create()
+    that path is an in-memory file, otherwise it is a temporary file.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("ciphertext")
+        try:
+            ciphertext.save(f"/proc/self/fd/{fd}")
+            return os.pread(fd, os.fstat(fd).st_size, 0)
+        finally:
+            os.close(fd)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "ciphertext")
+        ciphertext.save(path)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def _ciphertext_to_vector(context: t.Any, ciphertext: t.Any, size: int) -> BFVVector:
+    """
+    Wrap a SEAL ciphertext as a BFVVector of the given number of slots, linked to the TenSEAL context
+    """
+    data = _serialize_ciphertext(ciphertext)
+
+    # BFVVectorProto of TenSEAL 0.3.15, which pyproject.toml pins: the packed sizes (field 1) and the serialized
+    # ciphertexts (field 2). TenSEAL has no public way to make a BFVVector from a SEAL ciphertext, test_server.py
+    # checks this gives the same bytes as TenSEAL's own serialization.
+    sizes = _varint(size)
+    proto = b"\x0a" + _varint(len(sizes)) + sizes + b"\x12" + _varint(len(data)) + data
+    return bfv_vector_from(context, proto)
+
+
+class PlaintextCache:
+    """
+    Coefficient rows of a transposed coefficient matrix, encoded as SEAL plaintexts. Rows are encoded the first time
+    they are needed (or all at once by fill()) and kept until the cache takes max_bytes. Rows past that are encoded
+    again on every use instead, so a database which does not fit still gets the benefit for the rows which do.
+
+    The cache belongs to one matrix. If that matrix is changed, for example by patch_database(), the changed rows need
+    to be dropped with invalidate(). Server.add() and Server.remove() do this for the cache of the server.
+    """
+
+    def __init__(self, parameters: Parameters, transposed_poly_coeffs: CoeffMatrix, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.parameters = parameters
+        self.matrix = transposed_poly_coeffs
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        encryption_parameters = sealapi.EncryptionParameters(sealapi.SCHEME_TYPE.BFV)
+        encryption_parameters.set_poly_modulus_degree(parameters.poly_modulus_degree)
+        encryption_parameters.set_coeff_modulus(sealapi.CoeffModulus.BFVDefault(parameters.poly_modulus_degree, sealapi.SEC_LEVEL_TYPE.TC128))
+        encryption_parameters.set_plain_modulus(parameters.plain_modulus)
+        self.context = sealapi.SEALContext(encryption_parameters, True, sealapi.SEC_LEVEL_TYPE.TC128)
+        self.parms_id = self.context.first_parms_id()
+        self.encoder = sealapi.BatchEncoder(self.context)
+        self.evaluator = sealapi.Evaluator(self.context)
+
+        self._plaintexts: dict[int, t.Any] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._plaintexts)
+
+    def _is_ntt_row(self, index: int) -> bool:
+        "the last row of each partition is added to the result rather than multiplied, so it is not kept in NTT form"
+        return index % (self.parameters.minibin_capacity + 1) != self.parameters.minibin_capacity
+
+    def encode(self, index: int) -> t.Any:
+        "encode a row of the matrix, without caching it"
+        row = self.matrix[index]
+        plaintext = sealapi.Plaintext()
+        self.encoder.encode(row.tolist() if isinstance(row, np.ndarray) else row, plaintext)
+        if self._is_ntt_row(index):
+            self.evaluator.transform_to_ntt_inplace(plaintext, self.parms_id)
+        return plaintext
+
+    def get(self, index: int) -> t.Any:
+        "the encoded row of the matrix, from the cache if possible"
+        plaintext = self._plaintexts.get(index)
+        if plaintext is not None:
+            return plaintext
+
+        plaintext = self.encode(index)
+        nbytes = plaintext.coeff_count() * 8
+        with self._lock:
+            if index not in self._plaintexts and self.nbytes + nbytes <= self.max_bytes:
+                self._plaintexts[index] = plaintext
+                self.nbytes += nbytes
+        return plaintext
+
+    def fill(self) -> None:
+        "encode the rows used by queries up front, up to the first one which does not fit in max_bytes"
+        width = self.parameters.minibin_capacity + 1
+        for i in range(self.parameters.alpha):
+            for j in range(1, width):
+                index = width * i + j
+                self.get(index)
+                if index not in self._plaintexts or self.nbytes >= self.max_bytes:
+                    return
+
+    def invalidate(self, update: DatabaseUpdate) -> None:
+        "drop the rows changed by an update applied to the matrix"
+        with self._lock:
+            for _, rows in update.row_ranges:
+                for index in range(rows.start, rows.stop):
+                    plaintext = self._plaintexts.pop(index, None)
+                    if plaintext is not None:
+                        self.nbytes -= plaintext.coeff_count() * 8
+
+    def supports(self, vector: BFVVector) -> bool:
+        "whether the vector was encrypted with the encryption parameters of the cache"
+        return bool(vector.ciphertext()[0].parms_id() == self.parms_id)
+
+    def to_ntt(self, vector: BFVVector) -> t.Any:
+        "the ciphertext of a vector, in NTT form ready to be multiplied by the cached rows"
+        ciphertext = vector.ciphertext()[0]
+        self.evaluator.transform_to_ntt_inplace(ciphertext)
+        return ciphertext
+
+    def partition_answer(self, ntt_powers: list[t.Any], highest_power: BFVVector, i: int) -> BFVVector:
+        """
+        Same as Server.partition_answer(), from the powers Enc(y^{minibin_capacity - 1}), ..., Enc(y) already in NTT
+        form and Enc(y^{minibin_capacity}) which the leading coefficients of 1 multiply
+        """
+        width = self.parameters.minibin_capacity + 1
+        product = sealapi.Ciphertext(self.context)
+        dot_product: t.Any = None
+        for j, power in enumerate(ntt_powers, start=1):
+            plaintext = self.get(width * i + j)
+            if plaintext.is_zero():
+                continue
+            if dot_product is None:
+                dot_product = sealapi.Ciphertext(self.context)
+                self.evaluator.multiply_plain(power, plaintext, dot_product)
+            else:
+                self.evaluator.multiply_plain(power, plaintext, product)
+                self.evaluator.add_inplace(dot_product, product)
+
+        result = highest_power.ciphertext()[0]
+        if dot_product is not None:
+            self.evaluator.transform_from_ntt_inplace(dot_product)
+            self.evaluator.add_inplace(result, dot_product)
+        self.evaluator.add_plain_inplace(result, self.get(width * i + width - 1))
+        return _ciphertext_to_vector(highest_power.context(), result, highest_power.size())
@@ -0,0 +1,225 @@
+"""
+Choice of the protocol parameters from the sizes of the server and client sets.
+
+The bin capacity follows from the server set size: every server item goes into number_of_hashes bins, and a bin which
+gets more than bin_capacity items makes the simple hashing abort. The capacity is the smallest for which the chance of
+that, bounded by the number of bins times the binomial tail of the load of one bin, is below a target. With the target
+of 2 ** -30 this gives back the capacities of the reference implementation: 68, 176, 536, 1832 and 6727 for 2 ** 16 to
+2 ** 24 items.
+
+Each bin is then split into alpha minibins of minibin_capacity items, and the query is windowed with base 2 ** ell.
+These trade off against each other:
+
+- the client encrypts and sends one ciphertext per power in the window, more of them with a larger ell
+- the server computes every power up to minibin_capacity which is not in the window, with a ciphertext multiplication
+  each, and fewer of them with a larger ell
+- the server multiplies each power by a plaintext row for each minibin, bin_capacity of them in total
+- the server sends back alpha ciphertexts, and the client decrypts them
+
+query_costs() predicts these from the single-core timings of each operation, and plan() picks the alpha and ell with the
+lowest predicted latency, counting the traffic at the given bandwidth. The timings were measured for 2 ** 13 slots and
+are scaled by the size of the ciphertexts for other sizes, so they are estimates rather than promises.
+"""
+
+import typing as t
+from math import ceil, exp, lgamma, log, log1p, log2
+
+from .parameters import Parameters
+from .plaintexts import DEFAULT_MAX_BYTES
+
+# Target chance of the simple hashing of the server set aborting
+DEFAULT_FAILURE_PROBABILITY = 2**-30
+
+# Bytes per second between the client and the server
+DEFAULT_BANDWIDTH = 2**23
+
+# Deepest chain of ciphertext multiplications when computing the powers, which the noise budget of the default
+# encryption parameters allows for
+DEFAULT_MAX_DEPTH = 2
+
+# Number of primes holding the data of a ciphertext, in the default coefficient modulus of each polynomial modulus degree
+_DATA_PRIMES = {4096: 2, 8192: 4, 16384: 8, 32768: 15}
+
+# Single-core timings in seconds, and sizes in bytes, of each operation for 2 ** 13 slots
+ENCRYPT_SECONDS = 0.0072
+DECRYPT_SECONDS = 0.0026
+MULTIPLY_SECONDS = 0.025
+# Multiplying a power by a row and adding it to the sum, with the row encoded for the query or taken from the
+# PlaintextCache
+PLAIN_MULTIPLY_SECONDS = 0.0044
+CACHED_PLAIN_MULTIPLY_SECONDS = 0.0017
+# Running the OPRF for an item, on both sides
+OPRF_SECONDS = 0.003
+CIPHERTEXT_BYTES = 432_000
+# A row of the database in NTT form in the PlaintextCache
+ROW_BYTES = 2**18
+
+
+class QueryCosts(t.NamedTuple):
+    """
+    Predicted costs of running a client set against a server set with some parameters
+    """
+
+    # Bound on the chance of the simple hashing of the server set aborting
+    failure_probability: float
+    # Queries needed to fit the client set
+    queries: int
+    # Ciphertexts sent and received by each query
+    query_ciphertexts: int
+    answer_ciphertexts: int
+    # Ciphertext and plaintext multiplications done by the server for each query
+    multiplications: int
+    plain_multiplications: int
+    # Multiplications in a row when computing the powers
+    depth: int
+    # Bytes sent and received by each query, not counting the public context
+    query_bytes: int
+    answer_bytes: int
+    # Totals over all the queries
+    client_seconds: float
+    server_seconds: float
+    network_seconds: float
+
+    @property
+    def seconds(self) -> float:
+        "predicted latency of the whole client set"
+        return self.client_seconds + self.server_seconds + self.network_seconds
+
+    @property
+    def bytes(self) -> int:
+        "predicted traffic of the whole client set"
+        return self.queries * (self.query_bytes + self.answer_bytes)
+
+
+def overflow_probability(server_size: int, number_of_bins: int, number_of_hashes: int, bin_capacity: int) -> float:
+    """
+    :return: a bound on the chance of any bin getting more than bin_capacity of the server items, each hashed into
+        number_of_hashes bins
+    """
+    trials = server_size * number_of_hashes
+    p = 1 / number_of_bins
+    if bin_capacity >= trials:
+        return 0.0
+    if bin_capacity < trials * p:
+        # Below the mean load, about half of the bins overflow
+        return 1.0
+    # Binomial tail P(load > bin_capacity) summed in log space, the terms fall quickly past the mean
+    log_terms = []
+    for k in range(bin_capacity + 1, trials + 1):
+        log_term = lgamma(trials + 1) - lgamma(k + 1) - lgamma(trials - k + 1) + k * log(p) + (trials - k) * log1p(-p)
+        log_terms.append(log_term)
+        if log_term < log_terms[0] - 50:
+            break
+    largest = max(log_terms)
+    tail = exp(largest) * sum(exp(term - largest) for term in log_terms)
+    return min(1.0, number_of_bins * tail)
+
+
+def required_bin_capacity(server_size: int, number_of_bins: int, number_of_hashes: int, failure_probability: float = DEFAULT_FAILURE_PROBABILITY) -> int:
+    """
+    :return: the smallest bin capacity for which the chance of the simple hashing aborting is below failure_probability
+    """
+    trials = server_size * number_of_hashes
+    # Start from the mean and double the step until the bound is met, then bisect
+    low, step = trials // number_of_bins, 1
+    while overflow_probability(server_size, number_of_bins, number_of_hashes, low + step) > failure_probability:
+        low, step = low + step, step * 2
+    high = low + step
+    while high - low > 1:
+        middle = (low + high) // 2
+        if overflow_probability(server_size, number_of_bins, number_of_hashes, middle) > failure_probability:
+            low = middle
+        else:
+            high = middle
+    return max(high, 1)
+
+
+def window_size(base: int, logB_ell: int, minibin_capacity: int) -> int:
+    "number of powers the client sends, as in power_plan()"
+    return sum(1 for i in range(base - 1) for j in range(logB_ell) if (i + 1) * base**j - 1 < minibin_capacity)
+
+
+def query_costs(
+    parameters: Parameters,
+    server_size: int,
+    client_size: int,
+    bandwidth: float = DEFAULT_BANDWIDTH,
+    plaintext_cache_bytes: int = DEFAULT_MAX_BYTES,
+) -> QueryCosts:
+    """
+    Predict the costs of running a client set against a server set
+
+    :param bandwidth: bytes per second between the client and the server
+    :param plaintext_cache_bytes: size of the PlaintextCache of the server, rows past it are encoded for every query
+    """
+    number_of_bins = 2**parameters.output_bits
+    minibin_capacity = parameters.minibin_capacity
+    scale = parameters.poly_modulus_degree * _DATA_PRIMES.get(parameters.poly_modulus_degree, 4) / (2**13 * _DATA_PRIMES[2**13])
+
+    queries = max(1, ceil(client_size / parameters.max_client_size))
+    query_ciphertexts = window_size(parameters.base, parameters.logB_ell, minibin_capacity)
+    multiplications = minibin_capacity - query_ciphertexts
+    rows = parameters.alpha * (minibin_capacity - 1)
+    cached_rows = min(rows, int(plaintext_cache_bytes / (ROW_BYTES * scale)))
+    query_bytes = int(query_ciphertexts * CIPHERTEXT_BYTES * scale)
+    answer_bytes = int(parameters.alpha * CIPHERTEXT_BYTES * scale)
+
+    client_seconds = client_size * OPRF_SECONDS + queries * scale * (query_ciphertexts * ENCRYPT_SECONDS + parameters.alpha * DECRYPT_SECONDS)
+    server_seconds = (
+        queries * scale * (multiplications * MULTIPLY_SECONDS + cached_rows * CACHED_PLAIN_MULTIPLY_SECONDS + (rows - cached_rows) * PLAIN_MULTIPLY_SECONDS)
+    )
+    return QueryCosts(
+        failure_probability=overflow_probability(server_size, number_of_bins, parameters.number_of_hashes, parameters.bin_capacity),
+        queries=queries,
+        query_ciphertexts=query_ciphertexts,
+        answer_ciphertexts=parameters.alpha,
+        multiplications=multiplications,
+        plain_multiplications=rows,
+        depth=ceil(log2(parameters.logB_ell)) if parameters.logB_ell > 1 else 0,
+        query_bytes=query_bytes,
+        answer_bytes=answer_bytes,
+        client_seconds=client_seconds,
+        server_seconds=server_seconds,
+        network_seconds=queries * (query_bytes + answer_bytes) / bandwidth,
+    )
+
+
+def plan(
+    server_size: int,
+    client_size: int,
+    poly_modulus_degree: int = 2**13,
+    failure_probability: float = DEFAULT_FAILURE_PROBABILITY,
+    bandwidth: float = DEFAULT_BANDWIDTH,
+    max_depth: int = DEFAULT_MAX_DEPTH,
+    plaintext_cache_bytes: int = DEFAULT_MAX_BYTES,
+) -> tuple[Parameters, QueryCosts]:
+    """
+    Pick the parameters with the lowest predicted latency for the given set sizes. See Parameters.for_sizes().
+
+    :return: the parameters and their predicted costs
+    """
+    # There is one bin per slot of the ciphertexts. Fewer bins would not make the ciphertexts any smaller and would
+    # only put more server items in each bin.
+    output_bits = int(log2(poly_modulus_degree))
+    if 2**output_bits != poly_modulus_degree:
+        raise ValueError("poly_modulus_degree must be a power of 2")
+    required = required_bin_capacity(server_size, 2**output_bits, Parameters().number_of_hashes, failure_probability)
+
+    best: tuple[Parameters, QueryCosts] | None = None
+    for alpha in range(1, required + 1):
+        # Every position of a bin needs to be part of a minibin
+        minibin_capacity = ceil(required / alpha)
+        if alpha > 1 and ceil(required / (alpha - 1)) == minibin_capacity:
+            # Same minibins as with fewer partitions, only with more answer ciphertexts
+            continue
+        for ell in range(1, max(1, minibin_capacity.bit_length()) + 1):
+            parameters = Parameters(
+                output_bits=output_bits, poly_modulus_degree=poly_modulus_degree, bin_capacity=alpha * minibin_capacity, alpha=alpha, ell=ell
+            )
+            if parameters.logB_ell > 2**max_depth:
+                continue
+            costs = query_costs(parameters, server_size, client_size, bandwidth, plaintext_cache_bytes)
+            if best is None or costs.seconds < best[1].seconds:
+                best = parameters, costs
+    assert best is not None
+    return best
@@ -0,0 +1,64 @@
+"""
+SEC1 compressed encoding of the P-192 points exchanged during the OPRF.
+
+A compressed point is a byte 0x02 or 0x03 giving the parity of its y coordinate, followed by its x coordinate as a 24
+byte big-endian integer. That is 25 bytes per point rather than 48 for both coordinates. Sets of points are sent as the
+concatenation of their compressed encodings, rather than as lists of tuples.
+"""
+
+from fastecdsa.curve import P192
+
+from .types import CompressedPoints, OPRFPoints
+
+COORDINATE_BYTES = 24
+POINT_BYTES = 1 + COORDINATE_BYTES
+
+_EVEN = 2
+_ODD = 3
+
+# With p = 3 mod 4, a square root of n is n ** ((p + 1) / 4) mod p
+assert P192.p % 4 == 3
+_SQRT_EXPONENT = (P192.p + 1) // 4
+
+
+def compress_points(points: OPRFPoints) -> CompressedPoints:
+    """
+    :param points: vector of coordinates of points on the curve
+    :return: the compressed encoding of every point, concatenated
+    """
+    return b"".join(bytes((_ODD if y & 1 else _EVEN,)) + x.to_bytes(COORDINATE_BYTES, "big") for x, y in points)
+
+
+def compressed_x(data: CompressedPoints) -> list[int]:
+    """
+    :param data: concatenated compressed points
+    :return: the first coordinate of every point, which does not need any decompression
+    """
+    return [int.from_bytes(data[i + 1 : i + POINT_BYTES], "big") for i in range(0, len(data), POINT_BYTES)]
+
+
+def decompress_points(data: CompressedPoints) -> OPRFPoints:
+    """
+    :param data: concatenated compressed points
+    :return: vector of coordinates of the points
+    """
+    if len(data) % POINT_BYTES:
+        raise ValueError("Truncated compressed point")
+
+    p, a, b = P192.p, P192.a, P192.b
+    points = []
+    for i in range(0, len(data), POINT_BYTES):
+        prefix = data[i]
+        x = int.from_bytes(data[i + 1 : i + POINT_BYTES], "big")
+        if prefix not in (_EVEN, _ODD) or x >= p:
+            raise ValueError("Invalid compressed point")
+
+        # y ** 2 = x ** 3 + a * x + b
+        y_squared = (x * x * x + a * x + b) % p
+        y = pow(y_squared, _SQRT_EXPONENT, p)
+        if y * y % p != y_squared:
+            raise ValueError("Compressed point is not on the curve")
+        if y & 1 != prefix & 1:
+            y = p - y
+        points.append((x, y))
+    return points
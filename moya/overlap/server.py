@@ -1,12 +1,22 @@
+import os
 import typing as t
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from math import ceil, log2
+from multiprocessing.pool import Pool
 
 import numpy as np
+import numpy.typing as npt
 from tenseal import BFVVector
 
+from .database import DatabaseUpdate, load_database, save_database
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
 from .oprf import OPRF, OPRFPoints
 from .parameters import Parameters
+from .plaintexts import DEFAULT_MAX_BYTES, PlaintextCache
+from .points import POINT_BYTES
 from .simple_hash import Simple_hash
-from .types import IntMatrix, RawNumbers, VectorMatrix
+from .types import CoeffMatrix, CompressedPoints, IntMatrix, RawNumbers, VectorMatrix
 
 
 def int2base(n: int, b: int) -> list[int]:
@@ -46,6 +56,70 @@ def low_depth_multiplication(vector: list[BFVVector]) -> BFVVector:
             return low_depth_multiplication(vec)
 
 
+class PowerPlan(t.NamedTuple):
+    """
+    How to compute all the powers y^1 ... y^{minibin_capacity} from the windowed powers sent by the client. Every
+    missing power takes a single multiplication of two powers computed at an earlier level.
+    """
+
+    # The powers sent by the client, with their (i, j) position in the window
+    window: dict[int, tuple[int, int]]
+
+    # Multiplications at each level as (exponent, a, b) for y^exponent = y^a * y^b. Those in the same level are
+    # independent of each other.
+    levels: list[list[tuple[int, int, int]]]
+
+    # Ciphertext multiplications needed when computing each power separately with power_reconstruct()
+    naive_multiplications: int
+
+    @property
+    def multiplications(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+    @property
+    def depth(self) -> int:
+        return len(self.levels)
+
+
+@lru_cache
+def power_plan(base: int, logB_ell: int, minibin_capacity: int) -> PowerPlan:
+    """
+    Build the plan computing all the powers with the fewest ciphertext multiplications, without going over the
+    multiplicative depth of power_reconstruct(): ceil(log2(logB_ell)), as a power has at most logB_ell base digits.
+    """
+    window = {}
+    for i in range(base - 1):
+        for j in range(logB_ell):
+            if (i + 1) * base**j - 1 < minibin_capacity:
+                window[(i + 1) * base**j] = (i, j)
+
+    naive_multiplications = 0
+    for exponent in range(1, minibin_capacity + 1):
+        if exponent not in window:
+            naive_multiplications += len([x for x in int2base(exponent, base) if x]) - 1
+
+    known = set(window)
+    levels: list[list[tuple[int, int, int]]] = []
+    for _ in range(ceil(log2(logB_ell)) if logB_ell > 1 else 0):
+        if len(known) == minibin_capacity:
+            break
+        level = []
+        for exponent in range(1, minibin_capacity + 1):
+            if exponent in known:
+                continue
+            # Pick the most balanced split, each power can be used for any number of others
+            for a in range(exponent // 2, 0, -1):
+                if a in known and exponent - a in known:
+                    level.append((exponent, exponent - a, a))
+                    break
+        known.update(exponent for exponent, _, _ in level)
+        levels.append(level)
+
+    if len(known) != minibin_capacity:
+        raise ValueError("Not all powers can be computed within the multiplicative depth")
+    return PowerPlan(window, levels, naive_multiplications)
+
+
 def coeffs_from_roots(roots: list[int], modulus: int) -> list[int]:
     """
     :param roots: an array of integers
@@ -58,51 +132,235 @@ def coeffs_from_roots(roots: list[int], modulus: int) -> list[int]:
     return t.cast(list[int], coefficients.tolist())
 
 
+def coeffs_from_roots_batched(roots: npt.NDArray[np.int64], modulus: int, workers: int | None = None) -> npt.NDArray[np.int64]:
+    """
+    Vectorized version of coeffs_from_roots() for many polynomials at once.
+
+    :param roots: an (n, d) array of integers, each row being the roots of one polynomial
+    :param modulus: an integer below 2 ** 31, so that products of two reduced values fit in an int64
+    :param workers: number of threads to spread the rows over, defaults to the number of CPUs
+    :return: an (n, d + 1) array with the coefficients of each polynomial modulo modulus, highest degree first
+    """
+    assert modulus < 2**31
+    n, degree = roots.shape
+    roots = roots % modulus
+    coefficients = np.zeros((n, degree + 1), dtype=np.int64)
+    coefficients[:, 0] = 1
+
+    def multiply_out(rows: slice) -> None:
+        c = coefficients[rows]
+        for k in range(degree):
+            # Multiply by (x - r): the coefficient of each power gets -r times the coefficient of the power above it
+            c[:, 1 : k + 2] = (c[:, 1 : k + 2] - roots[rows, k : k + 1] * c[:, : k + 1]) % modulus
+
+    # Numpy releases the GIL during the arithmetic, so blocks of rows can be processed in parallel on threads
+    block = 4096
+    blocks = [slice(i, i + block) for i in range(0, n, block)]
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        list(executor.map(multiply_out, blocks))
+    return coefficients
+
+
+def coeff_row(transposed_poly_coeffs: CoeffMatrix, index: int) -> list[int]:
+    """
+    :return: a row of the transposed coefficient matrix as a list, which is what TenSEAL takes as a plaintext
+    """
+    row = transposed_poly_coeffs[index]
+    return t.cast(list[int], row.tolist() if isinstance(row, np.ndarray) else row)
+
+
 class Server:
-    def __init__(self, parameters: Parameters, oprf_server_key: int):
+    def __init__(
+        self,
+        parameters: Parameters,
+        oprf_server_key: int,
+        pool: Pool | None = None,
+        query_executor: Executor | None = None,
+        plaintext_cache_bytes: int = DEFAULT_MAX_BYTES,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """
+        Create a server with the given parameters and OPRF key.
+
+        Optionally, a process pool can be provided for the OPRF work, otherwise one is started on first use and kept
+        until close() is called.
+
+        Optionally, a thread pool can be provided to evaluate the alpha partitions of each query in parallel, otherwise
+        they are evaluated one after the other. The results are the same either way.
+
+        The coefficient rows of a database passed to cache_plaintexts() (or loaded with load_database(cache=True)) are
+        encoded once and kept, up to plaintext_cache_bytes, rather than encoded again for every query.
+
+        Optionally, an Instrumentation can be provided to time each stage of the preprocessing, OPRF and queries, which
+        otherwise costs nothing.
+        """
         self.parameters = parameters
-        self._oprf = OPRF(self.parameters)
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.query_executor = query_executor
+        self._oprf = OPRF(self.parameters, pool=pool)
         self.key = oprf_server_key
 
         # key * generator of elliptic curve
         self.server_point_precomputed = (self.key % self._oprf.order_of_generator) * self._oprf.G
 
-    def preprocess(self, server_set: RawNumbers) -> IntMatrix:
+        # Simple hashing state from the last preprocess(), kept so that the database can be updated incrementally
+        self.simple_hash: Simple_hash | None = None
+
+        self.plaintext_cache_bytes = plaintext_cache_bytes
+        self.plaintext_cache: PlaintextCache | None = None
+
+    def close(self) -> None:
+        "Release the OPRF worker pool"
+        self._oprf.close()
+
+    def preprocess_array(self, server_set: RawNumbers, workers: int | None = None) -> npt.NDArray[np.uint32]:
         """
-        Run beforehand to generate the large server set of values
+        Run beforehand to generate the large server set of values, returned as a (number_of_bins, alpha *
+        (minibin_capacity + 1)) array.
         """
-        PRFed_server_set = set(self._oprf.server_offline(server_set, self.server_point_precomputed))
+        with self.instrumentation.stage("server.preprocess", items=len(server_set)):
+            return self.database_from_oprf(self.oprf_offline(server_set), workers)
 
-        number_of_bins = 2**self.parameters.output_bits
+    def oprf_offline(self, server_set: RawNumbers) -> list[int]:
+        """
+        First half of preprocess_array(): the OPRF outputs of the server set, which are what go into the database
+        """
+        with self.instrumentation.stage("server.oprf_offline", items=len(server_set)):
+            return self._oprf.server_offline(server_set, self.server_point_precomputed)
+
+    def database_from_oprf(self, PRFed_server_set: t.Iterable[int], workers: int | None = None) -> npt.NDArray[np.uint32]:
+        """
+        Second half of preprocess_array(), from the OPRF outputs of the server set
+        """
+        PRFed_server_set = set(PRFed_server_set)
 
         # The OPRF-processed database entries are simple hashed
-        SH = Simple_hash(self.parameters)
-        for item in PRFed_server_set:
-            for i in range(self.parameters.number_of_hashes):
-                SH.insert(item, i)
+        with self.instrumentation.stage("server.simple_hash", items=len(PRFed_server_set)):
+            SH = Simple_hash(self.parameters)
+            SH.insert_all(np.fromiter(PRFed_server_set, dtype=np.uint64, count=len(PRFed_server_set)))
 
-        padded = SH.get_padded()
+        self.simple_hash = SH
+        padded = SH.get_padded().astype(np.int64)
 
         # Here we perform the partitioning:
         # Namely, we partition each bin into alpha minibins with B/alpha items each
         # We represent each minibin as the coefficients of a polynomial of degree B/alpha that vanishes in all the entries of the mininbin
         # Therefore, each minibin will be represented by B/alpha + 1 coefficients; notice that the leading coeff = 1
-        poly_coeffs = []
-        for i in range(number_of_bins):
-            # we create a list of coefficients of all minibins from concatenating the list of coefficients of each minibin
-            coeffs_from_bin = []
-            for j in range(self.parameters.alpha):
-                roots = [padded[i][self.parameters.minibin_capacity * j + r] for r in range(self.parameters.minibin_capacity)]
-                coeffs_from_bin += coeffs_from_roots(roots, self.parameters.plain_modulus)
-            poly_coeffs.append(coeffs_from_bin)
-        return poly_coeffs
+        # All the minibins of all the bins are built at once, then the coefficients of the minibins of each bin are
+        # concatenated.
+        number_of_bins = 2**self.parameters.output_bits
+        minibins = padded[:, : self.parameters.alpha * self.parameters.minibin_capacity].reshape(-1, self.parameters.minibin_capacity)
+        with self.instrumentation.stage("server.polynomials", minibins=len(minibins)):
+            poly_coeffs = coeffs_from_roots_batched(minibins, self.parameters.plain_modulus, workers)
+        return poly_coeffs.reshape(number_of_bins, -1).astype(np.uint32)
+
+    def preprocess(self, server_set: RawNumbers) -> IntMatrix:
+        """
+        Run beforehand to generate the large server set of values
+        """
+        return t.cast(IntMatrix, self.preprocess_array(server_set).tolist())
 
     def preprocess_transposed(self, server_set: RawNumbers) -> IntMatrix:
-        points = self.preprocess(server_set)
-        return t.cast(IntMatrix, np.transpose(points).tolist())
+        return t.cast(IntMatrix, self.preprocess_array(server_set).T.tolist())
+
+    def add(self, server_set: RawNumbers) -> DatabaseUpdate:
+        """
+        Add numbers to the database built by the last preprocess(). Only the new numbers go through the OPRF and only
+        the minibins they land in are rebuilt. Numbers which are already present are ignored.
+
+        :return: the changed minibins, to be applied to the transposed coefficient matrix being served before it is
+            queried again, as the rows they change are dropped from the PlaintextCache
+        """
+        SH = self._simple_hash()
+        new_items = [item for item in set(self._oprf.server_offline(server_set, self.server_point_precomputed)) if SH.find(item, 0) is None]
+
+        # insert_all() checks every bin has room before inserting anything, so an overflow leaves the table as it was
+        before = SH.occurences.copy()
+        SH.insert_all(np.array(new_items, dtype=np.uint64))
+        changed = {(int(loc), position) for loc in np.flatnonzero(SH.occurences != before) for position in range(before[loc], SH.occurences[loc])}
+        return self._update(changed)
+
+    def remove(self, server_set: RawNumbers) -> DatabaseUpdate:
+        """
+        Remove numbers from the database built by the last preprocess(). Numbers which are not present are ignored.
+
+        :return: the changed minibins, to be applied to the transposed coefficient matrix being served before it is
+            queried again, as the rows they change are dropped from the PlaintextCache
+        """
+        SH = self._simple_hash()
+        changed: set[tuple[int, int]] = set()
+        for item in set(self._oprf.server_offline(server_set, self.server_point_precomputed)):
+            if SH.find(item, 0) is None:
+                continue
+            for i in range(self.parameters.number_of_hashes):
+                loc, position, last = SH.remove(item, i)
+                changed.update([(loc, position), (loc, last)])
+        return self._update(changed)
+
+    def _simple_hash(self) -> Simple_hash:
+        if self.simple_hash is None:
+            raise RuntimeError("preprocess() needs to be run before the database can be updated")
+        return self.simple_hash
+
+    def _update(self, changed: set[tuple[int, int]]) -> DatabaseUpdate:
+        """
+        :param changed: bin and position in the bin of each changed entry of the simple hash table
+        :return: the recomputed coefficients of the minibins containing those entries
+        """
+        SH = self._simple_hash()
+        minibin_capacity = self.parameters.minibin_capacity
+        # Positions past alpha * minibin_capacity are not part of any minibin
+        minibins = sorted({(loc, position // minibin_capacity) for loc, position in changed if position // minibin_capacity < self.parameters.alpha})
+        bins = np.array([loc for loc, _ in minibins], dtype=np.int64)
+        indexes = np.array([j for _, j in minibins], dtype=np.int64)
+
+        roots = np.array([SH.get_padded_bin(loc)[minibin_capacity * j : minibin_capacity * (j + 1)] for loc, j in minibins], dtype=np.int64)
+        coefficients = coeffs_from_roots_batched(roots.reshape(len(minibins), minibin_capacity), self.parameters.plain_modulus)
+        update = DatabaseUpdate(bins, indexes, coefficients.astype(np.uint32))
+        # The rows are encoded again from the matrix the next time they are used, which is after the update is applied
+        if self.plaintext_cache is not None:
+            self.plaintext_cache.invalidate(update)
+        return update
+
+    def save_database(self, path: str | os.PathLike[str], transposed_poly_coeffs: CoeffMatrix) -> None:
+        """
+        Save the output of preprocess_transposed() along with the parameters to a file that can be memory-mapped by
+        load_database()
+        """
+        save_database(path, self.parameters, transposed_poly_coeffs)
+
+    def load_database(self, path: str | os.PathLike[str], verify: bool = True, cache: bool = False) -> npt.NDArray[np.uint32]:
+        """
+        Memory-map a database saved by save_database(). The result can be passed straight to run_overlap_query(), and
+        is shared between all processes which load the same file.
+
+        :param cache: encode the rows of the database up front with cache_plaintexts(), which takes up to
+            plaintext_cache_bytes of memory and a few seconds for large databases
+        """
+        parameters, transposed_poly_coeffs = load_database(path, verify)
+        if parameters.model_dump() != self.parameters.model_dump():
+            raise ValueError("Database was generated with different parameters")
+        if cache:
+            self.cache_plaintexts(transposed_poly_coeffs)
+        return transposed_poly_coeffs
+
+    def cache_plaintexts(self, transposed_poly_coeffs: CoeffMatrix) -> PlaintextCache:
+        """
+        Encode the coefficient rows of the database up front, so that queries against it only need to do the
+        multiplications. Queries against any other matrix are run without the cache.
+        """
+        self.plaintext_cache = PlaintextCache(self.parameters, transposed_poly_coeffs, self.plaintext_cache_bytes)
+        self.plaintext_cache.fill()
+        return self.plaintext_cache
 
     def oprf(self, points: OPRFPoints) -> OPRFPoints:
-        return self._oprf.server_online(self.key, points)
+        with self.instrumentation.stage("server.oprf", items=len(points), compressed=False):
+            return self._oprf.server_online(self.key, points)
+
+    def oprf_compressed(self, points: CompressedPoints) -> CompressedPoints:
+        "oprf() for SEC1 compressed points, which are decompressed by the OPRF worker processes"
+        with self.instrumentation.stage("server.oprf", items=len(points) // POINT_BYTES, bytes=len(points), compressed=True):
+            return self._oprf.server_online_compressed(self.key, points)
 
     def power_reconstruct(self, window: VectorMatrix, exponent: int) -> BFVVector:
         """
@@ -121,31 +379,68 @@ class Server:
             j = j + 1
         return low_depth_multiplication(necessary_powers)
 
-    def run_overlap_query(self, transposed_poly_coeffs: IntMatrix, received_enc_query: VectorMatrix) -> list[BFVVector]:
+    def encrypted_powers(self, received_enc_query: VectorMatrix) -> list[BFVVector]:
         """
-        Realtime run the overlap query to return results to client
+        :param received_enc_query: the encrypted windowing of y
+        :return: Enc(y^{minibin_capacity}), ..., Enc(y^2), Enc(y)
         """
         # Here we recover all the encrypted powers Enc(y), Enc(y^2), Enc(y^3) ..., Enc(y^{minibin_capacity}), from the encrypted windowing of y.
         # These are needed to compute the polynomial of degree minibin_capacity
-        all_powers_orig: list[BFVVector | None] = [None for i in range(self.parameters.minibin_capacity)]
-        for i in range(self.parameters.base - 1):
-            for j in range(self.parameters.logB_ell):
-                if (i + 1) * self.parameters.base**j - 1 < self.parameters.minibin_capacity:
-                    all_powers_orig[(i + 1) * self.parameters.base**j - 1] = received_enc_query[i][j]
-
-        all_powers: list[BFVVector] = []
-        for k in reversed(range(self.parameters.minibin_capacity)):
-            orig = all_powers_orig[k]
-            all_powers.append(self.power_reconstruct(received_enc_query, k + 1) if orig is None else orig)
-
-        # Server sends alpha ciphertexts, obtained from performing dot_product between the polynomial coefficients from the
-        # preprocessed server database and all the powers Enc(y), ..., Enc(y^{minibin_capacity})
-        srv_answer: list[BFVVector] = []
-        for i in range(self.parameters.alpha):
-            # the rows with index multiple of (B/alpha+1) have only 1's
-            dot_product = all_powers[0].copy()
-            for j in range(1, self.parameters.minibin_capacity):
-                dot_product += transposed_poly_coeffs[(self.parameters.minibin_capacity + 1) * i + j] * all_powers[j]
-            dot_product += transposed_poly_coeffs[(self.parameters.minibin_capacity + 1) * i + self.parameters.minibin_capacity]
-            srv_answer.append(dot_product)
-        return srv_answer
+        plan = power_plan(self.parameters.base, self.parameters.logB_ell, self.parameters.minibin_capacity)
+        powers: dict[int, BFVVector] = {}
+        for exponent, (i, j) in plan.window.items():
+            val = received_enc_query[i][j]
+            assert val is not None
+            powers[exponent] = val
+
+        def multiply(step: tuple[int, int, int]) -> BFVVector:
+            return powers[step[1]] * powers[step[2]]
+
+        for level in plan.levels:
+            products = map(multiply, level) if self.query_executor is None else self.query_executor.map(multiply, level)
+            powers.update(zip([exponent for exponent, _, _ in level], products))
+
+        return [powers[k] for k in reversed(range(1, self.parameters.minibin_capacity + 1))]
+
+    def partition_answer(self, transposed_poly_coeffs: CoeffMatrix, all_powers: list[BFVVector], i: int) -> BFVVector:
+        """
+        :return: the dot product between the polynomial coefficients of partition i of the preprocessed server database
+            and all the powers Enc(y), ..., Enc(y^{minibin_capacity})
+        """
+        # the rows with index multiple of (B/alpha+1) have only 1's
+        dot_product = all_powers[0].copy()
+        for j in range(1, self.parameters.minibin_capacity):
+            dot_product += coeff_row(transposed_poly_coeffs, (self.parameters.minibin_capacity + 1) * i + j) * all_powers[j]
+        dot_product += coeff_row(transposed_poly_coeffs, (self.parameters.minibin_capacity + 1) * i + self.parameters.minibin_capacity)
+        return dot_product
+
+    def run_overlap_query(self, transposed_poly_coeffs: CoeffMatrix, received_enc_query: VectorMatrix) -> list[BFVVector]:
+        """
+        Realtime run the overlap query to return results to client
+        """
+        with self.instrumentation.stage("server.query"):
+            with self.instrumentation.stage("server.powers") as stage:
+                if stage.enabled:
+                    received = [v for row in received_enc_query for v in row if v is not None]
+                    plan = power_plan(self.parameters.base, self.parameters.logB_ell, self.parameters.minibin_capacity)
+                    stage.record(ciphertexts=len(received), bytes=sum(len(v.serialize()) for v in received), multiplications=plan.multiplications)
+                all_powers = self.encrypted_powers(received_enc_query)
+
+            # Server sends alpha ciphertexts, one for each partition. The partitions are independent of each other so they
+            # can be evaluated in parallel.
+            cache = self.plaintext_cache
+            answer: t.Callable[[int], BFVVector]
+            with self.instrumentation.stage("server.evaluate", partitions=self.parameters.alpha) as stage:
+                if cache is not None and cache.matrix is transposed_poly_coeffs and cache.supports(all_powers[0]):
+                    answer = partial(cache.partition_answer, [cache.to_ntt(power) for power in all_powers[1:]], all_powers[0])
+                    stage.record(cached=True)
+                else:
+                    answer = partial(self.partition_answer, transposed_poly_coeffs, all_powers)
+                    stage.record(cached=False)
+                if self.query_executor is None:
+                    result = [answer(i) for i in range(self.parameters.alpha)]
+                else:
+                    result = list(self.query_executor.map(answer, range(self.parameters.alpha)))
+                if stage.enabled:
+                    stage.record(ciphertexts=len(result), bytes=sum(len(v.serialize()) for v in result))
+            return result
@@ -0,0 +1,256 @@
+"""
+One database served by several worker processes, with new versions swapped in while serving.
+
+A SharedServer runs the queries on a number of worker processes, each of which memory-maps the same database file, so
+the coefficient matrix is held once in the page cache however many workers there are. Databases built in memory are
+written to a file first, in a directory which can be put on /dev/shm to keep them off the disk. The OPRF runs in the
+process of the SharedServer, on its own process pool.
+
+A new version of the database is published by loading it in each worker alongside the current one, one worker at a
+time so that the others keep serving, and then switching every new query over to it at once. Queries already sent to a
+worker finish against the version they started on, and each worker drops the old version after them.
+
+The rows of the database encoded by the PlaintextCache of each worker are SEAL objects private to that worker, which
+TenSEAL has no way of placing in shared memory, so plaintext_cache_bytes is taken once per worker, twice while a new
+version is being published.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import typing as t
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.pool import Pool
+
+import numpy as np
+import numpy.typing as npt
+import tenseal as ts
+
+from .database import load_database, save_database
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from .oprf import POOL_CONTEXT
+from .parameters import Parameters
+from .plaintexts import DEFAULT_MAX_BYTES
+from .server import Server
+from .session import ContextCache, UnknownContext, context_id
+from .types import BFVVector, CoeffMatrix, CompressedPoints, OPRFPoints, VectorMatrix
+from .wire import BINARY, decode_answer, decode_query, encode_answer, encode_query
+
+# State of a worker process: a Server, with its PlaintextCache, and the mapped matrix of each loaded version of the
+# database, and the public contexts uploaded by the clients.
+_worker_arguments: tuple[Parameters, int, int] | None = None
+_worker_versions: dict[int, tuple[Server, npt.NDArray[np.uint32]]] = {}
+_worker_contexts: ContextCache | None = None
+
+
+def _worker_init(parameters: Parameters, oprf_server_key: int, plaintext_cache_bytes: int, max_context_bytes: int) -> None:
+    global _worker_arguments, _worker_contexts
+    _worker_arguments = parameters, oprf_server_key, plaintext_cache_bytes
+    _worker_contexts = ContextCache(max_context_bytes)
+
+
+def _worker_load(version: int, path: str) -> None:
+    assert _worker_arguments is not None
+    parameters, oprf_server_key, plaintext_cache_bytes = _worker_arguments
+    server = Server(parameters, oprf_server_key, plaintext_cache_bytes=plaintext_cache_bytes)
+    # The SharedServer verified the checksum already
+    _worker_versions[version] = server, server.load_database(path, verify=False, cache=True)
+
+
+def _worker_release(version: int) -> None:
+    _worker_versions.pop(version, None)
+
+
+def _worker_add_context(serialized_context: bytes) -> str:
+    assert _worker_contexts is not None
+    return _worker_contexts.add(serialized_context)
+
+
+def _worker_query(version: int, data: bytes) -> bytes:
+    server, matrix = _worker_versions[version]
+    _, enc_query = decode_query(data, BINARY, _worker_contexts)
+    return encode_answer(server.run_overlap_query(matrix, enc_query), BINARY)
+
+
+class _Worker:
+    def __init__(self, executor: ProcessPoolExecutor):
+        self.executor = executor
+        # Queries sent to the worker which have not finished yet, and versions being loaded
+        self.in_flight = 0
+
+
+class SharedServer:
+    """
+    Server whose queries run on several worker processes sharing one memory-mapped database, which publish() replaces
+    without interrupting the queries
+    """
+
+    def __init__(
+        self,
+        parameters: Parameters,
+        oprf_server_key: int,
+        workers: int = 2,
+        directory: str | os.PathLike[str] | None = None,
+        plaintext_cache_bytes: int = DEFAULT_MAX_BYTES,
+        max_context_bytes: int = 2**30,
+        pool: Pool | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """
+        :param workers: number of worker processes running the queries
+        :param directory: where to write the databases published from memory, by default a temporary directory which
+            is removed by close()
+        :param plaintext_cache_bytes: size of the PlaintextCache of each worker process
+        :param max_context_bytes: size of the cache of client contexts of each worker process
+        :param pool: process pool for the OPRF work, otherwise one is started on first use and kept until close() is
+            called
+        :param instrumentation: to time the OPRF and each query, which is not passed on to the worker processes
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.parameters = parameters
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.server = Server(parameters, oprf_server_key, pool=pool, instrumentation=instrumentation)
+        self._workers = [
+            _Worker(
+                ProcessPoolExecutor(
+                    1, mp_context=POOL_CONTEXT, initializer=_worker_init, initargs=(parameters, oprf_server_key, plaintext_cache_bytes, max_context_bytes)
+                )
+            )
+            for _ in range(workers)
+        ]
+
+        self._owns_directory = directory is None
+        self.directory = os.fspath(directory) if directory is not None else tempfile.mkdtemp(prefix="moya-database-")
+
+        # The current version and the file written for it, if any. Queries are sent under _lock so that a version is
+        # never released by a worker before the queries sent for it.
+        self._version: int | None = None
+        self._written: str | None = None
+        self._next_version = 1
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+        # ID and serialization of each client context, worked out once rather than for every query
+        self._context_ids: weakref.WeakKeyDictionary[ts.Context, tuple[str, bytes]] = weakref.WeakKeyDictionary()
+
+    def __enter__(self) -> "SharedServer":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        "Stop the worker processes and the OPRF worker pool, and remove the databases written by publish()"
+        for worker in self._workers:
+            worker.executor.shutdown(cancel_futures=True)
+        self.server.close()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        elif self._written is not None:
+            os.remove(self._written)
+        self._written = None
+
+    @property
+    def version(self) -> int | None:
+        "the version of the database new queries run against, None until the first publish()"
+        return self._version
+
+    def publish(self, database: str | os.PathLike[str] | CoeffMatrix) -> int:
+        """
+        Load a new version of the database in every worker alongside the current one, then switch new queries over to
+        it. The workers load it one at a time, so all but one of them keep serving the current version meanwhile.
+
+        :param database: a database file written by save_database() or preprocess_stream(), or a transposed
+            coefficient matrix which is written to the directory of the SharedServer
+        :return: the number of the new version
+        """
+        with self._publish_lock:
+            version = self._next_version
+            self._next_version += 1
+
+            written = None
+            if isinstance(database, (str, os.PathLike)):
+                path = os.fspath(database)
+            else:
+                path = written = os.path.join(self.directory, f"database-{version}.bin")
+                save_database(path, self.parameters, database)
+
+            with self.instrumentation.stage("server.publish", version=version, workers=len(self._workers)):
+                try:
+                    # Checked once here rather than by every worker
+                    parameters, _ = load_database(path)
+                    if parameters.model_dump() != self.parameters.model_dump():
+                        raise ValueError("Database was generated with different parameters")
+                    for worker in self._workers:
+                        # Counted as busy so that queries go to the other workers while it loads
+                        with self._lock:
+                            worker.in_flight += 1
+                        try:
+                            worker.executor.submit(_worker_load, version, path).result()
+                        finally:
+                            with self._lock:
+                                worker.in_flight -= 1
+                except BaseException:
+                    for worker in self._workers:
+                        worker.executor.submit(_worker_release, version)
+                    if written is not None:
+                        os.remove(written)
+                    raise
+
+                with self._lock:
+                    old_version, self._version = self._version, version
+                    if old_version is not None:
+                        for worker in self._workers:
+                            worker.executor.submit(_worker_release, old_version)
+
+            # The workers keep their mapping of the old file until they release it
+            if self._written is not None:
+                os.remove(self._written)
+            self._written = written
+            return version
+
+    def oprf(self, points: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(points)
+
+    def oprf_compressed(self, points: CompressedPoints) -> CompressedPoints:
+        return self.server.oprf_compressed(points)
+
+    def _context(self, public_context: ts.Context) -> tuple[str, bytes]:
+        with self._lock:
+            known = self._context_ids.get(public_context)
+            if known is None:
+                serialized = public_context.serialize()
+                known = self._context_ids[public_context] = context_id(serialized), serialized
+            return known
+
+    def _submit(self, worker: _Worker, data: bytes, serialized_context: bytes | None = None) -> "Future[bytes]":
+        "send a query to a worker for the current version, with the client context first if given"
+        with self._lock:
+            if self._version is None:
+                raise RuntimeError("publish() needs to be run before the server can be queried")
+            if serialized_context is not None:
+                worker.executor.submit(_worker_add_context, serialized_context)
+            return worker.executor.submit(_worker_query, self._version, data)
+
+    def run_overlap_query(self, public_context: ts.Context, received_enc_query: VectorMatrix) -> list[BFVVector]:
+        """
+        Run the query on the least busy worker, against the current version of the database
+        """
+        cid, serialized = self._context(public_context)
+        data = encode_query(cid, received_enc_query, BINARY)
+        with self._lock:
+            worker = min(self._workers, key=lambda worker: worker.in_flight)
+            worker.in_flight += 1
+        try:
+            with self.instrumentation.stage("server.shared_query"):
+                try:
+                    answer = self._submit(worker, data).result()
+                except UnknownContext:
+                    answer = self._submit(worker, data, serialized).result()
+        finally:
+            with self._lock:
+                worker.in_flight -= 1
+        return decode_answer(public_context, answer, BINARY)
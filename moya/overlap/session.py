@@ -0,0 +1,118 @@
+"""
+Server-side cache of the public BFV contexts uploaded by clients.
+
+A public context holds the relinearization keys of a client, which is several MB. Rather than sending it with every
+query, a client uploads it once and refers to it by its ID in later queries. The ID is the SHA-256 of the serialized
+context, so uploading the same context again gives the same ID, and a client can tell which ID it will get.
+"""
+
+import hashlib
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+import tenseal as ts
+
+
+class UnknownContext(KeyError):
+    "The context ID is not (or no longer) in the cache, the client needs to upload its context again"
+
+
+class _Entry(t.NamedTuple):
+    context: ts.Context
+    nbytes: int
+    expires: float
+
+
+def context_id(serialized_context: bytes) -> str:
+    "the ID of a serialized public context"
+    return hashlib.sha256(serialized_context).hexdigest()
+
+
+class ContextCache:
+    """
+    Deserialized public contexts by ID. The least recently used contexts are dropped once the cache takes more than
+    max_bytes, and any context which has not been used for ttl seconds is dropped too. The memory taken by a context is
+    estimated from its serialized size.
+    """
+
+    def __init__(self, max_bytes: int = 2**30, ttl: float = 3600, clock: t.Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.nbytes = 0
+        self._contexts: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def __contains__(self, cid: str) -> bool:
+        with self._lock:
+            self._expire()
+            return cid in self._contexts
+
+    def _expire(self) -> None:
+        "drop expired contexts, the least recently used come first"
+        now = self.clock()
+        while self._contexts:
+            cid, entry = next(iter(self._contexts.items()))
+            if entry.expires > now:
+                break
+            self._remove(cid)
+
+    def _remove(self, cid: str) -> None:
+        self.nbytes -= self._contexts.pop(cid).nbytes
+
+    def _refresh(self, cid: str, entry: _Entry) -> None:
+        "push back the expiry of a context and mark it as the most recently used"
+        self._contexts[cid] = entry._replace(expires=self.clock() + self.ttl)
+        self._contexts.move_to_end(cid)
+
+    def add(self, serialized_context: bytes) -> str:
+        """
+        Deserialize a public context and keep it
+
+        :return: its ID
+        """
+        cid = context_id(serialized_context)
+        with self._lock:
+            self._expire()
+            entry = self._contexts.get(cid)
+            if entry is not None:
+                self._refresh(cid, entry)
+                return cid
+
+        # Deserialized outside the lock as it takes a while, another thread adding the same context meanwhile is fine
+        context = ts.context_from(serialized_context)
+        if not context.is_public():
+            raise ValueError("Only public contexts can be uploaded")
+
+        with self._lock:
+            if cid in self._contexts:
+                self._remove(cid)
+            self._contexts[cid] = _Entry(context, len(serialized_context), self.clock() + self.ttl)
+            self.nbytes += len(serialized_context)
+            while self.nbytes > self.max_bytes and len(self._contexts) > 1:
+                self._remove(next(iter(self._contexts)))
+        return cid
+
+    def get(self, cid: str) -> ts.Context:
+        """
+        :return: the context with the given ID
+        :raises UnknownContext: if it is not in the cache
+        """
+        with self._lock:
+            self._expire()
+            entry = self._contexts.get(cid)
+            if entry is None:
+                raise UnknownContext(cid)
+            self._refresh(cid, entry)
+            return entry.context
+
+    def discard(self, cid: str) -> None:
+        "drop a context, for example at the end of a session"
+        with self._lock:
+            if cid in self._contexts:
+                self._remove(cid)
@@ -0,0 +1,229 @@
+"""
+Server database split into shards.
+
+The bin capacity, and with it the work of every query, grows with the size of the server set. A ShardedServer splits
+the set into shards which each have their own database, with the bin capacity of a set of that size, and runs every
+query against all the shards at once. The answers of the shards are put together, and the client decodes them as it
+would the answer of a single server: an item is in the intersection if it is found in any of the answer vectors.
+
+All the shards share the Parameters, which the client needs to know, and the OPRF key. The OPRF runs on the
+coordinator, and the OPRF outputs of the server set are split between the shards by range, so that the shards are
+balanced and an item always goes to the same shard.
+
+A shard is either a LocalShard, which runs in this process, or a ProcessShard, which keeps its database in a worker
+process of its own. Shards on other machines can implement Shard in the same way as ProcessShard, sending the binary
+wire format of the query and answer.
+"""
+
+import threading
+import typing as t
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.pool import Pool
+
+import numpy as np
+import numpy.typing as npt
+import tenseal as ts
+
+from .instrumentation import NULL_INSTRUMENTATION, Instrumentation
+from .oprf import POOL_CONTEXT
+from .parameters import Parameters
+from .server import Server
+from .session import ContextCache, UnknownContext, context_id
+from .types import BFVVector, CompressedPoints, OPRFPoints, RawNumbers, VectorMatrix
+from .wire import BINARY, decode_answer, decode_query, encode_answer, encode_query
+
+
+def shard_of(PRFed_item: int, shards: int, sigma_max: int) -> int:
+    """
+    :param PRFed_item: an OPRF output of the server set, of sigma_max bits
+    :return: the index of the shard it belongs to
+    """
+    return (PRFed_item * shards) >> sigma_max
+
+
+class Shard(ABC):
+    """
+    One part of the server database
+    """
+
+    @abstractmethod
+    def load(self, PRFed_server_set: list[int]) -> None:
+        """
+        Build the database of this shard from the OPRF outputs of its part of the server set
+        """
+        pass
+
+    @abstractmethod
+    def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        """
+        Run a query against the database of this shard
+        """
+        pass
+
+    def close(self) -> None:
+        "Release the resources of this shard"
+
+
+class LocalShard(Shard):
+    """
+    Shard running in this process
+    """
+
+    def __init__(self, parameters: Parameters, oprf_server_key: int, query_executor: Executor | None = None, instrumentation: Instrumentation | None = None):
+        self.server = Server(parameters, oprf_server_key, query_executor=query_executor, instrumentation=instrumentation)
+        self.database: npt.NDArray[np.uint32] | None = None
+
+    def load(self, PRFed_server_set: list[int]) -> None:
+        self.database = self.server.database_from_oprf(PRFed_server_set).T
+        self.server.cache_plaintexts(self.database)
+
+    def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        if self.database is None:
+            raise RuntimeError("load() needs to be run before the shard can be queried")
+        return self.server.run_overlap_query(self.database, enc_query)
+
+    def close(self) -> None:
+        self.server.close()
+
+
+# State of the worker process of a ProcessShard. The queries and answers are exchanged in the binary wire format, and
+# the public contexts of the clients are uploaded once and referred to by ID afterwards.
+_worker_shard: LocalShard | None = None
+_worker_contexts: ContextCache | None = None
+
+
+def _worker_init(parameters: Parameters, oprf_server_key: int, max_context_bytes: int) -> None:
+    global _worker_shard, _worker_contexts
+    _worker_shard = LocalShard(parameters, oprf_server_key)
+    _worker_contexts = ContextCache(max_context_bytes)
+
+
+def _worker_load(PRFed_server_set: list[int]) -> None:
+    assert _worker_shard is not None
+    _worker_shard.load(PRFed_server_set)
+
+
+def _worker_add_context(serialized_context: bytes) -> str:
+    assert _worker_contexts is not None
+    return _worker_contexts.add(serialized_context)
+
+
+def _worker_query(data: bytes) -> bytes:
+    assert _worker_shard is not None
+    public_context, enc_query = decode_query(data, BINARY, _worker_contexts)
+    return encode_answer(_worker_shard.run_query(public_context, enc_query), BINARY)
+
+
+class ProcessShard(Shard):
+    """
+    Shard which keeps its database in a worker process of its own, so that the shards of a server can use all the cores
+    of a machine
+    """
+
+    def __init__(self, parameters: Parameters, oprf_server_key: int, max_context_bytes: int = 2**30):
+        """
+        :param max_context_bytes: size of the cache of client contexts in the worker process
+        """
+        self._executor = ProcessPoolExecutor(1, mp_context=POOL_CONTEXT, initializer=_worker_init, initargs=(parameters, oprf_server_key, max_context_bytes))
+        # ID and serialization of each client context, worked out once rather than for every query
+        self._context_ids: weakref.WeakKeyDictionary[ts.Context, tuple[str, bytes]] = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def load(self, PRFed_server_set: list[int]) -> None:
+        self._executor.submit(_worker_load, PRFed_server_set).result()
+
+    def _context(self, public_context: ts.Context) -> tuple[str, bytes]:
+        with self._lock:
+            known = self._context_ids.get(public_context)
+            if known is None:
+                serialized = public_context.serialize()
+                known = self._context_ids[public_context] = context_id(serialized), serialized
+            return known
+
+    def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        cid, serialized = self._context(public_context)
+        data = encode_query(cid, enc_query, BINARY)
+        try:
+            answer = self._executor.submit(_worker_query, data).result()
+        except UnknownContext:
+            self._executor.submit(_worker_add_context, serialized).result()
+            answer = self._executor.submit(_worker_query, data).result()
+        return decode_answer(public_context, answer, BINARY)
+
+    def close(self) -> None:
+        self._executor.shutdown(cancel_futures=True)
+
+
+class ShardedServer:
+    """
+    Server whose database is split into shards, each queried in parallel
+    """
+
+    def __init__(
+        self,
+        parameters: Parameters,
+        oprf_server_key: int,
+        shards: int | t.Sequence[Shard],
+        processes: bool = True,
+        pool: Pool | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """
+        :param parameters: parameters of every shard, with the bin capacity for the size of a shard rather than of the
+            whole server set. Parameters.for_sizes() of the size of a shard picks them, though it is best to leave some
+            room as the shards are only roughly the same size.
+        :param shards: either the number of shards, or the shards themselves
+        :param processes: with a number of shards, whether to run each of them in its own process (ProcessShard) or
+            in this one (LocalShard)
+        :param pool: process pool for the OPRF work, otherwise one is started on first use and kept until close() is
+            called
+        :param instrumentation: to time each stage, which a ProcessShard does not pass on to its worker process
+        """
+        self.parameters = parameters
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.server = Server(parameters, oprf_server_key, pool=pool, instrumentation=instrumentation)
+        if isinstance(shards, int):
+            if processes:
+                shards = [ProcessShard(parameters, oprf_server_key) for _ in range(shards)]
+            else:
+                shards = [LocalShard(parameters, oprf_server_key, instrumentation=instrumentation) for _ in range(shards)]
+        self.shards = list(shards)
+        self._executor = ThreadPoolExecutor(len(self.shards), thread_name_prefix="shard")
+
+    def close(self) -> None:
+        "Release the OPRF worker pool and the shards"
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+        self.server.close()
+
+    def partition(self, PRFed_server_set: t.Iterable[int]) -> list[list[int]]:
+        "split OPRF outputs of the server set between the shards"
+        parts: list[list[int]] = [[] for _ in self.shards]
+        for item in PRFed_server_set:
+            parts[shard_of(item, len(self.shards), self.parameters.sigma_max)].append(item)
+        return parts
+
+    def preprocess(self, server_set: RawNumbers) -> None:
+        """
+        Run the OPRF over the server set and build the database of every shard from its part of it
+        """
+        with self.instrumentation.stage("server.preprocess", items=len(server_set), shards=len(self.shards)):
+            parts = self.partition(self.server.oprf_offline(server_set))
+            list(self._executor.map(lambda shard, part: shard.load(part), self.shards, parts))
+
+    def oprf(self, points: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(points)
+
+    def oprf_compressed(self, points: CompressedPoints) -> CompressedPoints:
+        return self.server.oprf_compressed(points)
+
+    def run_overlap_query(self, public_context: ts.Context, received_enc_query: VectorMatrix) -> list[BFVVector]:
+        """
+        Run the query against every shard, and return the answers of all of them, shard by shard
+        """
+        with self.instrumentation.stage("server.sharded_query", shards=len(self.shards)):
+            answers = self._executor.map(lambda shard: shard.run_query(public_context, received_enc_query), self.shards)
+            return [vector for answer in answers for vector in answer]
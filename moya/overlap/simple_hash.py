@@ -1,15 +1,36 @@
+import typing as t
+
 import mmh3
+import numpy as np
+import numpy.typing as npt
 
+from .hashing import locations
 from .parameters import Parameters
-from .types import IntMatrix
+
+
+class SimpleHashOverflow(Exception):
+    "A bin of the simple hash table is full, the bin capacity is too small for the set"
 
 
 class Simple_hash:
-    def __init__(self, parameters: Parameters) -> None:
+    """
+    Simple hash table of no_bins bins of bin_capacity items each. The items of each bin are packed at the start of its
+    row of simple_hashed_data, with occurences giving how many there are.
+    """
+
+    def __init__(
+        self, parameters: Parameters, simple_hashed_data: npt.NDArray[np.uint64] | None = None, occurences: npt.NDArray[np.int64] | None = None
+    ) -> None:
+        """
+        Optionally, the table can be given, for example memory-mapped from a file, along with how many items each of
+        its bins has. Otherwise the table starts empty in memory.
+        """
         self.parameters = parameters
         self.no_bins = 2**parameters.output_bits
-        self.simple_hashed_data: list[list[int | None]] = [[None for j in range(parameters.bin_capacity)] for i in range(self.no_bins)]
-        self.occurences = [0 for i in range(self.no_bins)]
+        if simple_hashed_data is None:
+            simple_hashed_data = np.zeros((self.no_bins, parameters.bin_capacity), dtype=np.uint64)
+        self.simple_hashed_data = simple_hashed_data
+        self.occurences = occurences if occurences is not None else np.zeros(self.no_bins, dtype=np.int64)
         self.hash_seed = parameters.hash_seeds
         self.bin_capacity = parameters.bin_capacity
         self.mask_of_power_of_2 = 2**self.parameters.output_bits - 1
@@ -39,11 +60,87 @@ class Simple_hash:
         "insert item using hash i on position given by location"
         loc = self.location(self.hash_seed[i], item)
         if self.occurences[loc] < self.bin_capacity:
-            self.simple_hashed_data[loc][self.occurences[loc]] = self.left_and_index(item, i)
+            self.simple_hashed_data[loc, self.occurences[loc]] = self.left_and_index(item, i)
             self.occurences[loc] += 1
         else:
-            raise Exception("Simple hashing aborted")
+            raise SimpleHashOverflow("Simple hashing aborted")
 
-    def get_padded(self) -> IntMatrix:
-        dummy_msg = 2 ** (self.parameters.sigma_max - self.parameters.output_bits + self.parameters.log_no_hashes) + 1
-        return [[dummy_msg if x is None else x for x in row] for row in self.simple_hashed_data]
+    def insert_all(self, items: npt.NDArray[np.uint64]) -> None:
+        """
+        Insert every item using every hash. The items end up in the same positions as calling insert() for each item,
+        and each hash of the item in turn. Nothing is inserted if any bin would overflow.
+        """
+        items = np.asarray(items, dtype=np.uint64)
+        output_bits, log_no_hashes = np.uint64(self.parameters.output_bits), np.uint64(self.parameters.log_no_hashes)
+
+        # (item, hash) pairs in the order that insert() would be called
+        locs = np.stack([locations(items, seed, self.parameters.output_bits) for seed in self.hash_seed], axis=1).ravel()
+        values = np.stack([((items >> output_bits) << log_no_hashes) + np.uint64(i) for i in range(len(self.hash_seed))], axis=1).ravel()
+
+        counts = np.bincount(locs, minlength=self.no_bins)
+        if (self.occurences + counts > self.bin_capacity).any():
+            raise SimpleHashOverflow("Simple hashing aborted")
+
+        # A stable sort by bin keeps the insertion order within each bin, so each entry is placed after the ones already
+        # in the bin and the ones before it in this batch
+        order = np.argsort(locs, kind="stable")
+        sorted_locs = locs[order]
+        rank = np.arange(len(locs)) - (np.cumsum(counts) - counts)[sorted_locs]
+        self.simple_hashed_data[sorted_locs, self.occurences[sorted_locs] + rank] = values[order]
+        self.occurences += counts
+
+    def find(self, item: int, i: int) -> int | None:
+        "position of item inserted using hash i in its bin, or None if it is not there"
+        loc = self.location(self.hash_seed[i], item)
+        positions = np.flatnonzero(self.simple_hashed_data[loc, : self.occurences[loc]] == self.left_and_index(item, i))
+        return int(positions[0]) if len(positions) else None
+
+    def remove(self, item: int, i: int) -> tuple[int, int, int]:
+        """
+        remove item inserted using hash i, moving the last item of the bin into its place
+
+        :return: the bin, the position the item was removed from and the position which is now empty
+        """
+        loc = self.location(self.hash_seed[i], item)
+        position = self.find(item, i)
+        if position is None:
+            raise KeyError(item)
+        last = int(self.occurences[loc]) - 1
+        self.simple_hashed_data[loc, position] = self.simple_hashed_data[loc, last]
+        self.simple_hashed_data[loc, last] = 0
+        self.occurences[loc] = last
+        return loc, position, last
+
+    @property
+    def dummy_msg(self) -> int:
+        return t.cast(int, 2 ** (self.parameters.sigma_max - self.parameters.output_bits + self.parameters.log_no_hashes) + 1)
+
+    def get_padded_bin(self, loc: int) -> npt.NDArray[np.uint64]:
+        padded: npt.NDArray[np.uint64] = self.simple_hashed_data[loc].copy()
+        padded[self.occurences[loc] :] = self.dummy_msg
+        return padded
+
+    def get_padded(self, bins: slice = slice(None)) -> npt.NDArray[np.uint64]:
+        "the bins, or a range of them, with the empty positions holding the dummy message"
+        empty = np.arange(self.bin_capacity) >= self.occurences[bins, np.newaxis]
+        return t.cast(npt.NDArray[np.uint64], np.where(empty, np.uint64(self.dummy_msg), self.simple_hashed_data[bins]))
+
+    def deduplicate(self, bins: slice = slice(None)) -> int:
+        """
+        Remove repeated entries from the bins, or a range of them, keeping the first of each. An entry only repeats if
+        the same item was inserted more than once.
+
+        :return: the number of entries removed
+        """
+        removed = 0
+        for loc in range(*bins.indices(self.no_bins)):
+            occurences = int(self.occurences[loc])
+            row = self.simple_hashed_data[loc, :occurences]
+            _, first = np.unique(row, return_index=True)
+            if len(first) < occurences:
+                kept = row[np.sort(first)]
+                self.simple_hashed_data[loc, : len(kept)] = kept
+                self.simple_hashed_data[loc, len(kept) : occurences] = 0
+                self.occurences[loc] = len(kept)
+                removed += occurences - len(kept)
+        return removed
@@ -0,0 +1,201 @@
+"""
+Preprocessing of server sets too large to hold in memory.
+
+preprocess_stream() reads the server set in chunks, from an iterator of numbers or a file with one number per line.
+Each chunk goes through the OPRF on the worker pool while the previous one is inserted into the simple hash table. The
+table is memory-mapped from a file in the work directory, and the coefficients are computed a block of bins at a time
+and written straight into the database file. The memory used is bounded by the chunk and block sizes rather than by the
+size of the set, with the table and database pages left to the page cache.
+
+The state is checkpointed in the work directory every few chunks. If preprocessing stops part-way, running it again
+with the same input and work directory carries on from the last checkpoint. The table file is written ahead of the
+checkpoint, but entries past the item counts of the checkpoint are ignored, so anything inserted after it is
+overwritten when the same chunks are inserted again.
+"""
+
+import itertools
+import json
+import os
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from .database import DatabaseWriter
+from .server import Server, coeffs_from_roots_batched
+from .simple_hash import Simple_hash, SimpleHashOverflow
+from .types import RawNumbers
+
+# Numbers read and OPRFed at a time
+DEFAULT_CHUNK_SIZE = 2**16
+
+# Bins whose coefficients are computed at a time
+DEFAULT_BLOCK_SIZE = 512
+
+# Chunks between checkpoints
+DEFAULT_CHECKPOINT_INTERVAL = 16
+
+_TABLE = "simple_hash.bin"
+_STATE = "state.npz"
+
+
+class _Reader:
+    """
+    Chunks of numbers from an iterable or a file, which keeps track of where it is so that it can be resumed
+    """
+
+    def __init__(self, source: t.Iterable[int] | str | os.PathLike[str], chunk_size: int):
+        self.chunk_size = chunk_size
+        self.consumed = 0
+        self.offset = 0
+        self._file: t.BinaryIO | None = None
+        self._iterator: t.Iterator[int] | None = None
+        if isinstance(source, (str, os.PathLike)):
+            self._file = open(source, "rb")
+        else:
+            self._iterator = iter(source)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+    def skip(self, consumed: int, offset: int) -> None:
+        "carry on from where a checkpoint was taken"
+        if self._file is not None:
+            self._file.seek(offset)
+        else:
+            assert self._iterator is not None
+            for _ in itertools.islice(self._iterator, consumed):
+                pass
+        self.consumed, self.offset = consumed, offset
+
+    def read(self) -> RawNumbers:
+        "the next chunk of numbers, empty at the end"
+        if self._iterator is not None:
+            chunk = list(itertools.islice(self._iterator, self.chunk_size))
+        else:
+            assert self._file is not None
+            chunk = []
+            while len(chunk) < self.chunk_size:
+                line = self._file.readline()
+                if not line:
+                    break
+                self.offset += len(line)
+                if line.strip():
+                    chunk.append(int(line))
+        self.consumed += len(chunk)
+        return chunk
+
+
+def preprocess_stream(
+    server: Server,
+    source: t.Iterable[int] | str | os.PathLike[str],
+    path: str | os.PathLike[str],
+    work_dir: str | os.PathLike[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL,
+    workers: int | None = None,
+) -> None:
+    """
+    Preprocess a server set into a database file which can be loaded with Server.load_database(). Repeated numbers
+    only go into the database once.
+
+    :param source: the numbers, or a file with one number per line
+    :param path: where to write the database
+    :param work_dir: directory for the simple hash table and the checkpoints, which can be resumed from
+    :param chunk_size: numbers to read and OPRF at a time
+    :param block_size: bins to compute the coefficients of at a time
+    :param checkpoint_interval: chunks between checkpoints
+    :param workers: number of threads computing the coefficients, defaults to the number of CPUs
+    """
+    parameters = server.parameters
+    os.makedirs(work_dir, exist_ok=True)
+    table_path = os.path.join(work_dir, _TABLE)
+    state_path = os.path.join(work_dir, _STATE)
+    number_of_bins = 2**parameters.output_bits
+
+    # Start again if the checkpoint is for different parameters
+    consumed, offset, bins_done = 0, 0, 0
+    occurences = np.zeros(number_of_bins, dtype=np.int64)
+    resume = os.path.exists(state_path) and os.path.exists(table_path)
+    if resume:
+        with np.load(state_path) as state:
+            resume = json.loads(str(state["parameters"])) == parameters.model_dump()
+            if resume:
+                consumed, offset, bins_done = (int(x) for x in state["progress"])
+                occurences = state["occurences"].copy()
+    table = np.memmap(table_path, dtype=np.uint64, mode="r+" if resume else "w+", shape=(number_of_bins, parameters.bin_capacity))
+    SH = Simple_hash(parameters, table, occurences)
+
+    def checkpoint(consumed: int, offset: int, bins_done: int) -> None:
+        "save the state once the files it refers to are on disk"
+        table.flush()
+        tmp_path = f"{state_path}.tmp.npz"
+        np.savez(tmp_path, parameters=json.dumps(parameters.model_dump()), progress=np.array([consumed, offset, bins_done]), occurences=SH.occurences)
+        os.replace(tmp_path, state_path)
+
+    width = parameters.alpha * (parameters.minibin_capacity + 1)
+    writer = DatabaseWriter(path, parameters, (width, number_of_bins))
+    # The table is complete once computing the coefficients has started, but those already computed are lost if the
+    # temporary database file did not survive
+    hashed = bins_done > 0
+    if not writer.resumed:
+        bins_done = 0
+
+    with server.instrumentation.stage("server.preprocess", resumed_items=consumed) as stage:
+        if not hashed:
+            reader = _Reader(source, chunk_size)
+            try:
+                reader.skip(consumed, offset)
+                with ThreadPoolExecutor(1, thread_name_prefix="oprf") as executor:
+                    # The OPRF of the next chunk runs on the worker pool while this one is inserted. Positions in
+                    # the input up to which the chunks have been inserted, and to the end of the current chunk.
+                    inserted = (reader.consumed, reader.offset)
+                    chunk = reader.read()
+                    position = (reader.consumed, reader.offset)
+                    next_PRFed: Future[list[int]] = executor.submit(server.oprf_offline, chunk)
+                    chunks = 0
+                    while chunk:
+                        PRFed = next_PRFed.result()
+                        chunk = reader.read()
+                        next_position = (reader.consumed, reader.offset)
+                        next_PRFed = executor.submit(server.oprf_offline, chunk)
+
+                        items = np.unique(np.array(PRFed, dtype=np.uint64))
+                        with server.instrumentation.stage("server.simple_hash", items=len(items)):
+                            try:
+                                SH.insert_all(items)
+                            except SimpleHashOverflow:
+                                # Numbers repeated between chunks take room until the table is deduplicated. That
+                                # moves entries within the bins, which the last checkpoint no longer matches, so
+                                # the table is checkpointed again without the current chunk.
+                                SH.deduplicate()
+                                checkpoint(*inserted, 0)
+                                SH.insert_all(items)
+                        chunks += 1
+                        if chunks % checkpoint_interval == 0:
+                            checkpoint(*position, 0)
+                        inserted, position = position, next_position
+            finally:
+                reader.close()
+            stage.record(items=reader.consumed)
+            SH.deduplicate()
+            checkpoint(reader.consumed, reader.offset, 0)
+
+        # The coefficients of each block of bins are written into the database, column by column
+        with server.instrumentation.stage("server.polynomials", bins=number_of_bins - bins_done):
+            for start in range(bins_done, number_of_bins, block_size):
+                bins = slice(start, min(start + block_size, number_of_bins))
+                padded = SH.get_padded(bins).astype(np.int64)
+                minibins = padded[:, : parameters.alpha * parameters.minibin_capacity].reshape(-1, parameters.minibin_capacity)
+                coefficients = coeffs_from_roots_batched(minibins, parameters.plain_modulus, workers)
+                writer.matrix[:, bins] = coefficients.reshape(bins.stop - bins.start, width).T
+                if (start // block_size + 1) % checkpoint_interval == 0:
+                    writer.flush()
+                    checkpoint(0, 0, bins.stop)
+
+    writer.commit()
+    server.simple_hash = SH
+    os.remove(state_path)
+    os.remove(table_path)
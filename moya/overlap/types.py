@@ -1,9 +1,17 @@
+import numpy as np
+import numpy.typing as npt
 from tenseal import BFVVector
 
 OPRFPoint = tuple[int, int]
 OPRFPoints = list[OPRFPoint]
+
+# SEC1 compressed points, concatenated
+CompressedPoints = bytes
 VectorMatrix = list[list[BFVVector | None]]
 IntMatrix = list[list[int]]
 
+# Transposed polynomial coefficients of the server database, either as lists or as a (memory-mapped) array
+CoeffMatrix = IntMatrix | npt.NDArray[np.uint32]
+
 # Plain input and output number sets for running the overlap on
 RawNumbers = list[int]
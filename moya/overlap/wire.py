@@ -0,0 +1,282 @@
+"""
+Encoding of the OPRF and query messages exchanged between client and server.
+
+Two content types are supported:
+
+- application/json, the original format: points as arrays of integers and ciphertexts as base64 strings
+- application/x-moya-psi, a binary format. It starts with a 4 byte magic, a version byte and a flags byte, followed
+  by a sequence of frames, each a little-endian uint32 length and that many bytes. A length of 0xFFFFFFFF marks a
+  missing ciphertext. Points are sent as a single frame of fixed-width big-endian coordinates, or of SEC1 compressed
+  points if the compressed points flag is set. A server answers compressed points with compressed points.
+
+A query carries either the public context of the client, or the ID of a context uploaded earlier (see session.py).
+
+Ciphertexts and contexts are sent as serialized by TenSEAL, which already compresses them with SEAL's own compression.
+If the optional zstandard package is installed, the frames of a binary message can also be compressed as a whole.
+
+Clients should send binary requests with an Accept header listing both content types, and fall back to JSON if the
+server replies 415 Unsupported Media Type. Servers pick the response content type with negotiate().
+"""
+
+import json
+import struct
+import typing as t
+from base64 import b64decode, b64encode
+
+import tenseal as ts
+
+from .points import COORDINATE_BYTES
+from .session import ContextCache
+from .types import BFVVector, CompressedPoints, OPRFPoints, VectorMatrix
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+JSON = "application/json"
+BINARY = "application/x-moya-psi"
+
+# Accept header for clients which can take either content type, preferring binary
+ACCEPT = f"{BINARY}, {JSON};q=0.5"
+
+MAGIC = b"MPSI"
+VERSION = 1
+
+# Message flags
+FLAG_ZSTD = 1
+FLAG_COMPRESSED_POINTS = 2
+FLAG_CONTEXT_ID = 4
+_FLAGS = FLAG_ZSTD | FLAG_COMPRESSED_POINTS | FLAG_CONTEXT_ID
+
+_PREAMBLE = struct.Struct("<4sBB")
+_LENGTH = struct.Struct("<I")
+_MISSING = 0xFFFFFFFF
+_SHAPE = struct.Struct("<II")
+
+
+class WireFormatError(ValueError):
+    "A message could not be decoded"
+
+
+def negotiate(accept: str | None) -> str:
+    """
+    :param accept: the Accept header of a request
+    :return: the content type to respond with
+    """
+    if accept and BINARY in [part.split(";")[0].strip() for part in accept.split(",")]:
+        return BINARY
+    return JSON
+
+
+def content_type_of(content_type_header: str | None) -> str:
+    """
+    :return: the content type of a request or response from its Content-Type header, BINARY or JSON
+    """
+    content_type = (content_type_header or JSON).split(";")[0].strip()
+    if content_type not in (BINARY, JSON):
+        raise WireFormatError(f"Unsupported content type {content_type}")
+    return content_type
+
+
+def encode_frames(frames: t.Iterable[bytes | None], compress: bool = False, flags: int = 0) -> bytes:
+    """
+    :param frames: the frames of the message, None for a missing value
+    :param compress: compress the frames with zstd, if the zstandard package is installed
+    :param flags: message flags describing the frames
+    :return: a binary message
+    """
+    body = b"".join(_LENGTH.pack(_MISSING) if frame is None else _LENGTH.pack(len(frame)) + frame for frame in frames)
+    if compress and zstandard is not None:
+        body = zstandard.ZstdCompressor().compress(body)
+        flags |= FLAG_ZSTD
+    return _PREAMBLE.pack(MAGIC, VERSION, flags) + body
+
+
+def decode_frames(data: bytes) -> list[bytes | None]:
+    """
+    :param data: a binary message from encode_frames()
+    :return: the frames of the message
+    """
+    return decode_message(data)[1]
+
+
+def decode_message(data: bytes) -> tuple[int, list[bytes | None]]:
+    """
+    :param data: a binary message from encode_frames()
+    :return: the flags and the frames of the message
+    """
+    if len(data) < _PREAMBLE.size:
+        raise WireFormatError("Message too short")
+    magic, version, flags = _PREAMBLE.unpack_from(data)
+    if magic != MAGIC:
+        raise WireFormatError("Not a binary message")
+    if version != VERSION:
+        raise WireFormatError(f"Unsupported message version {version}")
+    if flags & ~_FLAGS:
+        raise WireFormatError(f"Unsupported message flags {flags}")
+
+    body = memoryview(data)[_PREAMBLE.size :]
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise WireFormatError("Message is compressed with zstd, which needs the zstandard package")
+        body = memoryview(zstandard.ZstdDecompressor().decompress(body))
+
+    frames: list[bytes | None] = []
+    offset = 0
+    while offset < len(body):
+        if offset + _LENGTH.size > len(body):
+            raise WireFormatError("Truncated frame length")
+        (length,) = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        if length == _MISSING:
+            frames.append(None)
+            continue
+        if offset + length > len(body):
+            raise WireFormatError("Truncated frame")
+        frames.append(bytes(body[offset : offset + length]))
+        offset += length
+    return flags, frames
+
+
+def pack_points(points: OPRFPoints) -> bytes:
+    "the coordinates of the points as fixed-width big-endian integers, x then y for each point"
+    return b"".join(x.to_bytes(COORDINATE_BYTES, "big") + y.to_bytes(COORDINATE_BYTES, "big") for x, y in points)
+
+
+def unpack_points(data: bytes) -> OPRFPoints:
+    "the points packed by pack_points()"
+    if len(data) % (2 * COORDINATE_BYTES):
+        raise WireFormatError("Truncated point")
+    from_bytes = int.from_bytes
+    return [
+        (from_bytes(data[i : i + COORDINATE_BYTES], "big"), from_bytes(data[i + COORDINATE_BYTES : i + 2 * COORDINATE_BYTES], "big"))
+        for i in range(0, len(data), 2 * COORDINATE_BYTES)
+    ]
+
+
+def _required(frame: bytes | None) -> bytes:
+    if frame is None:
+        raise WireFormatError("Missing frame")
+    return frame
+
+
+def encode_points(points: OPRFPoints, content_type: str = BINARY, compress: bool = False) -> bytes:
+    "the body of an OPRF request or response"
+    if content_type == BINARY:
+        return encode_frames([pack_points(points)], compress)
+    return json.dumps({"points": points}).encode()
+
+
+def decode_points(data: bytes, content_type: str = BINARY) -> OPRFPoints:
+    "the points of an OPRF request or response body"
+    points = decode_oprf(data, content_type)
+    if isinstance(points, bytes):
+        raise WireFormatError("Expected uncompressed points")
+    return points
+
+
+def encode_compressed_points(points: CompressedPoints, compress: bool = False) -> bytes:
+    "the body of an OPRF request or response with SEC1 compressed points, which is always binary"
+    return encode_frames([points], compress, FLAG_COMPRESSED_POINTS)
+
+
+def decode_oprf(data: bytes, content_type: str = BINARY) -> OPRFPoints | CompressedPoints:
+    """
+    :return: the points of an OPRF request or response body, as compressed points if they were sent that way
+    """
+    if content_type == BINARY:
+        flags, frames = decode_message(data)
+        if len(frames) != 1:
+            raise WireFormatError("Expected a single frame of points")
+        if flags & FLAG_COMPRESSED_POINTS:
+            return _required(frames[0])
+        return unpack_points(_required(frames[0]))
+    return t.cast(OPRFPoints, [tuple(p) for p in json.loads(data)["points"]])
+
+
+def encode_context(public_context: ts.Context, content_type: str = BINARY, compress: bool = False) -> bytes:
+    "the body of a context upload"
+    if content_type == BINARY:
+        return encode_frames([public_context.serialize()], compress)
+    return json.dumps({"public_context": b64encode(public_context.serialize()).decode()}).encode()
+
+
+def decode_context(data: bytes, content_type: str = BINARY) -> bytes:
+    "the serialized public context of a context upload body, to be added to a ContextCache"
+    if content_type == BINARY:
+        frames = decode_frames(data)
+        if len(frames) != 1:
+            raise WireFormatError("Expected a single frame with the context")
+        return _required(frames[0])
+    return b64decode(json.loads(data)["public_context"])
+
+
+def encode_query(public_context: ts.Context | str, enc_query: VectorMatrix, content_type: str = BINARY, compress: bool = False) -> bytes:
+    """
+    :param public_context: the public context of the client, or the ID of the context it uploaded
+    :return: the body of a query request
+    """
+    if content_type == BINARY:
+        rows, columns = len(enc_query), len(enc_query[0]) if enc_query else 0
+        cells = [None if v is None else v.serialize() for row in enc_query for v in row]
+        if isinstance(public_context, str):
+            return encode_frames([_SHAPE.pack(rows, columns), public_context.encode(), *cells], compress, FLAG_CONTEXT_ID)
+        return encode_frames([_SHAPE.pack(rows, columns), public_context.serialize(), *cells], compress)
+
+    query: dict[str, t.Any] = {"enc_query": [[None if v is None else b64encode(v.serialize()).decode() for v in c] for c in enc_query]}
+    if isinstance(public_context, str):
+        query["context_id"] = public_context
+    else:
+        query["public_context"] = b64encode(public_context.serialize()).decode()
+    return json.dumps(query).encode()
+
+
+def _query_context(serialized_context: bytes | None, cid: str | None, contexts: ContextCache | None) -> ts.Context:
+    if cid is None:
+        return ts.context_from(_required(serialized_context))
+    if contexts is None:
+        raise WireFormatError("Context IDs are not supported")
+    return contexts.get(cid)
+
+
+def decode_query(data: bytes, content_type: str = BINARY, contexts: ContextCache | None = None) -> tuple[ts.Context, VectorMatrix]:
+    """
+    :param contexts: the uploaded contexts, to look up queries which refer to one by ID
+    :return: the public context and the encrypted query of a query request body
+    :raises UnknownContext: if the query refers to a context which is not in contexts
+    """
+    if content_type == BINARY:
+        flags, frames = decode_message(data)
+        if len(frames) < 2:
+            raise WireFormatError("Expected the query shape and context")
+        rows, columns = _SHAPE.unpack(_required(frames[0]))
+        if len(frames) != 2 + rows * columns:
+            raise WireFormatError("Query does not match its shape")
+        if flags & FLAG_CONTEXT_ID:
+            public_context = _query_context(None, _required(frames[1]).decode(), contexts)
+        else:
+            public_context = _query_context(frames[1], None, contexts)
+        cells = [None if frame is None else ts.bfv_vector_from(public_context, frame) for frame in frames[2:]]
+        return public_context, [cells[columns * i : columns * (i + 1)] for i in range(rows)]
+
+    query = json.loads(data)
+    if "context_id" in query:
+        public_context = _query_context(None, query["context_id"], contexts)
+    else:
+        public_context = _query_context(b64decode(query["public_context"]), None, contexts)
+    return public_context, [[None if v is None else ts.bfv_vector_from(public_context, b64decode(v)) for v in c] for c in query["enc_query"]]
+
+
+def encode_answer(answer: list[BFVVector], content_type: str = BINARY, compress: bool = False) -> bytes:
+    "the body of a query response"
+    if content_type == BINARY:
+        return encode_frames([v.serialize() for v in answer], compress)
+    return json.dumps([b64encode(v.serialize()).decode() for v in answer]).encode()
+
+
+def decode_answer(public_context: ts.Context, data: bytes, content_type: str = BINARY) -> list[BFVVector]:
+    "the encrypted results of a query response body"
+    if content_type == BINARY:
+        return [ts.bfv_vector_from(public_context, _required(frame)) for frame in decode_frames(data)]
+    return [ts.bfv_vector_from(public_context, b64decode(ct)) for ct in json.loads(data)]
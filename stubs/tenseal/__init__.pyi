@@ -11,6 +11,9 @@ class BFVVector:
     @classmethod
     def lazy_load(cls, data: bytes) -> BFVVector: ...
     def copy(self) -> BFVVector: ...
+    def context(self) -> Context: ...
+    def size(self) -> int: ...
+    def ciphertext(self) -> list[t.Any]: ...
     def decrypt(self, secret_key: SecretKey | None = None) -> list[int]: ...
     def __mul__(self, other: BFVVector) -> BFVVector: ...
     def __rmul__(self, other: list[int]) -> BFVVector: ...
@@ -21,8 +24,12 @@ class BFVVector:
 
 class Context:
     def __init__(self, *args: t.Any, **kwargs: t.Any) -> None: ...
+    def copy(self) -> Context: ...
     def make_context_public(self) -> None: ...
-    def serialize(self) -> bytes: ...
+    def is_public(self) -> bool: ...
+    def is_private(self) -> bool: ...
+    def has_secret_key(self) -> bool: ...
+    def serialize(self, save_public_key: bool = True, save_secret_key: bool = False, save_galois_keys: bool = True, save_relin_keys: bool = True) -> bytes: ...
     def secret_key(self) -> SecretKey: ...
 
 def context(*args: t.Any, **kwargs: t.Any) -> Context: ...
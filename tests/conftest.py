@@ -2,6 +2,12 @@ import typing as t
 
 # import httpx
 import pytest
+import tenseal as ts
+
+from moya.overlap.client import ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.types import BFVVector, CoeffMatrix, IntMatrix, OPRFPoints, RawNumbers, VectorMatrix
 
 # from app.api.endpoints.overlap import scope_restriction
 # from main import get_app
@@ -17,6 +23,12 @@ import pytest
 #    async with httpx.AsyncClient(app=app, base_url="http://test/api/overlap") as client:
 #        yield client
 
+TEST_SERVER_POINTS: RawNumbers = [
+    487639465982,
+    542438948507207,
+    3259695623874827,
+]
+
 
 def pytest_addoption(parser: pytest.Parser) -> None:
     parser.addoption("--regenerate", action="store_true", help="Regenerate the .expected files")
@@ -25,3 +37,41 @@ def pytest_addoption(parser: pytest.Parser) -> None:
 @pytest.fixture(scope="session")
 def regenerate(pytestconfig: pytest.Config) -> bool:
     return t.cast(bool, pytestconfig.getoption("regenerate"))
+
+
+class LocalClientHelper(ClientHelperBase):
+    """
+    Client helper which talks directly to an in-process server
+    """
+
+    def __init__(self, server: Server, server_points: CoeffMatrix) -> None:
+        self.server = server
+        self.server_points = server_points
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(encoded_client_set)
+
+    async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        return self.server.run_overlap_query(self.server_points, enc_query)
+
+
+@pytest.fixture(scope="session")
+def parameters() -> Parameters:
+    return Parameters()
+
+
+@pytest.fixture(scope="session")
+def server(parameters: Parameters) -> t.Iterator[Server]:
+    server = Server(parameters, 1234567891011121314151617181920)
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope="session")
+def server_points(server: Server) -> IntMatrix:
+    return server.preprocess_transposed(TEST_SERVER_POINTS)
+
+
+@pytest.fixture(scope="session")
+def client_helper(server: Server, server_points: IntMatrix) -> LocalClientHelper:
+    return LocalClientHelper(server, server_points)
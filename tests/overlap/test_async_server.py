@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+import pytest
+
+from moya.overlap.async_server import AsyncServer, ServerBusy
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.types import IntMatrix, OPRFPoints
+
+
+class BlockingServer(Server):
+    "Server whose OPRF waits until it is released, to hold on to the slots of an AsyncServer"
+
+    def __init__(self, parameters: Parameters, key: int) -> None:
+        super().__init__(parameters, key)
+        self.release = threading.Event()
+
+    def oprf(self, points: OPRFPoints) -> OPRFPoints:
+        self.release.wait()
+        return super().oprf(points)
+
+
+async def test_async_server(parameters: Parameters, server: Server, server_points: IntMatrix, client_helper: ClientHelperBase) -> None:
+    client = Client(parameters, client_helper)
+    encoded = client.preprocess_oprf([487639465982, 2345934957037])
+    enc_query = (await client.prepare_query(encoded)).enc_query
+
+    async with AsyncServer(server, max_concurrency=2) as async_server:
+        oprf, query = await asyncio.gather(async_server.oprf(encoded), async_server.run_overlap_query(server_points, enc_query))
+        assert oprf == server.oprf(encoded)
+        assert len(query) == parameters.alpha
+        assert async_server.stats.completed == 2
+
+
+async def test_admission_control(parameters: Parameters) -> None:
+    server = BlockingServer(parameters, 1234567891011121314151617181920)
+    async with AsyncServer(server, max_concurrency=1, max_queue=1) as async_server:
+        running = asyncio.ensure_future(async_server.oprf([], timeout=0.1))
+        queued = asyncio.ensure_future(async_server.oprf([]))
+        await asyncio.sleep(0.01)
+        assert (async_server.stats.queued, async_server.stats.running) == (1, 1)
+
+        # The queue is full
+        with pytest.raises(ServerBusy):
+            await async_server.oprf([])
+
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+
+        # A request past its deadline returns, but its slot is kept until the work is done
+        with pytest.raises(asyncio.TimeoutError):
+            await running
+        assert async_server.stats.running == 1
+
+        server.release.set()
+        assert await async_server.oprf([]) == []
+        stats = async_server.stats
+        assert (stats.running, stats.completed, stats.rejected, stats.timed_out, stats.cancelled) == (0, 1, 1, 1, 1)
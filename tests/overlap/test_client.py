@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import tenseal as ts
+
+from moya.overlap.client import Client, PreparedQuery
+from moya.overlap.cuckoo_hash import Cuckoo
+from moya.overlap.instrumentation import CallbackInstrumentation, StageRecord
+from moya.overlap.parameters import Parameters
+from moya.overlap.types import BFVVector, CompressedPoints, OPRFPoints, VectorMatrix
+from tests.conftest import TEST_SERVER_POINTS, LocalClientHelper
+
+
+async def test_get_intersection_batched(parameters: Parameters, client_helper: LocalClientHelper) -> None:
+    client = Client(parameters, client_helper)
+    client_set = [450258435097, 487639465982, 436874875093495, 542438948507207, 2345934957037]
+
+    batches = [batch async for batch in client.get_intersection_batched(client_set, batch_size=2)]
+    assert batches == [[487639465982], [542438948507207], []]
+
+    assert [batch async for batch in client.get_intersection_batched([])] == []
+
+
+async def test_decode(parameters: Parameters, client_helper: LocalClientHelper) -> None:
+    class FixedResultHelper(LocalClientHelper):
+        "a real OPRF, and a fixed answer to every query"
+
+        results: list[BFVVector] = []
+
+        async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+            return self.results
+
+    CH = Cuckoo(parameters)
+    CH.insert_all(np.arange(100, 200, dtype=np.uint64) << np.uint64(20))
+    bin_of = {index: location for location, index in enumerate(CH.item_index.tolist()) if index >= 0}
+    empty_bin = int(np.flatnonzero(~CH.occupied)[0])
+
+    values: list[list[int | None]] = [[1] * parameters.poly_modulus_degree for _ in range(parameters.alpha)]
+    # Item 3 matches in two partitions, item 42 in one, and an empty bin gives a spurious zero
+    values[0][bin_of[3]] = 0
+    values[5][bin_of[3]] = 0
+    values[7][bin_of[42]] = 0
+    values[2][empty_bin] = 0
+
+    helper = FixedResultHelper(client_helper.server, client_helper.server_points)
+    client = Client(parameters, helper)
+    helper.results = [ts.bfv_vector(client.public_context, partition) for partition in values]
+    assert sorted(await client.run_prepared_query(PreparedQuery(CH, []))) == [3, 42]
+
+
+async def test_oprf_response_mismatch(parameters: Parameters, client_helper: LocalClientHelper) -> None:
+    class ShortHelper(LocalClientHelper):
+        "drops the last point of the OPRF response"
+
+        async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+            return (await super().oprf(encoded_client_set))[:-1]
+
+    class RepeatingHelper(LocalClientHelper):
+        "answers the first half of the points twice, and the second half not at all"
+
+        async def oprf_chunks(self, encoded_client_set: OPRFPoints | CompressedPoints) -> t.AsyncIterator[tuple[int, OPRFPoints | CompressedPoints]]:
+            assert not isinstance(encoded_client_set, bytes)
+            half = await self.oprf(encoded_client_set[: len(encoded_client_set) // 2])
+            yield 0, half
+            yield 0, half
+
+    class TruncatedHelper(LocalClientHelper):
+        "cuts the last compressed point of the OPRF response short"
+
+        async def oprf_compressed(self, encoded_client_set: CompressedPoints) -> CompressedPoints:
+            return (await super().oprf_compressed(encoded_client_set))[:-1]
+
+    for helper in [ShortHelper, RepeatingHelper]:
+        client = Client(parameters, helper(client_helper.server, client_helper.server_points))
+        with pytest.raises(ValueError):
+            await client.get_intersection([450258435097, 487639465982, 542438948507207, 2345934957037])
+        client.close()
+
+    client = Client(parameters, TruncatedHelper(client_helper.server, client_helper.server_points), compressed_points=True)
+    with pytest.raises(ValueError, match="whole number"):
+        await client.get_intersection([450258435097, 487639465982])
+    client.close()
+
+
+async def test_executor(parameters: Parameters, client_helper: LocalClientHelper) -> None:
+    class SlowHelper(LocalClientHelper):
+        "counts the queries the server is working on at once"
+
+        running = most_running = 0
+
+        async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+            SlowHelper.running += 1
+            SlowHelper.most_running = max(SlowHelper.most_running, SlowHelper.running)
+            await asyncio.sleep(0.05)
+            SlowHelper.running -= 1
+            return await super().run_query(public_context, enc_query)
+
+    threads: dict[str, str] = {}
+
+    def record(stage: StageRecord) -> None:
+        threads[stage.name] = threading.current_thread().name
+
+    helper = SlowHelper(client_helper.server, client_helper.server_points)
+    concurrency = asyncio.Semaphore(2)
+    with ThreadPoolExecutor(2, thread_name_prefix="client") as executor:
+        clients = [Client(parameters, helper, executor=executor, concurrency=concurrency, instrumentation=CallbackInstrumentation(record)) for _ in range(4)]
+        client_sets = [[TEST_SERVER_POINTS[i % 3], 10**12 + i] for i in range(4)]
+        results = await asyncio.gather(*(client.get_intersection(client_set) for client, client_set in zip(clients, client_sets)))
+    assert results == [client_set[:1] for client_set in client_sets]
+
+    # The CPU-bound stages ran on the executor, and no more than two queries at once
+    for name in ["client.preprocess_oprf", "client.cuckoo", "client.window", "client.encrypt", "client.decrypt"]:
+        assert threads[name].startswith("client")
+    assert SlowHelper.most_running == 2
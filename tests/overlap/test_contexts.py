@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import pytest
+
+from moya.overlap.client import Client
+from moya.overlap.contexts import ContextPool
+from moya.overlap.instrumentation import CallbackInstrumentation, StageRecord
+from moya.overlap.parameters import Parameters
+from tests.conftest import LocalClientHelper
+
+
+def wait_until_ready(pool: ContextPool, ready: int) -> None:
+    deadline = time.monotonic() + 60
+    while pool.stats.ready < ready:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+async def test_context_pool(parameters: Parameters, client_helper: LocalClientHelper) -> None:
+    records: list[StageRecord] = []
+    with ContextPool(parameters, size=2, instrumentation=CallbackInstrumentation(records.append)) as pool:
+        wait_until_ready(pool, 2)
+        assert pool.stats.generated == 2
+        assert [r.attributes for r in records] == [{"background": True}] * 2
+
+        # Each client gets a key pair of its own, from the pool while there are any ready
+        clients = [Client(parameters, client_helper, contexts=pool) for _ in range(3)]
+        stats = pool.stats
+        assert (stats.hits, stats.misses) == (2, 1)
+        assert stats.hit_rate == pytest.approx(2 / 3)
+        assert stats.mean_generation_seconds > 0
+        assert len({client.private_context.serialize() for client in clients}) == 3
+
+        # Topped up again in the background
+        wait_until_ready(pool, 2)
+        assert pool.stats.generated == 5
+
+        for client in clients:
+            assert client.private_context.is_private() and client.public_context.is_public()
+            assert sorted(await client.get_intersection([487639465982, 2345934957037, 542438948507207])) == [487639465982, 542438948507207]
+            client.close()
+
+    with pytest.raises(ValueError):
+        Client(parameters.model_copy(update={"poly_modulus_degree": 2**14}), client_helper, contexts=pool)
+
+
+async def test_context_pool_latency(parameters: Parameters) -> None:
+    # The event loop is held up while each key pair is generated, but gets to run in between rather than waiting for
+    # the pool to fill up
+    with ContextPool(parameters, size=4) as pool:
+        deadline = time.monotonic() + 60
+        longest = 0.0
+        while pool.stats.ready < 4:
+            assert time.monotonic() < deadline
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            longest = max(longest, time.perf_counter() - start)
+        stats = pool.stats
+        assert stats.generated == 4
+        assert longest < 2 * stats.mean_generation_seconds
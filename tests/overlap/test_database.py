@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from moya.overlap.client import Client
+from moya.overlap.database import DatabaseFormatError
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.types import IntMatrix
+from tests.conftest import LocalClientHelper
+
+
+async def test_save_load(tmp_path, parameters: Parameters, server: Server, server_points: IntMatrix) -> None:
+    path = tmp_path / "db.bin"
+    server.save_database(path, server_points)
+    database = server.load_database(path)
+
+    assert database.dtype == np.uint32
+    assert database.tolist() == server_points
+
+    client = Client(parameters, LocalClientHelper(server, database))
+    assert sorted(await client.get_intersection([450258435097, 487639465982, 542438948507207])) == [487639465982, 542438948507207]
+
+    # Rows are only encoded up front when asked for
+    loader = Server(parameters, server.key)
+    loader.load_database(path)
+    assert loader.plaintext_cache is None
+
+    with pytest.raises(ValueError):
+        Server(Parameters(alpha=8), 1).load_database(path)
+
+    with open(path, "r+b") as f:
+        f.seek(-1, 2)
+        f.write(b"\xff")
+    with pytest.raises(DatabaseFormatError):
+        server.load_database(path)
+    server.load_database(path, verify=False)
+
+    path.write_bytes(b"garbage")
+    with pytest.raises(DatabaseFormatError):
+        server.load_database(path)
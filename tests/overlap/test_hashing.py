@@ -0,0 +1,52 @@
+import mmh3
+import numpy as np
+
+from moya.overlap.cuckoo_hash import Cuckoo
+from moya.overlap.hashing import murmur3_32_of_decimal
+from moya.overlap.parameters import Parameters
+from moya.overlap.simple_hash import Simple_hash
+
+
+def test_murmur3_32_of_decimal() -> None:
+    rng = np.random.default_rng(1)
+    values = np.concatenate([rng.integers(0, 2**62, size=1000, dtype=np.uint64), np.array([0, 9, 10, 1234, 2**32, 2**64 - 1], dtype=np.uint64)])
+    for seed in Parameters().hash_seeds:
+        assert murmur3_32_of_decimal(values, seed).tolist() == [mmh3.hash(str(v), seed, signed=False) for v in values.tolist()]
+
+
+def test_simple_hash_insert_all(parameters: Parameters) -> None:
+    items = np.random.default_rng(2).integers(0, 2**parameters.sigma_max, size=2000, dtype=np.uint64)
+
+    expected = Simple_hash(parameters)
+    for item in items.tolist():
+        for i in range(parameters.number_of_hashes):
+            expected.insert(item, i)
+
+    SH = Simple_hash(parameters)
+    SH.insert_all(items[:1000])
+    SH.insert_all(items[1000:])
+    assert (SH.occurences == expected.occurences).all()
+    assert (SH.get_padded() == expected.get_padded()).all()
+
+
+def test_cuckoo_insert_all(parameters: Parameters) -> None:
+    items = np.random.default_rng(3).integers(0, 2**parameters.sigma_max, size=parameters.max_client_size, dtype=np.uint64)
+    CH = Cuckoo(parameters)
+    CH.insert_all(items)
+
+    assert sorted(CH.item_index[CH.occupied].tolist()) == list(range(len(items)))
+    data_structure = CH.data_structure.tolist()
+    for location in np.flatnonzero(CH.occupied).tolist():
+        seed = parameters.hash_seeds[CH.hash_index[location]]
+        item = int(items[CH.item_index[location]])
+        assert CH.location(seed, item) == location
+        assert CH.reconstruct_item(data_structure[location], location, seed) == item
+
+
+def test_window_array(parameters: Parameters) -> None:
+    CH = Cuckoo(parameters)
+    CH.insert_all(np.random.default_rng(4).integers(0, 2**parameters.sigma_max, size=1000, dtype=np.uint64))
+
+    windowed = CH.window_array()
+    for k, y in enumerate(CH.padded_items().tolist()):
+        assert windowed[:, :, k].tolist() == CH.windowing(y, parameters.minibin_capacity, parameters.plain_modulus)
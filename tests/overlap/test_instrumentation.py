@@ -0,0 +1,81 @@
+import typing as t
+from contextlib import contextmanager
+
+import pytest
+
+from moya.overlap.client import Client
+from moya.overlap.instrumentation import NULL_INSTRUMENTATION, CallbackInstrumentation, OpenTelemetryInstrumentation, StageRecord
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from tests.conftest import TEST_SERVER_POINTS, LocalClientHelper
+
+
+async def test_stages(parameters: Parameters) -> None:
+    records: list[StageRecord] = []
+    instrumentation = CallbackInstrumentation(records.append)
+    server = Server(parameters, 1234567891011121314151617181920, instrumentation=instrumentation)
+    try:
+        server_points = server.preprocess_transposed(TEST_SERVER_POINTS)
+        assert [(r.name, r.parent) for r in records] == [
+            ("server.oprf_offline", "server.preprocess"),
+            ("server.simple_hash", "server.preprocess"),
+            ("server.polynomials", "server.preprocess"),
+            ("server.preprocess", None),
+        ]
+        assert records[-1].attributes == {"items": len(TEST_SERVER_POINTS)}
+
+        records.clear()
+        client = Client(parameters, LocalClientHelper(server, server_points), instrumentation=instrumentation)
+        assert sorted(await client.get_intersection([487639465982, 2345934957037, 542438948507207])) == [487639465982, 542438948507207]
+    finally:
+        server.close()
+
+    stages = {r.name: r for r in records}
+    assert [r.name for r in records if r.parent == "client.run"] == ["client.prepare_query", "client.query", "client.decrypt"]
+    assert [r.name for r in records if r.parent == "client.prepare_query"] == ["client.oprf", "client.cuckoo", "client.window", "client.encrypt"]
+    assert [r.name for r in records if r.parent == "server.query"] == ["server.powers", "server.evaluate"]
+    assert stages["server.oprf"].parent == "client.oprf"
+    assert stages["server.query"].parent == "client.query"
+    assert all(r.seconds >= 0 and r.error is None for r in records)
+
+    assert stages["client.oprf"].attributes["items"] == 3
+    assert stages["client.decrypt"].attributes["matches"] == 2
+    assert stages["client.encrypt"].attributes["ciphertexts"] == stages["server.powers"].attributes["ciphertexts"]
+    assert stages["client.encrypt"].attributes["bytes"] == stages["server.powers"].attributes["bytes"]
+    assert stages["server.evaluate"].attributes["ciphertexts"] == parameters.alpha
+    assert stages["server.evaluate"].attributes["bytes"] == stages["client.query"].attributes["bytes"]
+
+    # Failed stages are reported too
+    records.clear()
+    with pytest.raises(ValueError):
+        with instrumentation.stage("client.test"):
+            raise ValueError
+    assert isinstance(records[0].error, ValueError)
+
+    with NULL_INSTRUMENTATION.stage("client.test", items=1) as stage:
+        assert not stage.enabled
+        stage.record(items=2)
+
+
+def test_opentelemetry() -> None:
+    class Span:
+        def __init__(self, name: str, attributes: dict[str, t.Any]) -> None:
+            self.name = name
+            self.attributes = dict(attributes)
+
+        def set_attributes(self, attributes: dict[str, t.Any]) -> None:
+            self.attributes.update(attributes)
+
+    class Tracer:
+        spans: list[Span] = []
+
+        @contextmanager
+        def start_as_current_span(self, name: str, attributes: dict[str, t.Any]) -> t.Iterator[Span]:
+            span = Span(name, attributes)
+            self.spans.append(span)
+            yield span
+
+    tracer = Tracer()
+    with OpenTelemetryInstrumentation(tracer).stage("server.oprf", items=3) as stage:
+        stage.record(bytes=75)
+    assert [(span.name, span.attributes) for span in tracer.spans] == [("server.oprf", {"items": 3, "bytes": 75})]
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from moya.overlap.fixed_base import FixedBaseTable
+from moya.overlap.oprf import OPRF
+from moya.overlap.parameters import Parameters
+from moya.overlap.points import compress_points, decompress_points
+
+
+def test_pool_matches_inline(parameters: Parameters) -> None:
+    items = list(range(10**12, 10**12 + 300))
+    inline = OPRF(parameters, processes=1)
+    point = 1234567 * inline.G
+
+    with OPRF(parameters, processes=3) as pooled:
+        assert len(pooled.chunks(len(items))) == 5
+        assert pooled.server_offline(items, point) == inline.server_offline(items, point)
+
+        points = [inline.client_offline(item, point) for item in items[:150]]
+        online = pooled.server_online(98765, points)
+        assert online == inline.server_online(98765, points)
+        # The pool is kept between calls
+        pool = pooled.pool
+        assert pooled.client_online(4321, online) == inline.client_online(4321, online)
+        assert pooled.pool is pool
+
+    assert pooled._pool is None
+
+
+def test_compressed_points(parameters: Parameters) -> None:
+    oprf = OPRF(parameters, processes=1)
+    points = [oprf.client_offline(item, oprf.G) for item in range(1, 100)]
+    data = compress_points(points)
+    assert len(data) == 25 * len(points)
+    assert decompress_points(data) == points
+
+    with pytest.raises(ValueError):
+        decompress_points(b"\x04" + data[1:25])
+    with pytest.raises(ValueError):
+        decompress_points(data[:-1])
+
+    online = oprf.server_online_compressed(98765, data)
+    assert decompress_points(online) == oprf.server_online(98765, points)
+    assert oprf.client_online_compressed(4321, online) == oprf.client_online(4321, oprf.server_online(98765, points))
+
+
+def test_fixed_base(parameters: Parameters) -> None:
+    oprf = OPRF(parameters, processes=1)
+    point = 1234567 * oprf.G
+    q = oprf.order_of_generator
+    rng = random.Random(1)
+    scalars = [1, 2, 255, 256, 10**12 + 7, q - 1, q + 1, 2**200 + 3, *(rng.getrandbits(64) for _ in range(50))]
+
+    expected = [oprf.client_offline(item, point) for item in scalars]
+    assert oprf.client_offline_batch(scalars, point) == expected
+    assert FixedBaseTable(point.x, point.y, 192).multiply([0, q, *scalars])[2:] == expected
@@ -0,0 +1,55 @@
+from math import ceil
+
+import pytest
+
+from moya.overlap.client import Client
+from moya.overlap.parameters import Parameters
+from moya.overlap.planner import overflow_probability, required_bin_capacity, window_size
+from moya.overlap.server import Server, power_plan
+from tests.conftest import LocalClientHelper
+
+
+def test_bin_capacity() -> None:
+    # The capacities of the reference implementation
+    for log_server_size, bin_capacity in zip([16, 18, 20, 22, 24], [68, 176, 536, 1832, 6727]):
+        assert required_bin_capacity(2**log_server_size, 2**13, 3) == bin_capacity
+
+    assert overflow_probability(2**20, 2**13, 3, 384) == 1.0
+    assert overflow_probability(2**20, 2**13, 3, 2**22) == 0.0
+    assert overflow_probability(2**20, 2**13, 3, 600) < overflow_probability(2**20, 2**13, 3, 536) < 2**-30
+
+
+@pytest.mark.parametrize("log_server_size", [10, 16, 20, 24])
+def test_for_sizes(log_server_size: int) -> None:
+    server_size = 2**log_server_size
+    parameters = Parameters.for_sizes(server_size, 5535)
+    costs = parameters.predicted_costs(server_size, 5535)
+
+    assert parameters.bin_capacity == parameters.alpha * parameters.minibin_capacity
+    assert parameters.bin_capacity >= required_bin_capacity(server_size, 2**13, 3)
+    assert costs.failure_probability < 2**-30
+    assert costs.depth <= 2
+    assert costs.queries == 1
+
+    plan = power_plan(parameters.base, parameters.logB_ell, parameters.minibin_capacity)
+    assert costs.query_ciphertexts == window_size(parameters.base, parameters.logB_ell, parameters.minibin_capacity) == len(plan.window)
+    assert costs.multiplications == plan.multiplications
+
+    # No worse than the default partitions and windowing
+    default = Parameters(bin_capacity=16 * ceil(required_bin_capacity(server_size, 2**13, 3) / 16))
+    assert costs.seconds <= default.predicted_costs(server_size, 5535).seconds
+
+    # Larger client sets are split into several queries
+    assert parameters.predicted_costs(server_size, 20000).queries == 4
+
+
+async def test_planned_query() -> None:
+    parameters = Parameters.for_sizes(2**10, 100)
+    server = Server(parameters, 1234567891011121314151617181920)
+    try:
+        server_set = list(range(10**10, 10**10 + 1000))
+        client = Client(parameters, LocalClientHelper(server, server.preprocess_transposed(server_set)))
+        assert sorted(await client.get_intersection([10**10 + 5, 10**10 + 999, 10**12])) == [10**10 + 5, 10**10 + 999]
+        client.close()
+    finally:
+        server.close()
@@ -2,13 +2,20 @@ import gzip
 import json
 import os.path
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import pytest
 import tenseal as ts
 
 from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.database import patch_database
 from moya.overlap.parameters import Parameters
-from moya.overlap.server import Server
-from moya.overlap.types import BFVVector, OPRFPoints, VectorMatrix
+from moya.overlap.plaintexts import PlaintextCache, _ciphertext_to_vector
+from moya.overlap.server import Server, coeffs_from_roots, coeffs_from_roots_batched, power_plan
+from moya.overlap.simple_hash import SimpleHashOverflow
+from moya.overlap.types import BFVVector, IntMatrix, OPRFPoints, VectorMatrix
+from tests.conftest import TEST_SERVER_POINTS, LocalClientHelper
 
 
 # Recurse through a data structure and convert tuples to lists
@@ -92,3 +99,128 @@ async def test_client_server(regenerate: bool) -> None:
     # Try again with totally random key
     client = Client(parameters, client_helper)
     assert sorted(await client.get_intersection(test_client_points)) == [487639465982, 542438948507207]
+
+
+def test_coeffs_from_roots_batched() -> None:
+    modulus = Parameters().plain_modulus
+    rng = np.random.default_rng(1)
+    roots = rng.integers(0, 2**30, size=(50, 33))
+    roots[0] = modulus - 1
+
+    batched = coeffs_from_roots_batched(roots, modulus, workers=2)
+    assert batched.tolist() == [coeffs_from_roots(r, modulus) for r in roots.tolist()]
+
+
+def test_incremental_update(tmp_path) -> None:
+    parameters = Parameters(bin_capacity=64)
+    server = Server(parameters, 1234567891011121314151617181920)
+    path = tmp_path / "db.bin"
+    server.save_database(path, server.preprocess_array([1, 2, 3]).T)
+
+    update = server.add([3, 4, 5])
+    assert len(update.bins) == 6, "Two new numbers in three bins each"
+    patch_database(path, update)
+    database = server.load_database(path)
+
+    # Same polynomials as if built from scratch, though the order of items within the bins may differ
+    assert server.simple_hash is not None
+    reference = Server(parameters, 1234567891011121314151617181920)
+    reference.preprocess_array([1, 2, 3, 4, 5])
+    assert reference.simple_hash is not None
+    assert server.simple_hash.occurences.tolist() == reference.simple_hash.occurences.tolist()
+    assert np.sort(server.simple_hash.simple_hashed_data).tolist() == np.sort(reference.simple_hash.simple_hashed_data).tolist()
+
+    update = server.remove([1, 4, 6])
+    assert 6 <= len(update.bins) <= 12
+    for column, rows in update.row_ranges:
+        assert rows.stop - rows.start == parameters.minibin_capacity + 1
+    update.apply(database := np.array(database))
+    assert database.tolist() == np.transpose(server.preprocess_array([2, 3, 5])).tolist()
+
+
+def test_add_overflow() -> None:
+    server = Server(Parameters(bin_capacity=4, alpha=2), 1234567891011121314151617181920)
+    server.preprocess_array([1, 2, 3])
+    assert server.simple_hash is not None
+    occurences = server.simple_hash.occurences.copy()
+    data = server.simple_hash.simple_hashed_data.copy()
+
+    # Too many numbers for the bins, none of them go in
+    with pytest.raises(SimpleHashOverflow):
+        server.add(list(range(10, 3010)))
+    assert server.simple_hash.occurences.tolist() == occurences.tolist()
+    assert server.simple_hash.simple_hashed_data.tolist() == data.tolist()
+    server.close()
+
+
+async def test_parallel_query(parameters: Parameters, server: Server, server_points: IntMatrix, client_helper: ClientHelperBase) -> None:
+    client = Client(parameters, client_helper)
+    enc_query = (await client.prepare_query(client.preprocess_oprf([487639465982, 2345934957037]))).enc_query
+    expected = [r.serialize() for r in server.run_overlap_query(server_points, enc_query)]
+
+    with ThreadPoolExecutor(4) as executor:
+        parallel_server = Server(parameters, server.key, query_executor=executor)
+        assert [r.serialize() for r in parallel_server.run_overlap_query(server_points, enc_query)] == expected
+
+
+async def test_plaintext_cache(
+    parameters: Parameters, server: Server, server_points: IntMatrix, client_helper: ClientHelperBase, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    client = Client(parameters, client_helper)
+    enc_query = (await client.prepare_query(client.preprocess_oprf([487639465982, 2345934957037]))).enc_query
+    secret_key = client.private_context.secret_key()
+    expected = [r.decrypt(secret_key) for r in server.run_overlap_query(server_points, enc_query)]
+
+    # Only some of the rows fit in the cache, the others are encoded for each query
+    cached_server = Server(parameters, server.key, plaintext_cache_bytes=2**22)
+    cache = cached_server.cache_plaintexts(server_points)
+    assert 0 < len(cache) < parameters.alpha * parameters.minibin_capacity
+    assert cache.nbytes <= 2**22
+    assert [r.decrypt(secret_key) for r in cached_server.run_overlap_query(server_points, enc_query)] == expected
+
+    # fill() stops at the first row which does not fit, rather than encoding the others for nothing
+    cache = PlaintextCache(parameters, server_points, 2**22 + 2**17)
+    encoded: list[int] = []
+    encode = cache.encode
+
+    def counting_encode(index: int) -> t.Any:
+        encoded.append(index)
+        return encode(index)
+
+    monkeypatch.setattr(cache, "encode", counting_encode)
+    cache.fill()
+    assert len(encoded) == len(cache) + 1
+
+    # Rows changed by add() are dropped from the cache and encoded again once the update is applied
+    database = cached_server.preprocess_array(TEST_SERVER_POINTS).T.copy()
+    cached_server.cache_plaintexts(database)
+    cached_server.add([2345934957037]).apply(database)
+    expected = [r.decrypt(secret_key) for r in server.run_overlap_query(database, enc_query)]
+    assert [r.decrypt(secret_key) for r in cached_server.run_overlap_query(database, enc_query)] == expected
+    cached_client = Client(parameters, LocalClientHelper(cached_server, database))
+    assert sorted(await cached_client.get_intersection([487639465982, 2345934957037])) == [487639465982, 2345934957037]
+    cached_client.close()
+
+
+def test_ciphertext_to_vector(parameters: Parameters) -> None:
+    # The hand-built BFVVectorProto matches TenSEAL's own serialization, which guards against a TenSEAL upgrade
+    # changing it
+    context = ts.context(ts.SCHEME_TYPE.BFV, poly_modulus_degree=parameters.poly_modulus_degree, plain_modulus=parameters.plain_modulus)
+    vector = ts.bfv_vector(context, [1, 2, 3])
+    wrapped = _ciphertext_to_vector(context, vector.ciphertext()[0], vector.size())
+    assert wrapped.serialize() == vector.serialize()
+    assert wrapped.decrypt() == [1, 2, 3]
+
+
+def test_power_plan(parameters: Parameters) -> None:
+    plan = power_plan(parameters.base, parameters.logB_ell, parameters.minibin_capacity)
+    assert plan.depth == 2
+    assert plan.multiplications == parameters.minibin_capacity - len(plan.window) == 25
+    assert plan.naive_multiplications == 34
+
+    depth = {exponent: 0 for exponent in plan.window}
+    for level, steps in enumerate(plan.levels, 1):
+        for exponent, a, b in steps:
+            assert a + b == exponent and depth[a] < level and depth[b] < level
+            depth[exponent] = level
+    assert sorted(depth) == list(range(1, parameters.minibin_capacity + 1))
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import pytest
+import tenseal as ts
+
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.database import save_database
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.serving import SharedServer
+from moya.overlap.types import BFVVector, OPRFPoints, VectorMatrix
+from moya.overlap.wire import BINARY, decode_answer, encode_query
+from tests.conftest import TEST_SERVER_POINTS
+
+KEY = 1234567891011121314151617181920
+CLIENT_SET = [487639465982, 2345934957037, 542438948507207]
+
+
+class SharedClientHelper(ClientHelperBase):
+    def __init__(self, server: SharedServer) -> None:
+        self.server = server
+        # Answer to give instead of asking the server
+        self.answer: list[BFVVector] | None = None
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(encoded_client_set)
+
+    async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        return self.answer if self.answer is not None else self.server.run_overlap_query(public_context, enc_query)
+
+
+async def test_shared_server(tmp_path, parameters: Parameters) -> None:
+    shared = SharedServer(parameters, KEY, workers=2)
+    try:
+        helper = SharedClientHelper(shared)
+        client = Client(parameters, helper)
+        with pytest.raises(RuntimeError):
+            await client.get_intersection(CLIENT_SET)
+
+        # Published from memory, through a file in the directory of the server
+        assert shared.publish(shared.server.preprocess_transposed(TEST_SERVER_POINTS)) == 1
+        assert [path.name for path in Path(shared.directory).iterdir()] == ["database-1.bin"]
+        for _ in range(3):
+            assert sorted(await client.get_intersection(CLIENT_SET)) == [487639465982, 542438948507207]
+
+        # A query sent before a new version is published finishes against the old one
+        prepared = await client.prepare_query(client.preprocess_oprf(CLIENT_SET))
+        cid, serialized = shared._context(client.public_context)
+        in_flight = shared._submit(shared._workers[0], encode_query(cid, prepared.enc_query, BINARY), serialized)
+
+        path = tmp_path / "database.bin"
+        save_database(path, parameters, shared.server.preprocess_transposed([2345934957037]))
+        assert shared.publish(path) == 2
+        assert shared.version == 2
+        assert list(Path(shared.directory).iterdir()) == []
+        assert sorted(CLIENT_SET[i] for i in await client.run_prepared_query(prepared)) == [2345934957037]
+        helper.answer = decode_answer(client.public_context, in_flight.result(), BINARY)
+        assert sorted(CLIENT_SET[i] for i in await client.run_prepared_query(prepared)) == [487639465982, 542438948507207]
+        helper.answer = None
+
+        # Databases for other parameters are turned away, and the current version kept
+        other = Parameters(bin_capacity=2 * parameters.bin_capacity)
+        other_server = Server(other, KEY)
+        save_database(path, other, other_server.preprocess_transposed(TEST_SERVER_POINTS))
+        other_server.close()
+        with pytest.raises(ValueError):
+            shared.publish(path)
+        assert shared.version == 2
+        assert sorted(await client.get_intersection(CLIENT_SET)) == [2345934957037]
+        client.close()
+    finally:
+        shared.close()
+    assert not Path(shared.directory).exists()
@@ -0,0 +1,35 @@
+import pytest
+import tenseal as ts
+
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.session import ContextCache, UnknownContext, context_id
+
+
+def test_context_cache(parameters: Parameters, client_helper: ClientHelperBase) -> None:
+    now = 0.0
+    serialized = [Client(parameters, client_helper).public_context.serialize() for _ in range(3)]
+    cache = ContextCache(max_bytes=2 * len(serialized[0]) + 1000, ttl=10, clock=lambda: now)
+
+    ids = [cache.add(s) for s in serialized[:2]]
+    assert ids == [context_id(s) for s in serialized[:2]]
+    assert cache.add(serialized[0]) == ids[0] and len(cache) == 2
+    assert isinstance(cache.get(ids[0]), ts.Context)
+
+    # Over the memory bound, the least recently used context is dropped
+    now = 5
+    cache.get(ids[0])
+    ids.append(cache.add(serialized[2]))
+    assert ids[0] in cache and ids[1] not in cache and ids[2] in cache
+    with pytest.raises(UnknownContext):
+        cache.get(ids[1])
+
+    # Contexts expire when not used for ttl seconds
+    now = 14
+    cache.get(ids[2])
+    now = 16
+    assert ids[0] not in cache and ids[2] in cache
+    assert cache.nbytes == len(serialized[2])
+
+    with pytest.raises(ValueError):
+        cache.add(Client(parameters, client_helper).private_context.serialize(save_secret_key=True))
@@ -0,0 +1,45 @@
+import pytest
+import tenseal as ts
+
+from moya.overlap.client import Client, ClientHelperBase
+from moya.overlap.parameters import Parameters
+from moya.overlap.sharded import ShardedServer
+from moya.overlap.types import BFVVector, OPRFPoints, VectorMatrix
+
+
+class ShardedClientHelper(ClientHelperBase):
+    def __init__(self, server: ShardedServer) -> None:
+        self.server = server
+
+    async def oprf(self, encoded_client_set: OPRFPoints) -> OPRFPoints:
+        return self.server.oprf(encoded_client_set)
+
+    async def run_query(self, public_context: ts.Context, enc_query: VectorMatrix) -> list[BFVVector]:
+        return self.server.run_overlap_query(public_context, enc_query)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+async def test_sharded_server(processes: bool) -> None:
+    # Each shard only needs the bin capacity of its share of the server set
+    server_set = list(range(10**10, 10**10 + 3000))
+    parameters = Parameters.for_sizes(len(server_set) // 2, 100)
+    server = ShardedServer(parameters, 1234567891011121314151617181920, shards=3, processes=processes)
+    try:
+        PRFed_server_set = server.server.oprf_offline(server_set)
+        parts = server.partition(PRFed_server_set)
+        assert sorted(item for part in parts for item in part) == sorted(PRFed_server_set)
+        assert all(800 < len(part) < 1200 for part in parts)
+
+        server.preprocess(server_set)
+        client = Client(parameters, ShardedClientHelper(server))
+        client_set = [10**10 + i for i in range(0, 3000, 150)] + [10**12, 10**12 + 1]
+        for _ in range(2):
+            # The second time round, process shards have the context of the client already
+            assert sorted(await client.get_intersection(client_set)) == client_set[:-2]
+
+        # The answer holds the answers of every shard
+        prepared = await client.prepare_query(client.preprocess_oprf([1]))
+        assert len(server.run_overlap_query(client.public_context, prepared.enc_query)) == 3 * parameters.alpha
+        client.close()
+    finally:
+        server.close()
@@ -0,0 +1,136 @@
+import os
+import typing as t
+
+import numpy as np
+import pytest
+
+import moya.overlap.streaming
+from moya.overlap.client import Client
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.simple_hash import Simple_hash
+from moya.overlap.streaming import preprocess_stream
+from tests.conftest import LocalClientHelper
+
+SERVER_SET = [10**10 + 7 * i for i in range(3000)]
+
+
+def interrupted(numbers: list[int], after: int) -> t.Iterator[int]:
+    "the numbers, with a crash part of the way through"
+    for i, number in enumerate(numbers):
+        if i == after:
+            raise RuntimeError("crash")
+        yield number
+
+
+async def test_preprocess_stream(tmp_path, parameters: Parameters) -> None:
+    server = Server(parameters, 1234567891011121314151617181920)
+    try:
+        # Numbers repeated within and between chunks only go in once
+        numbers_file = tmp_path / "numbers.txt"
+        numbers_file.write_text("\n".join(str(n) for n in SERVER_SET + SERVER_SET[:500]) + "\n\n")
+        path = tmp_path / "db.bin"
+        preprocess_stream(server, numbers_file, path, tmp_path / "work", chunk_size=700)
+        assert list((tmp_path / "work").iterdir()) == []
+
+        streamed = server.simple_hash
+        assert streamed is not None
+        expected = server.preprocess_array(SERVER_SET)
+        assert server.simple_hash is not None
+        assert (streamed.occurences == server.simple_hash.occurences).all()
+        for loc in range(0, streamed.no_bins, 97):
+            occurences = streamed.occurences[loc]
+            assert sorted(streamed.simple_hashed_data[loc, :occurences]) == sorted(server.simple_hash.simple_hashed_data[loc, :occurences])
+
+        database = server.load_database(path, cache=True)
+        assert server.plaintext_cache is not None and len(server.plaintext_cache) > 0
+        assert database.shape == expected.T.shape
+        client = Client(parameters, LocalClientHelper(server, database))
+        assert sorted(await client.get_intersection([SERVER_SET[0], SERVER_SET[-1], 10**12])) == [SERVER_SET[0], SERVER_SET[-1]]
+        client.close()
+    finally:
+        server.close()
+
+
+def test_resume(tmp_path, parameters: Parameters, monkeypatch: pytest.MonkeyPatch) -> None:
+    server = Server(parameters, 1234567891011121314151617181920)
+    try:
+        preprocess_stream(server, SERVER_SET, tmp_path / "expected.bin", tmp_path / "work", chunk_size=250)
+        expected = (tmp_path / "expected.bin").read_bytes()
+
+        # Crash while hashing, after a few checkpoints
+        path = tmp_path / "db.bin"
+        with pytest.raises(RuntimeError):
+            preprocess_stream(server, interrupted(SERVER_SET, 1900), path, tmp_path / "work", chunk_size=250, checkpoint_interval=3)
+        assert not path.exists()
+
+        # Crash while computing the coefficients
+        calls, crash_at = 0, 10
+        coeffs_from_roots_batched = moya.overlap.streaming.coeffs_from_roots_batched
+
+        def crashing(roots: np.ndarray, modulus: int, workers: int | None = None) -> np.ndarray:
+            nonlocal calls
+            calls += 1
+            if calls == crash_at:
+                raise RuntimeError("crash")
+            return coeffs_from_roots_batched(roots, modulus, workers)
+
+        monkeypatch.setattr(moya.overlap.streaming, "coeffs_from_roots_batched", crashing)
+        with pytest.raises(RuntimeError):
+            preprocess_stream(server, SERVER_SET, path, tmp_path / "work", chunk_size=250, block_size=256, checkpoint_interval=4)
+        calls, crash_at = 0, 0
+        preprocess_stream(server, SERVER_SET, path, tmp_path / "work", chunk_size=250, block_size=256, checkpoint_interval=4)
+        # Carried on from the checkpoint after the 8th block rather than starting again
+        assert calls == 32 - 8
+        assert path.read_bytes() == expected
+
+        # The coefficients computed before the crash are computed again if the temporary database file is lost
+        calls, crash_at = 0, 10
+        with pytest.raises(RuntimeError):
+            preprocess_stream(server, SERVER_SET, path, tmp_path / "work", chunk_size=250, block_size=256, checkpoint_interval=4)
+        os.remove(f"{path}.tmp")
+        calls, crash_at = 0, 0
+        preprocess_stream(server, SERVER_SET, path, tmp_path / "work", chunk_size=250, block_size=256, checkpoint_interval=4)
+        assert calls == 32
+        assert path.read_bytes() == expected
+    finally:
+        server.close()
+
+
+def test_resume_after_deduplicate(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Small bins, so that the repeated numbers fill them up and the table is deduplicated part of the way through. Each
+    # chunk also has numbers of its own, which are lost if a chunk is skipped on resuming.
+    server = Server(Parameters(bin_capacity=12, alpha=2), 1234567891011121314151617181920)
+    repeated = SERVER_SET[:400]
+    numbers = [n for i in range(8) for n in repeated + SERVER_SET[400 + 100 * i : 500 + 100 * i]]
+    try:
+        preprocess_stream(server, numbers, tmp_path / "expected.bin", tmp_path / "work", chunk_size=500)
+        expected = (tmp_path / "expected.bin").read_bytes()
+
+        # Crash while inserting the chunk which did not fit before the table was deduplicated
+        deduplicate, insert_all = Simple_hash.deduplicate, Simple_hash.insert_all
+        deduplicated = False
+
+        def crashing_deduplicate(self: Simple_hash, bins: slice = slice(None)) -> int:
+            nonlocal deduplicated
+            deduplicated = True
+            return deduplicate(self, bins)
+
+        def crashing_insert_all(self: Simple_hash, items: np.ndarray) -> None:
+            if deduplicated:
+                raise RuntimeError("crash")
+            insert_all(self, items)
+
+        monkeypatch.setattr(Simple_hash, "deduplicate", crashing_deduplicate)
+        monkeypatch.setattr(Simple_hash, "insert_all", crashing_insert_all)
+        path = tmp_path / "db.bin"
+        with pytest.raises(RuntimeError):
+            preprocess_stream(server, numbers, path, tmp_path / "work", chunk_size=500, checkpoint_interval=1)
+        monkeypatch.undo()
+
+        preprocess_stream(server, numbers, path, tmp_path / "work", chunk_size=500, checkpoint_interval=1)
+        assert path.read_bytes() == expected
+        assert server.simple_hash is not None
+        assert int(server.simple_hash.occurences.sum()) == 3 * 1200
+    finally:
+        server.close()
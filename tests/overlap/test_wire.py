@@ -0,0 +1,187 @@
+import typing as t
+
+import httpx
+import pytest
+
+from moya.overlap.client_httpx import HTTPClientHelper
+from moya.overlap.parameters import Parameters
+from moya.overlap.server import Server
+from moya.overlap.session import ContextCache, UnknownContext
+from moya.overlap.types import IntMatrix
+from moya.overlap.wire import (
+    BINARY,
+    JSON,
+    WireFormatError,
+    content_type_of,
+    decode_answer,
+    decode_context,
+    decode_frames,
+    decode_oprf,
+    decode_points,
+    decode_query,
+    encode_answer,
+    encode_compressed_points,
+    encode_frames,
+    encode_points,
+    negotiate,
+)
+
+
+def test_frames() -> None:
+    frames = [b"", None, b"abc", b"\0" * 100000]
+    assert decode_frames(encode_frames(frames)) == frames
+    assert decode_frames(encode_frames(frames, compress=True)) == frames
+
+    with pytest.raises(WireFormatError):
+        decode_frames(encode_frames(frames)[:-1])
+    with pytest.raises(WireFormatError):
+        decode_frames(b"[]")
+
+    points = [(1, 2), (2**192 - 1, 2**191)]
+    assert decode_points(encode_points(points, BINARY), BINARY) == points
+    assert decode_points(encode_points(points, JSON), JSON) == points
+    assert len(encode_points(points, BINARY)) < len(encode_points(points, JSON))
+
+    assert negotiate(f"{JSON};q=0.5, {BINARY}") == BINARY
+    assert negotiate(None) == negotiate("*/*") == JSON
+
+
+def server_handler(
+    parameters: Parameters,
+    server: Server,
+    server_points: IntMatrix,
+    binary_server: bool = True,
+    contexts: ContextCache | None = None,
+    unsupported_status: int = 415,
+) -> t.Callable[[httpx.Request], httpx.Response]:
+    "server endpoints, which optionally only speak JSON and reject other bodies with unsupported_status, and optionally keep uploaded contexts"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        content_type = content_type_of(request.headers.get("Content-Type"))
+        if content_type == BINARY and not binary_server:
+            return httpx.Response(unsupported_status)
+        response_type = negotiate(request.headers.get("Accept")) if binary_server else JSON
+
+        if request.url.path == "/parameters":
+            return httpx.Response(200, json=parameters.model_dump())
+        if request.url.path == "/oprf":
+            points = decode_oprf(request.content, content_type)
+            if isinstance(points, bytes):
+                response_type = BINARY
+                body = encode_compressed_points(server.oprf_compressed(points))
+            else:
+                body = encode_points(server.oprf(points), response_type)
+        elif request.url.path == "/context":
+            if contexts is None:
+                return httpx.Response(404)
+            return httpx.Response(200, json={"context_id": contexts.add(decode_context(request.content, content_type))})
+        else:
+            try:
+                _, enc_query = decode_query(request.content, content_type, contexts)
+            except UnknownContext:
+                return httpx.Response(404)
+            body = encode_answer(server.run_overlap_query(server_points, enc_query), response_type)
+        return httpx.Response(200, content=body, headers={"Content-Type": response_type})
+
+    return handler
+
+
+@pytest.mark.parametrize("binary_server", [True, False])
+@pytest.mark.parametrize("compressed_points", [True, False])
+async def test_http_client(binary_server: bool, compressed_points: bool, parameters: Parameters, server: Server, server_points: IntMatrix) -> None:
+    handler = server_handler(parameters, server, server_points, binary_server)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client, compressed_points=compressed_points)
+        client = await helper.get_client()
+        assert client.compressed_points == compressed_points
+        assert sorted(await client.get_intersection([487639465982, 2345934957037, 542438948507207])) == [487639465982, 542438948507207]
+        assert helper.binary == binary_server
+
+        # The answer decodes the same whichever way it is sent
+        prepared = await client.prepare_query(client.preprocess_oprf([487639465982]))
+        answer = server.run_overlap_query(server_points, prepared.enc_query)
+        for content_type in (BINARY, JSON):
+            decoded = decode_answer(client.public_context, encode_answer(answer, content_type), content_type)
+            assert [v.serialize() for v in decoded] == [v.serialize() for v in answer]
+
+
+async def test_json_server(parameters: Parameters, server: Server, server_points: IntMatrix) -> None:
+    # A server which validates every body as JSON rejects binary ones as unprocessable rather than unsupported
+    handler = server_handler(parameters, server, server_points, binary_server=False, unsupported_status=422)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client)
+        client = await helper.get_client()
+        assert sorted(await client.get_intersection([487639465982, 2345934957037, 542438948507207])) == [487639465982, 542438948507207]
+        assert not helper.binary
+
+    # Once a server has taken binary requests, client errors are errors
+    handler = server_handler(parameters, server, server_points)
+    failing = False
+
+    def failing_handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(422) if failing and request.url.path == "/oprf" else handler(request)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(failing_handler), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client)
+        client = await helper.get_client()
+        assert await client.get_intersection([487639465982]) == [487639465982]
+        failing = True
+        with pytest.raises(httpx.HTTPStatusError):
+            await client.get_intersection([487639465982])
+        assert helper.binary
+
+
+@pytest.mark.parametrize("compressed_points", [True, False])
+async def test_chunked_oprf(compressed_points: bool, parameters: Parameters, server: Server, server_points: IntMatrix) -> None:
+    handler = server_handler(parameters, server, server_points)
+    oprf_requests = 0
+
+    def flaky_handler(request: httpx.Request) -> httpx.Response:
+        "fail every other OPRF request"
+        nonlocal oprf_requests
+        if request.url.path == "/oprf":
+            oprf_requests += 1
+            if oprf_requests % 2:
+                return httpx.Response(503)
+        return handler(request)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(flaky_handler), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client, oprf_chunk_size=2, oprf_concurrency=2, retry_delay=0, compressed_points=compressed_points)
+        client = await helper.get_client()
+        client_set = [487639465982, 2345934957037, 542438948507207, 12345, 67890]
+        assert sorted(await client.get_intersection(client_set)) == [487639465982, 542438948507207]
+        assert oprf_requests == 6, "Every other request fails, so the three chunks take six requests"
+
+        helper.retries = 0
+        with pytest.raises(httpx.HTTPStatusError):
+            await client.get_intersection(client_set)
+
+
+async def test_sessions(parameters: Parameters, server: Server, server_points: IntMatrix) -> None:
+    contexts = ContextCache()
+    handler = server_handler(parameters, server, server_points, contexts=contexts)
+    paths: list[str] = []
+
+    def logging_handler(request: httpx.Request) -> httpx.Response:
+        paths.append(request.url.path)
+        return handler(request)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(logging_handler), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client)
+        client = await helper.get_client()
+        client_set = [487639465982, 2345934957037, 542438948507207]
+        for _ in range(2):
+            assert sorted(await client.get_intersection(client_set)) == [487639465982, 542438948507207]
+        assert paths.count("/context") == 1 and paths.count("/query") == 2
+
+        # The server lost the context, so it is uploaded again
+        contexts.discard(await helper.upload_context(client.public_context) or "")
+        assert sorted(await client.get_intersection(client_set)) == [487639465982, 542438948507207]
+        assert paths.count("/context") == 2 and paths.count("/query") == 4
+
+    # Servers without sessions get the context with every query
+    async with httpx.AsyncClient(transport=httpx.MockTransport(server_handler(parameters, server, server_points)), base_url="http://test/") as http_client:
+        helper = HTTPClientHelper(http_client)
+        client = await helper.get_client()
+        assert sorted(await client.get_intersection(client_set)) == [487639465982, 542438948507207]
+        assert not helper.sessions